@@ -1,38 +1,262 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import hashlib
+import json
 import os
 import sqlite3
+import threading
+import zlib
 
 import numpy as np
 
-from chg.defaults import CHG_PROJ_DB_PATH
+from chg.db.migrations import migrate
+from chg.db.vector_store import FIELDS, VectorStore, migrate_blobs
+from chg.defaults import CHG_EMBED_MODEL, CHG_PROJ_DB_PATH
 from chg.platform import git
 
 
+# chunk's diff text, in queries over Chunks joined with JOIN_DIFFS_SQL
+CHUNK_TEXT_SQL = "COALESCE(Chunks.chunk, unzip_diff(Diffs.data))"
+JOIN_DIFFS_SQL = "LEFT JOIN Diffs ON Diffs.hash = Chunks.diff_hash"
+DIFF_COMPRESSION_LEVEL = 6
+
+
 def create_chunks_table(conn):
     stmt = """
     CREATE TABLE IF NOT EXISTS Chunks (
         id INTEGER PRIMARY KEY,
         prehash TEXT,
         chunk TEXT,
-        posthash TEXT
+        posthash TEXT,
+        commit_date REAL
     )
     """
     cursor = conn.cursor()
     cursor.execute(stmt)
     conn.commit()
     cursor.close()
+    # seconds since epoch of the commit that produced the chunk
+    add_column_if_missing(conn, "Chunks", "commit_date", "REAL")
+    cursor = conn.cursor()
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS ChunksCommitDate ON Chunks(commit_date)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS ChunksPosthash ON Chunks(posthash)"
+    )
+    conn.commit()
+    cursor.close()
+
 
+def select_chunk_text_sql(existing):
+    # chunk ids and diff text, to fill tables added since. Databases not
+    # yet migrated to Diffs (see chg.db.migrations) only have Chunks.chunk
+    if "Diffs" not in existing:
+        return "SELECT id, chunk FROM Chunks"
+    return "SELECT Chunks.id, {} FROM Chunks {}".format(
+        CHUNK_TEXT_SQL, JOIN_DIFFS_SQL)
 
-def insert_chunk(conn, row):
-    assert len(row) == 3
+
+def create_diffs_table(conn):
+    # compressed diffs, stored once per distinct text
     stmt = """
-    INSERT INTO Chunks(prehash, chunk, posthash) VALUES(?, ?, ?)
+    CREATE TABLE IF NOT EXISTS Diffs (
+        hash TEXT PRIMARY KEY,
+        data BLOB,
+        size INTEGER
+    ) WITHOUT ROWID
     """
     cursor = conn.cursor()
-    cursor.execute(stmt, row)
+    cursor.execute(stmt)
+    conn.commit()
+    cursor.close()
+
+
+def hash_diff(diff):
+    return hashlib.sha256(diff.encode()).hexdigest()
+
+
+def compress_diff(diff):
+    return zlib.compress(diff.encode(), DIFF_COMPRESSION_LEVEL)
+
+
+def decompress_diff(data):
+    if data is None:
+        return None
+    return zlib.decompress(data).decode()
+
+
+def register_functions(conn):
+    # unzip_diff(Diffs.data) in queries returns the diff text
+    conn.create_function("unzip_diff", 1, decompress_diff, deterministic=True)
+
+
+def insert_diffs(cursor, diffs):
+    # hash of each diff (None for no diff), new texts are compressed and added
+    hashes = [None if d is None else hash_diff(d) for d in diffs]
+    unique = {h: d for h, d in zip(hashes, diffs) if h is not None}
+    cursor.executemany(
+        "INSERT OR IGNORE INTO Diffs(hash, data, size) VALUES(?, ?, ?)",
+        [(h, compress_diff(d), len(d)) for h, d in unique.items()],
+    )
+    return hashes
+
+
+def get_diff_stats(conn):
+    # (chunks with a diff, distinct diffs, raw bytes, compressed bytes)
+    stmt = """
+    SELECT
+        (SELECT COUNT(*) FROM Chunks WHERE diff_hash IS NOT NULL),
+        COUNT(*),
+        COALESCE(SUM(size), 0),
+        COALESCE(SUM(length(data)), 0)
+    FROM Diffs
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt)
+    result = cursor.fetchone()
+    cursor.close()
+    return result
+
+
+def insert_chunk(conn, row, commit_date=None):
+    return insert_chunks_many(conn, [row], [commit_date])[0]
+
+
+def insert_chunks_many(conn, rows, commit_dates=None):
+    # rows: (prehash, chunk, posthash), one transaction for all of them
+    if commit_dates is None:
+        commit_dates = [None] * len(rows)
+    stmt = """
+    INSERT INTO Chunks(prehash, diff_hash, posthash, commit_date)
+    VALUES(?, ?, ?, ?)
+    """
+    cursor = conn.cursor()
+    diff_hashes = insert_diffs(cursor, [row[1] for row in rows])
+    chunk_ids = []
+    for row, diff_hash, commit_date in zip(rows, diff_hashes, commit_dates):
+        assert len(row) == 3
+        cursor.execute(stmt, (row[0], diff_hash, row[2], commit_date))
+        chunk_ids.append(cursor.lastrowid)
+    # same transaction, so full-text index and paths never lag
+    insert_chunk_text(cursor, chunk_ids, [row[1] for row in rows])
+    insert_chunk_paths(cursor, chunk_ids, [row[1] for row in rows])
+    conn.commit()
+    cursor.close()
+    return chunk_ids
+
+
+def create_chunk_paths_table(conn):
+    # files touched by each chunk, for filtered search
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ChunkPaths (
+            chunk_id INTEGER,
+            path TEXT,
+            PRIMARY KEY(chunk_id, path),
+            FOREIGN KEY(chunk_id) REFERENCES Chunks(id)
+        )
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS ChunkPathsPath ON ChunkPaths(path)"
+    )
+    # chunks that predate the table
+    if "ChunkPaths" not in existing:
+        cursor.execute(select_chunk_text_sql(existing))
+        rows = cursor.fetchall()
+        insert_chunk_paths(
+            cursor,
+            [row[0] for row in rows],
+            [row[1] for row in rows],
+        )
+    conn.commit()
+    cursor.close()
+
+
+def insert_chunk_paths(cursor, chunk_ids, chunks):
+    cursor.executemany(
+        "INSERT OR IGNORE INTO ChunkPaths(chunk_id, path) VALUES(?, ?)",
+        [(chunk_id, path)
+         for chunk_id, chunk in zip(chunk_ids, chunks) if chunk is not None
+         for path in git.diff_paths(chunk)],
+    )
+
+
+def get_chunks_missing_dates(conn):
+    # (id, posthash) of chunks recorded without a commit date
+    stmt = """
+    SELECT id, posthash FROM Chunks WHERE commit_date IS NULL
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt)
+    results = cursor.fetchall()
+    cursor.close()
+    return results
+
+
+def set_commit_dates(conn, rows):
+    # rows: (commit_date, chunk_id)
+    cursor = conn.cursor()
+    cursor.executemany("UPDATE Chunks SET commit_date = ? WHERE id = ?", rows)
     conn.commit()
-    chunk_id = cursor.lastrowid
     cursor.close()
-    return chunk_id
+
+
+def path_condition(path_glob):
+    # a directory or file path matches everything under it
+    if any(c in path_glob for c in "*?["):
+        return "path GLOB ?", (path_glob, )
+    path_glob = path_glob.rstrip("/")
+    return "(path = ? OR path GLOB ?)", (path_glob, path_glob + "/*")
+
+
+def filter_chunk_ids(
+    conn,
+    path_globs=None,
+    since=None,
+    until=None,
+    commits=None,
+):
+    # ids of chunks that touch any of path_globs, were committed in
+    # [since, until] (seconds since epoch) and whose posthash is in commits
+    conditions = []
+    params = []
+    if path_globs is not None:
+        path_conditions = [path_condition(p) for p in path_globs]
+        conditions.append(
+            "id IN (SELECT chunk_id FROM ChunkPaths WHERE {})".format(
+                " OR ".join(c for c, _ in path_conditions)
+            )
+        )
+        for _, p in path_conditions:
+            params.extend(p)
+    if since is not None:
+        conditions.append("commit_date >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("commit_date <= ?")
+        params.append(until)
+    if commits is not None:
+        # recorded hashes may be abbreviated
+        cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT length(posthash) FROM Chunks")
+        lengths = [row[0] for row in cursor.fetchall() if row[0] is not None]
+        cursor.close()
+        hashes = set(c[:n] for c in commits for n in lengths)
+        conditions.append("posthash IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(sorted(hashes)))
+    stmt = "SELECT id FROM Chunks"
+    if len(conditions) > 0:
+        stmt += " WHERE " + " AND ".join(conditions)
+    cursor = conn.cursor()
+    cursor.execute(stmt, params)
+    results = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return results
 
 
 def create_dialogue_table(conn):
@@ -52,16 +276,120 @@ def create_dialogue_table(conn):
 
 
 def insert_answered_question(conn, row):
+    return insert_answered_questions_many(conn, [row])[0]
+
+
+def insert_answered_questions_many(conn, rows):
+    # rows: (question, answer, chunk_id), one transaction for all of them
     stmt = """
     INSERT INTO Dialogue(question, answer, chunk_id)
     VALUES(?, ?, ?)
     """
     cursor = conn.cursor()
-    cursor.execute(stmt, row)
+    qa_ids = []
+    for row in rows:
+        cursor.execute(stmt, row)
+        qa_ids.append(cursor.lastrowid)
+    insert_answer_text(cursor, qa_ids, [row[1] for row in rows])
     conn.commit()
-    qa_id = cursor.lastrowid
     cursor.close()
-    return qa_id
+    return qa_ids
+
+
+def create_text_tables(conn):
+    # full-text (FTS5) indices over chunks and answers, contentless as
+    # the text is already in Chunks/Dialogue (rowid is that table's id)
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS ChunkText
+        USING fts5(chunk, content='')
+        """
+    )
+    cursor.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS AnswerText
+        USING fts5(answer, content='')
+        """
+    )
+    # rows that predate the full-text indices
+    if "ChunkText" not in existing:
+        cursor.execute(select_chunk_text_sql(existing))
+        rows = cursor.fetchall()
+        insert_chunk_text(
+            cursor,
+            [row[0] for row in rows],
+            [row[1] for row in rows],
+        )
+    if "AnswerText" not in existing:
+        cursor.execute("SELECT id, answer FROM Dialogue")
+        rows = cursor.fetchall()
+        insert_answer_text(
+            cursor,
+            [row[0] for row in rows],
+            [row[1] for row in rows],
+        )
+    conn.commit()
+    cursor.close()
+
+
+def insert_chunk_text(cursor, chunk_ids, chunks):
+    cursor.executemany(
+        "INSERT INTO ChunkText(rowid, chunk) VALUES(?, ?)",
+        [(chunk_id, git.strip_colors(chunk))
+         for chunk_id, chunk in zip(chunk_ids, chunks) if chunk is not None],
+    )
+
+
+def insert_answer_text(cursor, qa_ids, answers):
+    cursor.executemany(
+        "INSERT INTO AnswerText(rowid, answer) VALUES(?, ?)",
+        [(qa_id, str(answer))
+         for qa_id, answer in zip(qa_ids, answers) if answer is not None],
+    )
+
+
+def search_text(conn, match, k, chunk_ids=None):
+    # chunk ids ranked by bm25, for matches in code and in answers
+    # chunk_ids: only consider these chunks (None: all)
+    chunk_filter, answer_filter, params = "", "", ()
+    if chunk_ids is not None:
+        chunk_filter = "AND rowid IN (SELECT value FROM json_each(?))"
+        answer_filter = "AND Dialogue.chunk_id IN (SELECT value FROM json_each(?))"
+        params = (json.dumps(list(chunk_ids)), )
+    chunk_stmt = """
+    SELECT rowid FROM ChunkText WHERE ChunkText MATCH ? {}
+    ORDER BY bm25(ChunkText) LIMIT ?
+    """.format(chunk_filter)
+    answer_stmt = """
+    SELECT Dialogue.chunk_id FROM AnswerText
+    JOIN Dialogue ON Dialogue.id = AnswerText.rowid
+    WHERE AnswerText MATCH ? {} ORDER BY bm25(AnswerText) LIMIT ?
+    """.format(answer_filter)
+    cursor = conn.cursor()
+    cursor.execute(chunk_stmt, (match, ) + params + (k, ))
+    chunk_results = [row[0] for row in cursor.fetchall()]
+    cursor.execute(answer_stmt, (match, ) + params + (k, ))
+    answer_results = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return chunk_results, answer_results
+
+
+def add_column_if_missing(conn, table, column, decl):
+    # tables created by older versions of chg may lack newer columns
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info({})".format(table))
+    columns = [row[1] for row in cursor.fetchall()]
+    added = column not in columns
+    if added:
+        cursor.execute(
+            "ALTER TABLE {} ADD COLUMN {} {}".format(table, column, decl)
+        )
+        conn.commit()
+    cursor.close()
+    return added
 
 
 def create_embeddings_table(conn):
@@ -71,6 +399,10 @@ def create_embeddings_table(conn):
         chunk_id INTEGER,
         code_embedding BLOB,
         nl_embedding BLOB,
+        dialogue_hash TEXT,
+        model TEXT,
+        policy TEXT,
+        row INTEGER,
         FOREIGN KEY(chunk_id) REFERENCES Chunks(id)
     )
     """
@@ -78,27 +410,242 @@ def create_embeddings_table(conn):
     cursor.execute(stmt)
     conn.commit()
     cursor.close()
+    add_column_if_missing(conn, "Embeddings", "dialogue_hash", "TEXT")
+    if add_column_if_missing(conn, "Embeddings", "model", "TEXT"):
+        # embeddings predate other backends
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE Embeddings SET model = ? WHERE model IS NULL",
+            (CHG_EMBED_MODEL, ),
+        )
+        conn.commit()
+        cursor.close()
+    add_column_if_missing(conn, "Embeddings", "policy", "TEXT")
+    # vectors live in the vector store, code/nl_embedding are legacy
+    add_column_if_missing(conn, "Embeddings", "row", "INTEGER")
 
 
-def insert_embeddings(conn, row):
-    assert len(row) == 3, "(chunk_id, code_embedding, nl_embedding) required"
+def insert_embeddings_many(conn, rows):
+    # rows: (chunk_id, dialogue_hash, model, policy, row)
+    # replace any (stale) embeddings for these chunks and model, rather than append
+    # single transaction, which also commits the vector store's rows
     stmt = """
-    INSERT INTO Embeddings(chunk_id, code_embedding, nl_embedding) VALUES(?, ?, ?)
+    INSERT INTO Embeddings(chunk_id, dialogue_hash, model, policy, row)
+    VALUES(?, ?, ?, ?, ?)
+    ON CONFLICT(chunk_id, model) DO UPDATE SET
+        dialogue_hash = excluded.dialogue_hash,
+        policy = excluded.policy,
+        row = excluded.row,
+        code_embedding = NULL,
+        nl_embedding = NULL
     """
     cursor = conn.cursor()
-    cursor.execute(stmt, row)
+    cursor.executemany(stmt, rows)
+    # lastrowid is undefined after executemany and an update, so read
+    # back the ids of the inserted or replaced rows
+    cursor.execute(
+        """
+        SELECT chunk_id, model, id FROM Embeddings
+        WHERE chunk_id IN (SELECT value FROM json_each(?))
+        """,
+        (json.dumps(sorted(set(row[0] for row in rows))), ),
+    )
+    ids = {(chunk_id, model): _id for chunk_id, model, _id in cursor}
     conn.commit()
-    chunk_id = cursor.lastrowid
     cursor.close()
-    return chunk_id
+    return [ids[(row[0], row[2])] for row in rows]
+
+
+def create_index_tables(conn):
+    # what each search index file contains, so it can be updated in place
+    stmts = [
+        """
+        CREATE TABLE IF NOT EXISTS IndexVersions (
+            path TEXT PRIMARY KEY,
+            model TEXT,
+            version INTEGER,
+            n_vectors INTEGER,
+            updated REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS IndexedChunks (
+            path TEXT,
+            chunk_id INTEGER,
+            dialogue_hash TEXT,
+            policy TEXT,
+            PRIMARY KEY(path, chunk_id)
+        )
+        """,
+    ]
+    cursor = conn.cursor()
+    for stmt in stmts:
+        cursor.execute(stmt)
+    conn.commit()
+    cursor.close()
+    # requested index mode and its (json) construction/search parameters
+    add_column_if_missing(conn, "IndexVersions", "mode", "TEXT")
+    add_column_if_missing(conn, "IndexVersions", "params", "TEXT")
+
+
+def get_index_version(conn, path):
+    # (model, version, n_vectors) or None if never built
+    stmt = """
+    SELECT model, version, n_vectors FROM IndexVersions WHERE path = ?
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt, (path, ))
+    result = cursor.fetchone()
+    cursor.close()
+    return result
 
 
-def get_embeddings_by_chunk_id(conn, chunk_id):
+def get_index_params(conn, path):
+    # (mode, params) or None if never built
     stmt = """
-    SELECT code_embedding, nl_embedding FROM Embeddings WHERE chunk_id = ?
+    SELECT mode, params FROM IndexVersions WHERE path = ?
     """
     cursor = conn.cursor()
-    cursor.execute(stmt, (chunk_id, ))
+    cursor.execute(stmt, (path, ))
+    result = cursor.fetchone()
+    cursor.close()
+    return result
+
+
+def get_indexed_chunks(conn, path):
+    stmt = """
+    SELECT chunk_id, dialogue_hash, policy FROM IndexedChunks WHERE path = ?
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt, (path, ))
+    results = {
+        chunk_id: (dialogue_hash, policy)
+        for chunk_id, dialogue_hash, policy in cursor.fetchall()
+    }
+    cursor.close()
+    return results
+
+
+def update_indexed_chunks(
+    conn,
+    path,
+    model,
+    removed,
+    added,
+    n_vectors,
+    mode=None,
+    params=None,
+    rebuilt=False,
+):
+    # removed: chunk ids, added: (chunk_id, dialogue_hash, policy)
+    # single transaction, bumps the index version
+    cursor = conn.cursor()
+    if rebuilt:
+        # nothing carries over
+        cursor.execute("DELETE FROM IndexedChunks WHERE path = ?", (path, ))
+    cursor.executemany(
+        "DELETE FROM IndexedChunks WHERE path = ? AND chunk_id = ?",
+        [(path, chunk_id) for chunk_id in removed],
+    )
+    cursor.executemany(
+        """
+        INSERT OR REPLACE INTO IndexedChunks(path, chunk_id, dialogue_hash, policy)
+        VALUES(?, ?, ?, ?)
+        """,
+        [(path, ) + tuple(row) for row in added],
+    )
+    cursor.execute(
+        """
+        INSERT INTO IndexVersions(
+            path, model, version, n_vectors, updated, mode, params
+        )
+        VALUES(?, ?, 1, ?, julianday('now'), ?, ?)
+        ON CONFLICT(path) DO UPDATE SET
+            model = excluded.model,
+            version = version + 1,
+            n_vectors = excluded.n_vectors,
+            updated = excluded.updated,
+            mode = excluded.mode,
+            params = excluded.params
+        """,
+        (path, model, n_vectors, mode, params),
+    )
+    conn.commit()
+    cursor.close()
+
+
+def get_chunks_by_ids(conn, ids):
+    stmt = """
+    SELECT Chunks.id, {} FROM Chunks {}
+    WHERE Chunks.id IN (SELECT value FROM json_each(?))
+    """.format(CHUNK_TEXT_SQL, JOIN_DIFFS_SQL)
+    cursor = conn.cursor()
+    cursor.execute(stmt, (json.dumps([int(i) for i in ids]), ))
+    results = dict(cursor.fetchall())
+    cursor.close()
+    return results
+
+
+def get_embedding_states(conn, model):
+    stmt = """
+    SELECT chunk_id, dialogue_hash, policy FROM Embeddings WHERE model = ?
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt, (model, ))
+    results = {
+        chunk_id: (dialogue_hash, policy)
+        for chunk_id, dialogue_hash, policy in cursor.fetchall()
+    }
+    cursor.close()
+    return results
+
+
+def hash_dialogue(question_and_answers):
+    # content hash used to detect dialogue changes since last embedding
+    h = hashlib.sha256()
+    for question, answer in question_and_answers:
+        h.update(str(question).encode())
+        h.update(b"\0")
+        h.update(str(answer).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def get_embedding_rows(conn, model):
+    # (chunk_id, row, dialogue_hash, policy) ordered by chunk
+    stmt = """
+    SELECT chunk_id, row, dialogue_hash, policy FROM Embeddings
+    WHERE model = ? AND row IS NOT NULL ORDER BY chunk_id
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt, (model, ))
+    results = cursor.fetchall()
+    cursor.close()
+    return results
+
+
+def get_embedding_rows_by_chunk_ids(conn, chunk_ids, model):
+    # (chunk_id, row) for those of chunk_ids embedded with model
+    stmt = """
+    SELECT chunk_id, row FROM Embeddings
+    WHERE model = ? AND row IS NOT NULL
+    AND chunk_id IN (SELECT value FROM json_each(?))
+    ORDER BY chunk_id
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt, (model, json.dumps([int(i) for i in chunk_ids])))
+    results = cursor.fetchall()
+    cursor.close()
+    return results
+
+
+def get_embeddings_by_chunk_id(conn, chunk_id, model):
+    stmt = """
+    SELECT row FROM Embeddings
+    WHERE chunk_id = ? AND model = ?
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt, (chunk_id, model))
     results = cursor.fetchall()
     cursor.close()
     return results
@@ -106,50 +653,342 @@ def get_embeddings_by_chunk_id(conn, chunk_id):
 
 def get_dialogue_by_ids(conn, ids):
     stmt = """
-    SELECT * from Dialogue WHERE id in ({})
-    """.format(", ".join(str(i) for i in ids))
+    SELECT * from Dialogue WHERE id IN (SELECT value FROM json_each(?))
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt, (json.dumps([int(i) for i in ids]), ))
+    results = cursor.fetchall()
+    cursor.close()
+    return results
+
+
+def get_content_version(conn):
+    # rows only get added, so the largest ids identify the content
+    stmt = """
+    SELECT
+        (SELECT MAX(id) FROM Chunks),
+        (SELECT MAX(id) FROM Dialogue),
+        (SELECT MAX(id) FROM Embeddings)
+    """
     cursor = conn.cursor()
     cursor.execute(stmt)
+    result = cursor.fetchone()
+    cursor.close()
+    return result
+
+
+def get_dialogue_by_chunk_ids(conn, chunk_ids):
+    # dialogue for each chunk, in the order of chunk_ids
+    stmt = """
+    SELECT * from Dialogue
+    WHERE chunk_id IN (SELECT value FROM json_each(?))
+    ORDER BY id
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt, (json.dumps([int(i) for i in chunk_ids]), ))
     results = cursor.fetchall()
     cursor.close()
+    rank = {chunk_id: i for i, chunk_id in enumerate(chunk_ids)}
+    # Dialogue: id, question, answer, chunk_id
+    return sorted(results, key=lambda row: rank[row[3]])
+
+
+# a search hit: the chunk, files it touches, the start of its diff and all
+# its dialogue, ranked. score is the searcher's (None if not known)
+SearchResult = namedtuple(
+    "SearchResult",
+    [
+        "rank",
+        "chunk_id",
+        "prehash",
+        "posthash",
+        "commit_date",
+        "paths",
+        "excerpt",
+        "dialogue",
+        "score",
+    ],
+)
+# lines of each hit's diff returned as its excerpt
+EXCERPT_LINES = 20
+
+
+def get_search_results(conn, chunk_ids, scores=None, excerpt_lines=EXCERPT_LINES):
+    # SearchResult for each chunk, in the order of chunk_ids, in one query
+    if len(chunk_ids) == 0:
+        return []
+    stmt = """
+    SELECT
+        Chunks.id,
+        Chunks.prehash,
+        Chunks.posthash,
+        Chunks.commit_date,
+        {},
+        (
+            SELECT json_group_array(path) FROM ChunkPaths
+            WHERE ChunkPaths.chunk_id = Chunks.id
+        ),
+        (
+            SELECT json_group_array(json_array(question, answer)) FROM (
+                SELECT question, answer FROM Dialogue
+                WHERE Dialogue.chunk_id = Chunks.id ORDER BY Dialogue.id
+            )
+        )
+    FROM json_each(?) AS ranked JOIN Chunks ON Chunks.id = ranked.value
+    {}
+    ORDER BY ranked.key
+    """.format(CHUNK_TEXT_SQL, JOIN_DIFFS_SQL)
+    cursor = conn.cursor()
+    cursor.execute(stmt, (json.dumps([int(i) for i in chunk_ids]), ))
+    rows = cursor.fetchall()
+    cursor.close()
+    if scores is None:
+        scores = [None] * len(chunk_ids)
+    score_of = dict(zip([int(i) for i in chunk_ids], scores))
+    results = []
+    for rank, row in enumerate(rows):
+        chunk_id, prehash, posthash, commit_date, chunk, paths, dialogue = row
+        excerpt = None
+        if chunk is not None:
+            lines = git.strip_colors(chunk).split("\n")
+            excerpt = "\n".join(lines[:excerpt_lines])
+        results.append(SearchResult(
+            rank=rank,
+            chunk_id=chunk_id,
+            prehash=prehash,
+            posthash=posthash,
+            commit_date=commit_date,
+            paths=json.loads(paths),
+            excerpt=excerpt,
+            dialogue=[tuple(qa) for qa in json.loads(dialogue)],
+            score=score_of.get(chunk_id),
+        ))
     return results
 
 
+# WAL: readers don't block the writer, and commits append to the log
+# instead of rewriting pages. synchronous=NORMAL only syncs at checkpoints,
+# which is still safe against corruption in WAL mode
+PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("temp_store", "MEMORY"),
+    # negative: KiB
+    ("cache_size", -64000),
+]
+
+
+def run_query(conn, stmt, params=()):
+    cursor = conn.cursor()
+    cursor.execute(stmt, params)
+    results = cursor.fetchall()
+    cursor.close()
+    return results
+
+
+# readers can't change the journal mode, the writer has already set it
+READER_PRAGMAS = [
+    ("temp_store", "MEMORY"),
+    ("cache_size", -64000),
+]
+
+
+def set_pragmas(conn, pragmas=PRAGMAS):
+    for name, value in pragmas:
+        conn.execute("PRAGMA {} = {}".format(name, value))
+
+
+def open_connection(db_path, readonly=False):
+    # the writer is handed between threads under a lock, read-only
+    # connections never create or change the database
+    if readonly:
+        uri = "file:{}?mode=ro".format(os.path.abspath(db_path))
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        set_pragmas(conn, READER_PRAGMAS)
+    else:
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        set_pragmas(conn)
+    register_functions(conn)
+    return conn
+
+
+class DeferredCommits(object):
+    """
+    Stands in for a connection inside Database.transaction(): commits by
+    the insert functions are no-ops, the transaction commits once at the end
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def commit(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class ConnectionManager(object):
+    """
+    Connections to one database shared by many threads: a single writer,
+    used by one thread at a time, and a read-only connection per thread.
+    In WAL mode readers see the last commit and are not blocked by a write
+    in progress
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.writer = open_connection(db_path)
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        # every thread's reader, so close() can close them all
+        self.readers = []
+        self.readers_lock = threading.Lock()
+        # thread holding the lock, and how many transactions deep it is
+        self.owner = None
+        self.depth = 0
+
+    def holds_lock(self):
+        return self.owner == threading.get_ident()
+
+    def current_writer(self):
+        if self.depth > 0 and self.holds_lock():
+            return DeferredCommits(self.writer)
+        return self.writer
+
+    @contextmanager
+    def write(self):
+        # the writer, held by this thread until the block ends
+        with self.lock:
+            owner = self.owner
+            self.owner = threading.get_ident()
+            try:
+                yield self.current_writer()
+            finally:
+                self.owner = owner
+
+    @contextmanager
+    def transaction(self):
+        # writes inside the block are committed together, or not at all.
+        # Nested blocks join the outermost one, which commits
+        with self.write():
+            self.depth += 1
+            try:
+                yield
+                if self.depth == 1:
+                    self.writer.commit()
+            except BaseException:
+                if self.depth == 1:
+                    self.writer.rollback()
+                raise
+            finally:
+                self.depth -= 1
+
+    def reader(self):
+        # a thread that is writing reads its own uncommitted changes
+        if self.holds_lock():
+            return self.current_writer()
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = open_connection(self.db_path, readonly=True)
+            self.local.conn = conn
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn
+
+    def close(self):
+        # every thread's reader and the writer
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers = []
+            self.local = threading.local()
+        with self.lock:
+            self.writer.close()
+
+
 class Database(object):
+    """
+    Reads run on the calling thread's read-only connection, writes on
+    the shared writer one thread at a time, so a Database can be used
+    from several threads (e.g. searches while embeddings are written)
+    """
     def __init__(self, db_path):
         self.db_path = db_path
-        self.conn = None
-        self._connect()
+        self.connections = ConnectionManager(db_path)
         # in case don't exist
         self._create_tables()
+        self.vectors = VectorStore(
+            self.connections.writer,
+            os.path.join(os.path.dirname(os.path.abspath(db_path)), "vectors"),
+            get_reader=self.connections.reader,
+            transaction=self.connections.transaction,
+        )
+        # embeddings written as per-row blobs by older versions
+        migrate_blobs(self.conn, self.vectors)
+
+    @property
+    def conn(self):
+        # the writer, for statements run directly. From more than one
+        # thread, only use it inside transaction()
+        return self.connections.current_writer()
 
-    def _connect(self):
-        self.conn = sqlite3.connect(self.db_path)
+    @property
+    def reader(self):
+        return self.connections.reader()
+
+    @contextmanager
+    def transaction(self):
+        # writes inside the block are committed together, or not at all
+        with self.connections.transaction():
+            yield self
+
+    def close(self):
+        self.vectors.close()
+        self.connections.close()
 
     def _create_tables(self):
         create_chunks_table(self.conn)
         create_dialogue_table(self.conn)
         create_embeddings_table(self.conn)
+        create_index_tables(self.conn)
+        create_text_tables(self.conn)
+        create_chunk_paths_table(self.conn)
+        # indexes and constraints added since, see chg.db.migrations
+        migrate(self.conn)
 
-    def run_query(self, stmt):
-        cursor = self.conn.cursor()
-        cursor.execute(stmt)
-        results = cursor.fetchall()
-        cursor.close()
-        return results
+    def run_query(self, stmt, params=(), readonly=False):
+        # readonly: run on this thread's reader, without waiting for writes
+        if readonly:
+            return run_query(self.reader, stmt, params)
+        with self.connections.write() as conn:
+            return run_query(conn, stmt, params)
 
-    def record_chunk(self, data):
+    def record_chunk(self, data, commit_date=None):
         # prehash, chunk, posthash = data
-        return insert_chunk(self.conn, data)
+        # commit_date: seconds since epoch
+        with self.connections.write() as conn:
+            return insert_chunk(conn, data, commit_date=commit_date)
+
+    def record_chunks_many(self, data, commit_dates=None):
+        # data: list of (prehash, chunk, posthash)
+        with self.connections.write() as conn:
+            return insert_chunks_many(conn, data, commit_dates=commit_dates)
 
     def record_dialogue(self, data):
-        chunk_id, answered_questions = data
+        return self.record_dialogue_many([data])[0]
+
+    def record_dialogue_many(self, data):
+        # data: list of (chunk_id, answered_questions)
+        rows = [
+            (question, answer, chunk_id)
+            for chunk_id, answered_questions in data
+            for question, answer in answered_questions
+        ]
+        with self.connections.write() as conn:
+            qa_ids = insert_answered_questions_many(conn, rows)
         ids = []
-        for (question, answer) in answered_questions:
-            qa_id = insert_answered_question(
-                self.conn, (question, answer, chunk_id)
-            )
-            ids.append(qa_id)
+        for _, answered_questions in data:
+            ids.append(qa_ids[:len(answered_questions)])
+            qa_ids = qa_ids[len(answered_questions):]
         return ids
 
     def array_to_blob(self, arr):
@@ -159,22 +998,151 @@ class Database(object):
     def blob_to_array(self, blob):
         return np.frombuffer(blob, dtype=np.float32)
 
-    def record_embeddings(self, data):
+    def record_embeddings(
+        self,
+        data,
+        dialogue_hash=None,
+        model=CHG_EMBED_MODEL,
+        policy=None,
+    ):
         chunk_id, code_embedding, nl_embedding = data
+        return self.record_embeddings_many(
+            [(chunk_id, code_embedding, nl_embedding, dialogue_hash)],
+            model=model,
+            policy=policy,
+        )[0]
+
+    def record_embeddings_many(self, data, model=CHG_EMBED_MODEL, policy=None):
+        # data: list of (chunk_id, code_embedding, nl_embedding, dialogue_hash)
+        # policy: token budget used to embed code
+        chunk_ids, code_embeddings, nl_embeddings, dialogue_hashes = zip(*data)
+        with self.connections.write() as conn:
+            rows = self.vectors.append({
+                "code": np.vstack(code_embeddings),
+                "nl": np.vstack(nl_embeddings),
+            })
+            return insert_embeddings_many(
+                conn,
+                list(
+                    zip(
+                        chunk_ids,
+                        dialogue_hashes,
+                        [model] * len(rows),
+                        [policy] * len(rows),
+                        rows,
+                    )
+                ),
+            )
+
+    def get_chunks_by_ids(self, ids):
+        # chunk_id -> chunk
+        return get_chunks_by_ids(self.reader, ids)
+
+    def get_diff_stats(self):
+        return get_diff_stats(self.reader)
 
-        code_blob = self.array_to_blob(code_embedding)
-        nl_blob = self.array_to_blob(nl_embedding)
-        return insert_embeddings(self.conn, (chunk_id, code_blob, nl_blob))
+    def get_embedding_states(self, model=CHG_EMBED_MODEL):
+        # chunk_id -> (hash of dialogue, token budget policy) when embedded
+        return get_embedding_states(self.reader, model)
 
-    def get_embeddings_by_chunk_id(self, _id):
-        row = get_embeddings_by_chunk_id(self.conn, _id)
-        code_blob, nl_blob = row[0]
-        code_embedding = self.blob_to_array(code_blob)
-        nl_embedding = self.blob_to_array(nl_blob)
+    def get_embedding_rows(self, model=CHG_EMBED_MODEL):
+        # (chunk_id, row in vector store, dialogue_hash, policy) by chunk
+        return get_embedding_rows(self.reader, model)
+
+    def get_embedding_rows_by_chunk_ids(self, chunk_ids, model=CHG_EMBED_MODEL):
+        # (chunk_id, row in vector store) for those of chunk_ids embedded
+        return get_embedding_rows_by_chunk_ids(self.reader, chunk_ids, model)
+
+    def get_embedding_matrix(self, field, model=CHG_EMBED_MODEL):
+        # chunk ids and their (copied) vectors for field in FIELDS
+        results = self.get_embedding_rows(model)
+        if len(results) == 0:
+            return [], None
+        chunk_ids = [r[0] for r in results]
+        return chunk_ids, self.vectors.get(field, [r[1] for r in results])
+
+    def search_text(self, match, k, chunk_ids=None):
+        # (chunk ids matching in code, in answers), best bm25 first
+        return search_text(self.reader, match, k, chunk_ids=chunk_ids)
+
+    def get_index_version(self, path):
+        # (model, version, n_vectors) of a search index, None if not built
+        return get_index_version(self.reader, path)
+
+    def get_index_params(self, path):
+        # (requested mode, json parameters) of a search index
+        return get_index_params(self.reader, path)
+
+    def get_indexed_chunks(self, path):
+        # chunk_id -> (dialogue_hash, policy) when added to search index
+        return get_indexed_chunks(self.reader, path)
+
+    def record_index_update(
+        self,
+        path,
+        model,
+        removed,
+        added,
+        n_vectors,
+        mode=None,
+        params=None,
+        rebuilt=False,
+    ):
+        with self.connections.write() as conn:
+            update_indexed_chunks(
+                conn,
+                path,
+                model,
+                removed,
+                added,
+                n_vectors,
+                mode=mode,
+                params=params,
+                rebuilt=rebuilt,
+            )
+
+    def get_embeddings_by_chunk_id(self, _id, model=CHG_EMBED_MODEL):
+        row = get_embeddings_by_chunk_id(self.reader, _id, model)[0][0]
+        code_embedding, nl_embedding = [
+            self.vectors.get(field, [row])[0] for field in FIELDS
+        ]
         return code_embedding, nl_embedding
 
     def get_dialogue_by_ids(self, ids):
-        return get_dialogue_by_ids(self.conn, ids)
+        return get_dialogue_by_ids(self.reader, ids)
+
+    def get_dialogue_by_chunk_ids(self, chunk_ids):
+        return get_dialogue_by_chunk_ids(self.reader, chunk_ids)
+
+    def get_search_results(self, chunk_ids, scores=None):
+        return get_search_results(self.reader, chunk_ids, scores=scores)
+
+    def get_chunks_missing_dates(self):
+        return get_chunks_missing_dates(self.reader)
+
+    def set_commit_dates(self, rows):
+        # rows: (commit_date, chunk_id)
+        with self.connections.write() as conn:
+            set_commit_dates(conn, rows)
+
+    def filter_chunk_ids(
+        self,
+        path_globs=None,
+        since=None,
+        until=None,
+        commits=None,
+    ):
+        return filter_chunk_ids(
+            self.reader,
+            path_globs=path_globs,
+            since=since,
+            until=until,
+            commits=commits,
+        )
+
+    def get_content_version(self):
+        # (max chunk id, max dialogue id, max embeddings id)
+        return get_content_version(self.reader)
 
 
 def get_store():
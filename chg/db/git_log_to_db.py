@@ -5,18 +5,34 @@ from chg.db.database import get_store
 
 import tqdm
 
+# commits written per transaction
+COMMITS_PER_TRANSACTION = 1000
 
-def log_to_db(store):
+
+def record_commits(store, pending):
+    # pending: (chunk row, commit date, answered questions)
+    with store.transaction():
+        chunk_ids = store.record_chunks_many(
+            [p[0] for p in pending],
+            commit_dates=[p[1] for p in pending],
+        )
+        store.record_dialogue_many(
+            [(chunk_id, p[2]) for chunk_id, p in zip(chunk_ids, pending)]
+        )
+
+
+def log_to_db(store, batch_size=COMMITS_PER_TRANSACTION):
     print("Git log to database")
     log_entries = git.log()
     # from oldest to newest
     log_entries = list(reversed(log_entries))
     n = len(log_entries)
+    pending = []
     for ix in tqdm.tqdm(list(range(1, n))):
         prev_commit = log_entries[ix - 1]
         curr_commit = log_entries[ix]
-        old_hash = prev_commit["abbreviated_commit"]
-        new_hash = curr_commit["abbreviated_commit"]
+        old_hash = prev_commit["commit"]
+        new_hash = curr_commit["commit"]
 
         chunk = git.diff_from_to(old_hash, new_hash)
 
@@ -26,8 +42,30 @@ def log_to_db(store):
 
         # TODO: include
         # code and dialogue embeddings
-        chunk_id = store.record_chunk((old_hash, chunk, new_hash))
-        store.record_dialogue((chunk_id, answered))
+        pending.append((
+            (old_hash, chunk, new_hash),
+            float(curr_commit["timestamp"]),
+            answered,
+        ))
+        if len(pending) == batch_size:
+            record_commits(store, pending)
+            pending = []
+    if len(pending) > 0:
+        record_commits(store, pending)
+
+
+def backfill_commit_dates(store):
+    # chunks recorded before commit dates were stored
+    missing = store.get_chunks_missing_dates()
+    print("Looking up commit dates for {} chunks".format(len(missing)))
+    rows = []
+    for chunk_id, posthash in tqdm.tqdm(missing):
+        commit_date = None
+        if posthash is not None:
+            commit_date = git.commit_timestamp(posthash)
+        if commit_date is not None:
+            rows.append((commit_date, chunk_id))
+    store.set_commit_dates(rows)
 
 
 def get_args():
@@ -35,13 +73,21 @@ def get_args():
         description="Record all git commits to chgstructor database",
         formatter_class=ArgumentDefaultsHelpFormatter
     )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Only add commit dates to chunks recorded without them",
+    )
     return parser.parse_args()
 
 
 def main():
-    _ = get_args()
+    args = get_args()
     store = get_store()
-    log_to_db(store)
+    if args.backfill:
+        backfill_commit_dates(store)
+    else:
+        log_to_db(store)
 
 
 if __name__ == "__main__":
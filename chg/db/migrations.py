@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+
+def create_schema_version_table(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS SchemaVersion (version INTEGER)"
+    )
+    conn.commit()
+    cursor.close()
+
+
+def get_schema_version(conn):
+    # 0 for databases created before versioning
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'SchemaVersion'"
+    )
+    if cursor.fetchone() is None:
+        cursor.close()
+        return 0
+    cursor.execute("SELECT MAX(version) FROM SchemaVersion")
+    version = cursor.fetchone()[0]
+    cursor.close()
+    return 0 if version is None else version
+
+
+def add_foreign_key_indexes(cursor):
+    # lookups by chunk (dialogue, ranker training, index updates)
+    # and by hash were full table scans
+    stmts = [
+        "CREATE INDEX IF NOT EXISTS DialogueChunkId ON Dialogue(chunk_id)",
+        "CREATE INDEX IF NOT EXISTS ChunksPrehash ON Chunks(prehash)",
+        "CREATE INDEX IF NOT EXISTS EmbeddingsDialogueHash "
+        "ON Embeddings(dialogue_hash)",
+        "CREATE INDEX IF NOT EXISTS IndexedChunksChunkId "
+        "ON IndexedChunks(chunk_id)",
+    ]
+    for stmt in stmts:
+        cursor.execute(stmt)
+
+
+def unique_embeddings(cursor):
+    # one embedding per chunk and model: keep the most recent duplicate
+    # (vector store rows no longer referenced are dropped by compact)
+    cursor.execute(
+        """
+        DELETE FROM Embeddings WHERE id NOT IN (
+            SELECT MAX(id) FROM Embeddings GROUP BY chunk_id, model
+        )
+        """
+    )
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS EmbeddingsChunkModel "
+        "ON Embeddings(chunk_id, model)"
+    )
+
+
+def compress_diffs(cursor, batch_size=1000):
+    # move diff text out of Chunks.chunk into Diffs, compressed and stored
+    # once per distinct text. Batches are committed as they go so a large
+    # store doesn't hold one huge transaction, and an interrupted run
+    # resumes where it stopped
+    from chg.db.database import (
+        add_column_if_missing,
+        create_diffs_table,
+        insert_diffs,
+    )
+    conn = cursor.connection
+    create_diffs_table(conn)
+    add_column_if_missing(conn, "Chunks", "diff_hash", "TEXT")
+    while True:
+        cursor.execute(
+            "SELECT id, chunk FROM Chunks WHERE chunk IS NOT NULL "
+            "ORDER BY id LIMIT ?",
+            (batch_size, ),
+        )
+        rows = cursor.fetchall()
+        if len(rows) == 0:
+            break
+        hashes = insert_diffs(cursor, [chunk for _, chunk in rows])
+        cursor.executemany(
+            "UPDATE Chunks SET diff_hash = ?, chunk = NULL WHERE id = ?",
+            [(h, chunk_id) for h, (chunk_id, _) in zip(hashes, rows)],
+        )
+        conn.commit()
+
+
+# forward migrations, MIGRATIONS[i] takes the schema from version i to i + 1.
+# Only ever append, and keep each one safe to re-run
+MIGRATIONS = [
+    add_foreign_key_indexes,
+    unique_embeddings,
+    compress_diffs,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    # apply migrations newer than the database's version, each committed
+    # along with its version number. Returns the versions applied
+    create_schema_version_table(conn)
+    version = get_schema_version(conn)
+    applied = []
+    for ix in range(version, len(migrations)):
+        cursor = conn.cursor()
+        try:
+            migrations[ix](cursor)
+            cursor.execute("DELETE FROM SchemaVersion")
+            cursor.execute(
+                "INSERT INTO SchemaVersion(version) VALUES(?)",
+                (ix + 1, ),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        applied.append(ix + 1)
+    return applied
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Show or upgrade the schema version of chg's database",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--db",
+        type=str,
+        help="Database path (default: this repository's)",
+    )
+    parser.add_argument(
+        "--vacuum",
+        action="store_true",
+        help="Rebuild the file afterwards so freed pages are returned",
+    )
+    return parser.parse_args()
+
+
+def main():
+    import os
+    from chg.db.database import Database
+    from chg.defaults import CHG_PROJ_DB_PATH
+    args = get_args()
+    db_path = CHG_PROJ_DB_PATH if args.db is None else args.db
+    size_before = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+    # opening the database applies any pending migrations
+    store = Database(db_path)
+    if args.vacuum:
+        store.conn.execute("VACUUM")
+    # checkpoint so the size below includes the write-ahead log's changes
+    store.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    size_after = os.path.getsize(db_path)
+    print("Schema version {} (latest {})".format(
+        get_schema_version(store.conn), SCHEMA_VERSION))
+    n_chunks, n_diffs, raw, compressed = store.get_diff_stats()
+    print("Diffs: {} chunks, {} distinct, {:.1f} MB raw, {:.1f} MB stored".format(
+        n_chunks, n_diffs, raw / 1e6, compressed / 1e6))
+    print("Database file: {:.1f} MB before, {:.1f} MB after".format(
+        size_before / 1e6, size_after / 1e6))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as err:
+        import pdb
+        pdb.post_mortem()
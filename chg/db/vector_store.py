@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import os
+
+import numpy as np
+
+# each chunk's embeddings are in the same row of every field's matrix
+FIELDS = ["code", "nl"]
+
+
+def create_vector_files_table(conn):
+    stmt = """
+    CREATE TABLE IF NOT EXISTS VectorFiles (
+        field TEXT PRIMARY KEY,
+        dim INTEGER,
+        n_rows INTEGER,
+        generation INTEGER
+    )
+    """
+    cursor = conn.cursor()
+    cursor.execute(stmt)
+    conn.commit()
+    cursor.close()
+
+
+class VectorStore(object):
+    """
+    Append-only float32 matrices on disk (one per field), memory-mapped
+    for reads. Embeddings.row maps chunks to rows, and VectorFiles
+    records how many rows are committed, so a crash mid-append
+    leaves nothing visible. get_reader returns the connection to read
+    VectorFiles on (the calling thread's), conn is used to write and
+    transaction, if given, returns a context manager that holds conn
+    for this thread and commits it at the end. Files are only truncated
+    or removed while holding sqlite's write lock, so another writer's
+    appended but not yet committed rows are never cut off.
+    """
+    def __init__(self, conn, directory, get_reader=None, transaction=None):
+        self.conn = conn
+        self.get_reader = get_reader
+        self.transaction = transaction
+        self.directory = directory
+        self.maps = {}
+        create_vector_files_table(conn)
+
+    def info(self, conn=None):
+        # (dim, n_rows, generation)
+        if conn is None:
+            conn = self.conn if self.get_reader is None else self.get_reader()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT dim, n_rows, generation FROM VectorFiles WHERE field = ?",
+            (FIELDS[0], ),
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        if row is None:
+            return None, 0, 0
+        return row
+
+    def path(self, field, generation=None):
+        if generation is None:
+            generation = self.info()[2]
+        return os.path.join(
+            self.directory, "{}.{}.f32".format(field, generation)
+        )
+
+    def _lock(self):
+        # sqlite's write lock, held until the caller's commit. A write
+        # already in the open transaction means this connection holds it
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+        # re-read under the lock, including this transaction's appends
+        return self.info(self.conn)
+
+    def _drop_other_generations(self, generation):
+        # files from an older generation left by compaction, or from
+        # a compaction that never committed. Call with the lock held
+        if not os.path.exists(self.directory):
+            return
+        current = set(
+            os.path.basename(self.path(f, generation)) for f in FIELDS
+        )
+        for name in os.listdir(self.directory):
+            if name.endswith(".f32") and name not in current:
+                os.remove(os.path.join(self.directory, name))
+
+    def _truncate(self, path, size):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _write(self, path, mat):
+        with open(path, "ab") as f:
+            f.write(np.ascontiguousarray(mat, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, mats):
+        # mats: field -> matrix, same number of rows for every field
+        # returns row ids, the caller commits them along with Embeddings
+        dim, n_rows, generation = self._lock()
+        n_new = len(mats[FIELDS[0]])
+        new_dim = mats[FIELDS[0]].shape[1]
+        if dim is not None and dim != new_dim:
+            raise ValueError("Vector dimension mismatch", dim, new_dim)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        for field in FIELDS:
+            assert len(mats[field]) == n_new
+            path = self.path(field, generation)
+            # drop leftovers from an append whose transaction rolled back
+            self._truncate(path, n_rows * new_dim * 4)
+            self._write(path, mats[field])
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            """
+            INSERT OR REPLACE INTO VectorFiles(field, dim, n_rows, generation)
+            VALUES(?, ?, ?, ?)
+            """,
+            [(f, new_dim, n_rows + n_new, generation) for f in FIELDS],
+        )
+        cursor.close()
+        return list(range(n_rows, n_rows + n_new))
+
+    def matrix(self, field):
+        # read-only, zero-copy view of committed rows
+        try:
+            return self._matrix(field)
+        except FileNotFoundError:
+            # generation removed by a compaction committed since info()
+            return self._matrix(field)
+
+    def _matrix(self, field):
+        dim, n_rows, generation = self.info()
+        if dim is None or n_rows == 0:
+            return np.zeros((0, 0 if dim is None else dim), dtype=np.float32)
+        key = (field, n_rows, generation)
+        if key not in self.maps:
+            self.maps = {
+                k: v for k, v in self.maps.items() if k[0] != field
+            }
+            self.maps[key] = np.memmap(
+                self.path(field, generation),
+                dtype=np.float32,
+                mode="r",
+                shape=(n_rows, dim),
+            )
+        return self.maps[key]
+
+    def close(self):
+        # unmapped once views returned by matrix() are released too
+        self.maps = {}
+
+    def get(self, field, rows):
+        return np.array(self.matrix(field)[np.asarray(rows, dtype=np.int64)])
+
+    def _transaction(self):
+        if self.transaction is not None:
+            return self.transaction()
+        # commits, or rolls back on error
+        return self.conn
+
+    def compact(self):
+        # rewrite matrices with only the rows still referenced.
+        # Other threads' writes on conn wait until this one commits
+        with self._transaction():
+            dim, n_rows, generation = self._lock()
+            if dim is None:
+                return 0, 0
+            self._drop_other_generations(generation)
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT id, row FROM Embeddings WHERE row IS NOT NULL "
+                "ORDER BY row"
+            )
+            live = cursor.fetchall()
+            old_rows = [row for _, row in live]
+            new_generation = generation + 1
+            for field in FIELDS:
+                path = self.path(field, new_generation)
+                if os.path.exists(path):
+                    os.remove(path)
+                mat = self.matrix(field)
+                for start in range(0, len(old_rows), 10000):
+                    self._write(path, mat[old_rows[start:(start + 10000)]])
+            cursor.executemany(
+                "UPDATE Embeddings SET row = ? WHERE id = ?",
+                [(new_row, _id) for new_row, (_id, _) in enumerate(live)],
+            )
+            cursor.executemany(
+                """
+                UPDATE VectorFiles SET n_rows = ?, generation = ?
+                WHERE field = ?
+                """,
+                [(len(live), new_generation, f) for f in FIELDS],
+            )
+            cursor.close()
+        self.maps = {}
+        # no longer referenced, and writers now append to the new one.
+        # Readers that already mapped it keep their view
+        for field in FIELDS:
+            os.remove(self.path(field, generation))
+        return n_rows, len(live)
+
+
+def migrate_blobs(conn, vectors, batch_size=10000):
+    # move embeddings stored as per-row BLOBs into the vector store
+    cursor = conn.cursor()
+    while True:
+        cursor.execute(
+            """
+            SELECT id, code_embedding, nl_embedding FROM Embeddings
+            WHERE row IS NULL AND code_embedding IS NOT NULL LIMIT ?
+            """,
+            (batch_size, ),
+        )
+        results = cursor.fetchall()
+        if len(results) == 0:
+            break
+        mats = {
+            "code": np.vstack([
+                np.frombuffer(r[1], dtype=np.float32) for r in results
+            ]),
+            "nl": np.vstack([
+                np.frombuffer(r[2], dtype=np.float32) for r in results
+            ]),
+        }
+        rows = vectors.append(mats)
+        cursor.executemany(
+            """
+            UPDATE Embeddings
+            SET row = ?, code_embedding = NULL, nl_embedding = NULL
+            WHERE id = ?
+            """,
+            [(row, r[0]) for row, r in zip(rows, results)],
+        )
+        conn.commit()
+    cursor.close()
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Maintain chg's on-disk embedding matrices",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "action",
+        type=str,
+        choices=["stats", "compact"],
+        help="Report row counts, or drop rows no longer referenced",
+    )
+    return parser.parse_args()
+
+
+def main():
+    # avoid circular import at module level
+    from chg.db.database import get_store
+    args = get_args()
+    store = get_store()
+    dim, n_rows, _ = store.vectors.info()
+    live = store.run_query(
+        "SELECT COUNT(*) FROM Embeddings WHERE row IS NOT NULL"
+    )[0][0]
+    if args.action == "stats":
+        print(
+            "dim={} rows={} referenced={} ({:.1f} MB per field)".format(
+                dim, n_rows, live, n_rows * (dim or 0) * 4 / 1e6
+            )
+        )
+    elif args.action == "compact":
+        before, after = store.vectors.compact()
+        print("Compacted {} rows to {}".format(before, after))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as err:
+        import pdb
+        pdb.post_mortem()
@@ -15,12 +15,26 @@ CHG_PROJ_DB_PATH = chg_path("db.sqlite3")
 # for semantic search
 CHG_PROJ_FAISS = chg_path("faiss.db")
 CHG_PROJ_RANKER = chg_path("ranker.pkl")
+CHG_PROJ_EMBED_CACHE = chg_path("embed_cache.sqlite3")
+# ONNX exports, one per model and opset
+CHG_PROJ_ONNX_DIR = chg_path("onnx")
+CHG_PROJ_EMBED_SOCKET = chg_path("embed.sock")
+CHG_PROJ_RESULT_CACHE = chg_path("result_cache.sqlite3")
+CHG_PROJ_SEARCH_SOCKET = chg_path("search.sock")
+
+# model whose (full precision) embeddings are indexed by default
+CHG_EMBED_MODEL = "microsoft/codebert-base"
 
 VARS = {
     "CHG_PROJ_DIR": CHG_PROJ_DIR,
     "CHG_PROJ_DB_PATH": CHG_PROJ_DB_PATH,
     "CHG_PROJ_FAISS": CHG_PROJ_FAISS,
     "CHG_PROJ_RANKER": CHG_PROJ_RANKER,
+    "CHG_PROJ_EMBED_CACHE": CHG_PROJ_EMBED_CACHE,
+    "CHG_PROJ_ONNX_DIR": CHG_PROJ_ONNX_DIR,
+    "CHG_PROJ_EMBED_SOCKET": CHG_PROJ_EMBED_SOCKET,
+    "CHG_PROJ_RESULT_CACHE": CHG_PROJ_RESULT_CACHE,
+    "CHG_PROJ_SEARCH_SOCKET": CHG_PROJ_SEARCH_SOCKET,
 }
 
 
@@ -1,130 +1,331 @@
 #!/usr/bin/env python3
 
-from argparse import ArgumentParser
+from collections import OrderedDict
 import os
-import subprocess
+import re
 
 import numpy as np
-from transformers import RobertaTokenizer, RobertaModel
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+from transformers import (
+    RobertaConfig,
+    RobertaModel,
+    RobertaTokenizer,
+    RobertaTokenizerFast,
+)
 import torch
-import tqdm
 
-from chg.db.database import get_store
+from chg.defaults import CHG_EMBED_MODEL, CHG_PROJ_ONNX_DIR
+from chg.embed.cache import normalize_text
+from chg.embed.utils import (
+    BACKENDS,
+    get_model_id,
+    merge_dialogue,
+    normalize_vectors,
+    remove_color_ascii,
+)
 
 # fix odd fault...
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
 
+ONNX_OPSET = 14
 
-def remove_color_ascii(msg):
-    proc = subprocess.Popen(
-        "sed 's/\x1b\[[0-9;]*m//g'",
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        shell=True,
+
+def token_windows(tokenizer, tokens, max_len):
+    # split up tokens into windows according to max_len
+    chunk_len = max_len - 4
+    windows = []
+    # empty text still gets a (cls, sep) window
+    for i in range(0, max(len(tokens), 1), chunk_len):
+        chunk = [tokenizer.cls_token]
+        chunk.extend(tokens[i:(i + chunk_len)])
+        chunk.append(tokenizer.sep_token)
+        windows.append(tokenizer.convert_tokens_to_ids(chunk))
+    return windows
+
+
+def batch_windows(tokenizer, txts, max_len):
+    # same windows as token_windows, tokenized and split natively
+    # in one call (requires a fast tokenizer)
+    encoded = tokenizer(
+        txts,
+        max_length=max_len - 2,
+        truncation=True,
+        return_overflowing_tokens=True,
     )
-    output, _ = proc.communicate(msg.encode())
-    return output.decode().strip()
+    return encoded["input_ids"], encoded["overflow_to_sample_mapping"]
+
 
+class HiddenStates(torch.nn.Module):
+    # last hidden state only, with keyword inputs, for ONNX export
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
 
-def normalize_vectors(mat):
-    # make vectors unit norm
-    norm = np.sqrt(np.sum(mat**2, axis=1))
-    # set to 1.0 to avoid nan
-    norm[norm == 0] = 1.0
-    norm_mat = mat / norm.reshape(-1, 1)
-    return norm_mat
+    def forward(self, input_ids, attention_mask):
+        return self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+        )[0]
+
+
+def get_onnx_path(model_name=CHG_EMBED_MODEL, opset=ONNX_OPSET):
+    # keyed by model and opset, so changing either never reuses an export
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+    return os.path.join(
+        CHG_PROJ_ONNX_DIR, "{}.opset{}.onnx".format(name, opset)
+    )
+
+
+def load_model():
+    model = RobertaModel.from_pretrained(CHG_EMBED_MODEL)
+    # no dropout, so embeddings are deterministic
+    return model.to("cpu").eval()
+
+
+def export_onnx(model, path, opset=ONNX_OPSET):
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    input_ids = torch.ones((1, 8), dtype=torch.long)
+    attention_mask = torch.ones((1, 8), dtype=torch.long)
+    dynamic_axes = {
+        "input_ids": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "sequence"},
+        "last_hidden_state": {0: "batch", 1: "sequence"},
+    }
+    # written under a temporary name, so an interrupted export isn't used
+    tmp_path = path + ".tmp"
+    # torchscript exporter: dynamic_axes isn't supported by the dynamo one
+    torch.onnx.export(
+        HiddenStates(model),
+        (input_ids, attention_mask),
+        tmp_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["last_hidden_state"],
+        dynamic_axes=dynamic_axes,
+        opset_version=opset,
+        dynamo=False,
+    )
+    os.replace(tmp_path, path)
 
 
 class BasicEmbedder(object):
-    def __init__(self):
-        self.tokenizer = RobertaTokenizer.from_pretrained(
-            "microsoft/codebert-base"
+    def __init__(
+        self,
+        batch_size=8,
+        cache=None,
+        backend="torch",
+        budget=None,
+        fast_tokenizer=True,
+        model=None,
+        tokenizer=None,
+    ):
+        # model, tokenizer: used instead of CodeBERT's (e.g. stand-ins
+        # for offline benchmarks), torch backends only
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend:", backend)
+        if model is not None and backend == "onnx":
+            raise ValueError("onnx backend only exports CodeBERT")
+        self.backend = backend
+        self.model_id = get_model_id(backend)
+        # fast (rust) tokenizer can split batches into windows natively
+        self.fast_tokenizer = fast_tokenizer
+        if tokenizer is not None:
+            self.tokenizer = tokenizer
+        elif fast_tokenizer:
+            self.tokenizer = RobertaTokenizerFast.from_pretrained(
+                CHG_EMBED_MODEL
+            )
+        else:
+            self.tokenizer = RobertaTokenizer.from_pretrained(CHG_EMBED_MODEL)
+        if model is None:
+            config = RobertaConfig.from_pretrained(CHG_EMBED_MODEL)
+        else:
+            config = model.config
+        self.max_len = config.max_position_embeddings
+        self.hidden_size = config.hidden_size
+        # number of windows per forward pass
+        self.batch_size = batch_size
+        # optional EmbeddingCache for natural language
+        self.cache = cache
+        # optional TokenBudget bounding cost of embedding code
+        self.budget = budget
+        self.policy = "full" if budget is None else budget.describe()
+        self.model = None
+        self.session = None
+        if backend == "onnx":
+            if onnxruntime is None:
+                raise Exception("onnx backend requires onnxruntime")
+            # torch weights are only loaded to export, once per model
+            onnx_path = get_onnx_path()
+            if not os.path.exists(onnx_path):
+                print("Exporting CodeBERT to ONNX at", onnx_path)
+                export_onnx(load_model(), onnx_path)
+            self.session = onnxruntime.InferenceSession(
+                onnx_path,
+                providers=["CPUExecutionProvider"],
+            )
+        else:
+            self.model = load_model() if model is None else model.eval()
+        if backend == "torch-int8":
+            # int8 weights for linear layers, activations quantized on the fly
+            self.model = torch.quantization.quantize_dynamic(
+                self.model,
+                {torch.nn.Linear},
+                dtype=torch.qint8,
+            )
+
+    def forward_(self, input_ids, attention_mask):
+        # last hidden state for a padded batch of windows
+        if self.session is not None:
+            return self.session.run(
+                ["last_hidden_state"],
+                {
+                    "input_ids": input_ids.numpy(),
+                    "attention_mask": attention_mask.numpy(),
+                },
+            )[0]
+        with torch.inference_mode():
+            output = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+            )[0]
+        return output.numpy()
+
+    def windows_(self, txt, budget=None):
+        if budget is None:
+            tokens = self.tokenizer.tokenize(txt)
+        else:
+            # only tokenizes as much as budget allows
+            tokens = budget.select_tokens(self.tokenizer.tokenize, txt)
+        return token_windows(self.tokenizer, tokens, self.max_len)
+
+    def batch_windows_(self, txts):
+        return batch_windows(self.tokenizer, txts, self.max_len)
+
+    def pad_(self, windows):
+        max_len = max(len(w) for w in windows)
+        input_ids = torch.full(
+            (len(windows), max_len),
+            self.tokenizer.pad_token_id,
+            dtype=torch.long,
         )
-        self.model = RobertaModel.from_pretrained("microsoft/codebert-base")
-        self.model = self.model.to("cpu")
-        # self.model = self.model.eval()
-        self.max_len = self.model.config.max_position_embeddings
+        attention_mask = torch.zeros((len(windows), max_len), dtype=torch.long)
+        for i, w in enumerate(windows):
+            input_ids[i, :len(w)] = torch.tensor(w, dtype=torch.long)
+            attention_mask[i, :len(w)] = 1
+        return input_ids, attention_mask
 
-    def embed_(self, txt):
-        tokens = [self.tokenizer.cls_token]
-        tokens = self.tokenizer.tokenize(txt)
-
-        # split up chunks according to max_len
-        embeddings = []
-        chunk_len = self.max_len - 4
-        for i in tqdm.tqdm(list(range(0, len(tokens), chunk_len))):
-            chunk = [self.tokenizer.cls_token]
-            chunk.extend(tokens[i:(i + chunk_len)])
-            chunk.append(self.tokenizer.sep_token)
-            chunk_token_ids = self.tokenizer.convert_tokens_to_ids(chunk)
-            with torch.no_grad():
-                chunk_embedding = self.model(
-                    torch.tensor(chunk_token_ids)[None, :]
-                )[0]
-                # average over tokens
-                chunk_embedding = chunk_embedding.mean(dim=1)
-                embeddings.append(chunk_embedding)
-        embeddings = torch.stack(embeddings)
-        # average over chunks
-        txt_embedding = embeddings.mean(dim=0)
-        txt_embedding = txt_embedding.numpy()
+    def embed_windows_(self, windows):
+        # sort by length so batches need little padding
+        order = sorted(range(len(windows)), key=lambda i: len(windows[i]))
+        embeddings = np.zeros((len(windows), self.hidden_size),
+                              dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            batch_ixs = order[start:(start + self.batch_size)]
+            input_ids, attention_mask = self.pad_(
+                [windows[i] for i in batch_ixs]
+            )
+            output = self.forward_(input_ids, attention_mask)
+            # average over (non-padding) tokens
+            mask = attention_mask.numpy()[:, :, None].astype(output.dtype)
+            pooled = (output * mask).sum(axis=1) / mask.sum(axis=1)
+            embeddings[batch_ixs] = pooled
+        return embeddings
+
+    def embed_batch_(self, txts, budget=None):
+        if len(txts) == 0:
+            return np.zeros((0, self.hidden_size), dtype=np.float32)
+        # pack windows from all texts into shared batches
+        windows = []
+        owners = []
+        if self.fast_tokenizer:
+            # texts that don't need a budget are split up in one batch
+            native = [
+                ix for ix, txt in enumerate(txts)
+                if budget is None or budget.fits(txt)
+            ]
+        else:
+            native = []
+        if len(native) > 0:
+            native_windows, mapping = self.batch_windows_(
+                [txts[ix] for ix in native]
+            )
+            windows.extend(native_windows)
+            owners.extend(native[i] for i in mapping)
+        native = set(native)
+        for ix, txt in enumerate(txts):
+            if ix in native:
+                continue
+            txt_windows = self.windows_(txt, budget=budget)
+            windows.extend(txt_windows)
+            owners.extend([ix] * len(txt_windows))
+        window_embeddings = self.embed_windows_(windows)
+        # average over windows of each text
+        owners = np.array(owners)
+        txt_embeddings = np.zeros((len(txts), self.hidden_size),
+                                  dtype=np.float32)
+        np.add.at(txt_embeddings, owners, window_embeddings)
+        counts = np.bincount(owners, minlength=len(txts))
+        txt_embeddings /= counts.reshape(-1, 1)
         # unit norm
-        txt_embedding = normalize_vectors(txt_embedding)
-        txt_embedding = txt_embedding.flatten()
-        return txt_embedding
+        return normalize_vectors(txt_embeddings)
+
+    def embed_(self, txt):
+        return self.embed_batch_([txt])[0]
 
     def embed_code(self, code):
-        return self.embed_(remove_color_ascii(code))
+        return self.embed_code_batch([code])[0]
 
     def embed_nl(self, nl):
-        return self.embed_(nl)
+        return self.embed_nl_batch([nl])[0]
 
     def embed_dialogue(self, question_and_answers):
-        # empty history
-        if len(question_and_answers) == 0:
-            question_and_answers = [("", "")]
-        merged_dialogue = "\n".join(
-            "{}:{}".format(q, a) for q, a in question_and_answers
-        )
-        return self.embed_nl(merged_dialogue)
-
-
-def get_args():
-    parser = ArgumentParser(description="Embed chg database")
-    return parser.parse_args()
+        return self.embed_dialogue_batch([question_and_answers])[0]
 
+    def embed_code_batch(self, codes):
+        return self.embed_batch_(
+            [remove_color_ascii(c) for c in codes],
+            budget=self.budget,
+        )
 
-def main():
-    _ = get_args()
-    embedder = BasicEmbedder()
-    store = get_store()
+    def embed_nl_batch(self, nls, use_cache=True):
+        if not use_cache or self.cache is None or len(nls) == 0:
+            return self.embed_batch_(nls)
+        results = self.cache.get_many(self.model_id, nls)
+        # only embed strings not already cached, once per normalized text
+        missing = OrderedDict()
+        for nl, r in zip(nls, results):
+            if r is None:
+                missing.setdefault(normalize_text(nl), nl)
+        if len(missing) > 0:
+            missing_nls = list(missing.values())
+            embedded = self.embed_batch_(missing_nls)
+            self.cache.put_many(self.model_id, missing_nls, embedded)
+            embedded = dict(zip(missing.keys(), embedded))
+            results = [
+                embedded[normalize_text(nl)] if r is None else r
+                for nl, r in zip(nls, results)
+            ]
+        return np.vstack(results)
 
-    # need to embed every chunk
-    chunk_ids = store.run_query(
-        "SELECT id FROM Chunks WHERE chunk IS NOT NULL"
-    )
-    chunk_ids = [row[0] for row in chunk_ids]
-    print("Embedding code and dialogue for {} chunks".format(len(chunk_ids)))
-    for chunk_id in tqdm.tqdm(chunk_ids):
-        chunk = store.run_query(
-            "SELECT chunk FROM Chunks WHERE id={}".format(chunk_id)
-        )
-        assert len(chunk) == 1, "Chunks should be uniquely identified"
-        chunk = chunk[0]
-        code_embedding = embedder.embed_code(chunk[0])
-        # embed dialogue associated with this chunk
-        dialogue = store.run_query(
-            "SELECT question, answer FROM Dialogue WHERE chunk_id={} ORDER BY id"
-            .format(chunk_id)
+    def embed_dialogue_batch(self, dialogues):
+        # not cached: each dialogue is embedded about once, and would
+        # evict the short, repeated queries the cache is for
+        return self.embed_nl_batch(
+            [merge_dialogue(d) for d in dialogues],
+            use_cache=False,
         )
-        assert len(dialogue) >= 1, "Should have at least one commit message"
-        nl_embedding = embedder.embed_dialogue(dialogue)
-        store.record_embeddings((chunk_id, code_embedding, nl_embedding))
 
 
 if __name__ == "__main__":
+    # embedding the database is done by chg.embed.pipeline
+    from chg.embed import pipeline
     try:
-        main()
+        pipeline.main()
     except Exception as err:
         import pdb
         pdb.post_mortem()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import time
+
+from transformers import RobertaConfig, RobertaTokenizer, RobertaTokenizerFast
+
+from chg.db.database import CHUNK_TEXT_SQL, JOIN_DIFFS_SQL, get_store
+from chg.defaults import CHG_EMBED_MODEL
+from chg.embed.basic import batch_windows, token_windows
+from chg.embed.utils import remove_color_ascii
+
+
+def sample_diffs(store, n):
+    rows = store.run_query(
+        "SELECT {} FROM Chunks {} "
+        "WHERE chunk IS NOT NULL OR diff_hash IS NOT NULL "
+        "ORDER BY RANDOM() LIMIT ?".format(CHUNK_TEXT_SQL, JOIN_DIFFS_SQL),
+        (n, ),
+    )
+    return [remove_color_ascii(row[0]) for row in rows]
+
+
+def slow_path(tokenizer, diffs, max_len):
+    # one string at a time: tokenize, then convert tokens to ids
+    return [
+        token_windows(tokenizer, tokenizer.tokenize(d), max_len)
+        for d in diffs
+    ]
+
+
+def fast_path(tokenizer, diffs, max_len, batch_size):
+    windows = [[] for _ in diffs]
+    for start in range(0, len(diffs), batch_size):
+        batch = diffs[start:(start + batch_size)]
+        ids, mapping = batch_windows(tokenizer, batch, max_len)
+        for window, i in zip(ids, mapping):
+            windows[start + i].append(window)
+    return windows
+
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return result, time.time() - start
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Benchmark tokenizing diffs from Chunks: slow vs fast",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--n",
+        type=int,
+        help="Number of diffs to sample",
+        default=500,
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Diffs per fast tokenizer call",
+        default=64,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    diffs = sample_diffs(get_store(), args.n)
+    if len(diffs) == 0:
+        print("No diffs in Chunks to benchmark")
+        return
+    max_len = RobertaConfig.from_pretrained(
+        CHG_EMBED_MODEL
+    ).max_position_embeddings
+    slow_tokenizer = RobertaTokenizer.from_pretrained(CHG_EMBED_MODEL)
+    fast_tokenizer = RobertaTokenizerFast.from_pretrained(CHG_EMBED_MODEL)
+
+    slow_windows, slow_time = timed(slow_path, slow_tokenizer, diffs, max_len)
+    fast_windows, fast_time = timed(
+        fast_path, fast_tokenizer, diffs, max_len, args.batch_size
+    )
+
+    n_bytes = sum(len(d.encode()) for d in diffs)
+    n_windows = sum(len(w) for w in slow_windows)
+    same = sum(s == f for s, f in zip(slow_windows, fast_windows))
+    print(
+        "{} diffs, {:.1f} MB, {} windows".format(
+            len(diffs), n_bytes / 1e6, n_windows
+        )
+    )
+    print("slow: {:.3f}s".format(slow_time))
+    print(
+        "fast: {:.3f}s ({:.1f}x)".format(
+            fast_time, slow_time / max(fast_time, 1e-9)
+        )
+    )
+    print("identical windows: {}/{}".format(same, len(diffs)))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as err:
+        import pdb
+        pdb.post_mortem()
@@ -0,0 +1,199 @@
+import fnmatch
+import math
+
+from chg.platform.git import DIFF_HEADER_REGEX
+
+# lockfiles, vendored and generated code: expensive to embed, little signal
+GENERATED_PATTERNS = [
+    "*.lock",
+    "*-lock.json",
+    "*-lock.yaml",
+    "go.sum",
+    "*.min.js",
+    "*.min.css",
+    "*.map",
+    "*_pb2.py",
+    "*.pb.go",
+    "*.generated.*",
+    "vendor/*",
+    "*/vendor/*",
+    "third_party/*",
+    "*/third_party/*",
+    "node_modules/*",
+    "*/node_modules/*",
+    "dist/*",
+]
+
+POLICIES = ["head", "tail", "head-tail", "strided"]
+
+BINARY_MARKERS = ("Binary files ", "GIT binary patch")
+
+# lines per block sampled by the strided policy
+STRIDE_BLOCK_LINES = 8
+
+
+def split_diff_by_file(diff):
+    # (path, text) for each file in a diff, path is None if no header
+    path = None
+    lines = []
+    for line in diff.split("\n"):
+        match = DIFF_HEADER_REGEX.match(line)
+        if match is not None:
+            if len(lines) > 0:
+                yield path, "\n".join(lines)
+            path = match.group(2)
+            lines = []
+        lines.append(line)
+    if len(lines) > 0:
+        yield path, "\n".join(lines)
+
+
+def is_binary(text):
+    return any(marker in text for marker in BINARY_MARKERS)
+
+
+class TokenBudget(object):
+    """
+    Bounds the number of tokens embedded for a (code) chunk
+    """
+    def __init__(
+        self,
+        max_tokens=8192,
+        file_tokens=2048,
+        policy="head-tail",
+        skip_generated=True,
+    ):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy:", policy)
+        self.max_tokens = max_tokens
+        self.file_tokens = file_tokens
+        self.policy = policy
+        self.skip_generated = skip_generated
+
+    def describe(self):
+        # recorded with each embedding
+        return "{};max={};file={};skip_generated={}".format(
+            self.policy,
+            self.max_tokens,
+            self.file_tokens,
+            self.skip_generated,
+        )
+
+    def fits(self, diff):
+        # whole diff is within budget, so selecting tokens is a no-op
+        # (every token covers at least one byte)
+        limit = min(self.max_tokens, self.file_tokens)
+        if len(diff.encode()) > limit:
+            return False
+        return not any(
+            self.should_skip(path, text)
+            for path, text in split_diff_by_file(diff)
+        )
+
+    def should_skip(self, path, text):
+        if is_binary(text):
+            return True
+        if not self.skip_generated or path is None:
+            return False
+        return any(fnmatch.fnmatch(path, p) for p in GENERATED_PATTERNS)
+
+    def take_head(self, tokenize, lines, limit):
+        # tokenize line by line, stop as soon as limit is reached.
+        # Returns all tokens of the lines used, and how many lines
+        tokens = []
+        n_lines = 0
+        for line in lines:
+            if len(tokens) >= limit:
+                break
+            tokens.extend(tokenize(line + "\n"))
+            n_lines += 1
+        return tokens, n_lines
+
+    def take_lines(self, tokenize, lines, limit):
+        return self.take_head(tokenize, lines, limit)[0][:limit]
+
+    def take_tail(self, tokenize, lines, limit):
+        # tokenize line by line from the end, stop once limit is reached
+        tail_lines = []
+        count = 0
+        for line in reversed(lines):
+            if count >= limit:
+                break
+            line_tokens = tokenize(line + "\n")
+            tail_lines.append(line_tokens)
+            count += len(line_tokens)
+        tokens = []
+        for line_tokens in reversed(tail_lines):
+            tokens.extend(line_tokens)
+        return tokens[max(len(tokens) - limit, 0):]
+
+    def take_strided(self, tokenize, lines, limit):
+        # evenly spaced blocks of lines across the text,
+        # stride estimated from the token density of the first block
+        tokens = self.take_lines(
+            tokenize, lines[:STRIDE_BLOCK_LINES], limit
+        )
+        tokens_per_block = max(len(tokens), 1)
+        n_blocks = math.ceil(len(lines) / STRIDE_BLOCK_LINES)
+        stride = max(1, math.ceil(n_blocks * tokens_per_block / limit))
+        block_start = STRIDE_BLOCK_LINES * stride
+        for start in range(block_start, len(lines), block_start):
+            if len(tokens) >= limit:
+                break
+            block = lines[start:(start + STRIDE_BLOCK_LINES)]
+            tokens.extend(self.take_lines(tokenize, block, limit - len(tokens)))
+        return tokens[:limit]
+
+    def select(self, tokenize, text, limit):
+        n_bytes = len(text.encode())
+        if n_bytes <= limit:
+            # every token covers at least one byte, so this fits
+            return tokenize(text)
+        lines = text.split("\n")
+        if self.policy == "head":
+            return self.take_lines(tokenize, lines, limit)
+        elif self.policy == "tail":
+            return self.take_tail(tokenize, lines, limit)
+        elif self.policy == "head-tail":
+            head_len = limit // 2
+            head, n_lines = self.take_head(tokenize, lines, head_len)
+            # tail never starts before the head ends, so a text just over
+            # the limit has no tokens taken twice
+            tail = head[head_len:] + self.take_tail(
+                tokenize, lines[n_lines:], limit - head_len
+            )
+            tail_len = limit - min(len(head), head_len)
+            return head[:head_len] + tail[max(len(tail) - tail_len, 0):]
+        else:
+            return self.take_strided(tokenize, lines, limit)
+
+    def select_tokens(self, tokenize, diff):
+        tokens = []
+        headers = []
+        for path, text in split_diff_by_file(diff):
+            remaining = self.max_tokens - len(tokens)
+            if remaining <= 0:
+                break
+            if self.should_skip(path, text):
+                # keep just the file header, so we know it changed
+                headers.append(text.split("\n", 1)[0])
+                continue
+            limit = min(self.file_tokens, remaining)
+            tokens.extend(self.select(tokenize, text, limit))
+        if len(tokens) == 0 and len(headers) > 0:
+            tokens = self.select(tokenize, "\n".join(headers), self.max_tokens)
+        return tokens
+
+
+def budget_from_policy(policy):
+    # TokenBudget recorded as an embedding's policy (None: whole chunk)
+    if policy is None or policy == "full":
+        return None
+    name, *options = policy.split(";")
+    options = dict(option.split("=", 1) for option in options)
+    return TokenBudget(
+        max_tokens=int(options["max"]),
+        file_tokens=int(options["file"]),
+        policy=name,
+        skip_generated=options["skip_generated"] == "True",
+    )
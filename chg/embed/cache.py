@@ -0,0 +1,166 @@
+from collections import OrderedDict
+import hashlib
+import os
+import sqlite3
+import time
+import unicodedata
+
+import numpy as np
+
+from chg.defaults import CHG_PROJ_EMBED_CACHE
+
+# seconds a write waits for another process holding the cache's lock
+BUSY_TIMEOUT = 30.0
+
+
+def normalize_text(txt):
+    return unicodedata.normalize("NFC", txt).strip()
+
+
+def cache_key(model_id, txt):
+    h = hashlib.sha256()
+    h.update(model_id.encode())
+    h.update(b"\0")
+    h.update(normalize_text(txt).encode())
+    return h.hexdigest()
+
+
+class EmbeddingCache(object):
+    """
+    Content-addressed embedding cache: in-memory LRU in front of
+    a size-bounded sqlite table on disk
+    """
+    def __init__(
+        self,
+        path,
+        max_entries=100000,
+        memory_entries=2048,
+        check_same_thread=True,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        # shared by every process embedding queries: readers don't block
+        # the writer, and writers wait for each other instead of failing
+        self.conn = sqlite3.connect(
+            path,
+            timeout=BUSY_TIMEOUT,
+            check_same_thread=check_same_thread,
+        )
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute(
+            "PRAGMA busy_timeout = {}".format(int(BUSY_TIMEOUT * 1000))
+        )
+        self._create_table()
+
+    def _create_table(self):
+        stmt = """
+        CREATE TABLE IF NOT EXISTS EmbeddingCache (
+            key TEXT PRIMARY KEY,
+            vector BLOB,
+            last_used REAL
+        )
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(stmt)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS EmbeddingCacheLastUsed "
+            "ON EmbeddingCache(last_used)"
+        )
+        self.conn.commit()
+        cursor.close()
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get_many(self, model_id, txts):
+        # list of vectors (None if not cached) aligned with txts
+        keys = [cache_key(model_id, t) for t in txts]
+        results = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                results[i] = self.memory[key]
+            else:
+                missing.append(i)
+
+        if len(missing) > 0:
+            missing_keys = list(set(keys[i] for i in missing))
+            found = {}
+            cursor = self.conn.cursor()
+            # stay below sqlite's limit on host parameters
+            for start in range(0, len(missing_keys), 500):
+                batch = missing_keys[start:(start + 500)]
+                cursor.execute(
+                    "SELECT key, vector FROM EmbeddingCache WHERE key IN ({})".
+                    format(", ".join("?" for _ in batch)),
+                    batch,
+                )
+                for key, blob in cursor.fetchall():
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if len(found) > 0:
+                now = time.time()
+                cursor.executemany(
+                    "UPDATE EmbeddingCache SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self.conn.commit()
+            cursor.close()
+            for i in missing:
+                vector = found.get(keys[i])
+                if vector is not None:
+                    self._remember(keys[i], vector)
+                    results[i] = vector
+        return results
+
+    def put_many(self, model_id, txts, vectors):
+        now = time.time()
+        rows = []
+        for txt, vector in zip(txts, vectors):
+            key = cache_key(model_id, txt)
+            vector = np.asarray(vector, dtype=np.float32)
+            self._remember(key, vector)
+            rows.append((key, vector.tobytes(), now))
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            "INSERT OR REPLACE INTO EmbeddingCache(key, vector, last_used) "
+            "VALUES(?, ?, ?)",
+            rows,
+        )
+        self.conn.commit()
+        cursor.close()
+        self.evict()
+
+    def evict(self):
+        # drop least recently used entries beyond max_entries
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM EmbeddingCache")
+        n = cursor.fetchone()[0]
+        if n > self.max_entries:
+            cursor.execute(
+                """
+                DELETE FROM EmbeddingCache WHERE key IN (
+                    SELECT key FROM EmbeddingCache
+                    ORDER BY last_used LIMIT ?
+                )
+                """,
+                (n - self.max_entries, ),
+            )
+            self.conn.commit()
+        cursor.close()
+
+
+def get_embedding_cache(check_same_thread=True):
+    cache_dir = os.path.dirname(CHG_PROJ_EMBED_CACHE)
+    if not os.path.exists(cache_dir):
+        print("Creating folder for chg embedding cache at", cache_dir)
+        os.makedirs(cache_dir)
+    return EmbeddingCache(
+        CHG_PROJ_EMBED_CACHE,
+        check_same_thread=check_same_thread,
+    )
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import time
+
+import numpy as np
+
+from chg.db.database import CHUNK_TEXT_SQL, JOIN_DIFFS_SQL, get_store
+from chg.defaults import CHG_EMBED_MODEL
+from chg.embed.basic import BACKENDS, BasicEmbedder
+from chg.embed.budget import budget_from_policy
+
+
+def sample_stored_embeddings(store, n):
+    rows = store.run_query(
+        """
+        SELECT Embeddings.chunk_id, {}, row, policy
+        FROM Embeddings JOIN Chunks ON Embeddings.chunk_id = Chunks.id
+        {}
+        WHERE model = ? AND row IS NOT NULL ORDER BY RANDOM() LIMIT ?
+        """.format(CHUNK_TEXT_SQL, JOIN_DIFFS_SQL),
+        (CHG_EMBED_MODEL, n),
+    )
+    samples = []
+    for chunk_id, chunk, row, policy in rows:
+        dialogue = store.run_query(
+            "SELECT question, answer FROM Dialogue WHERE chunk_id = ? ORDER BY id",
+            (chunk_id, ),
+        )
+        samples.append((
+            chunk,
+            dialogue,
+            store.vectors.get("code", [row])[0],
+            store.vectors.get("nl", [row])[0],
+            policy,
+        ))
+    return samples
+
+
+def cosine_drift(reference, other):
+    # stored vectors are unit norm, but be safe
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    other = other / np.linalg.norm(other, axis=1, keepdims=True)
+    return 1.0 - np.sum(reference * other, axis=1)
+
+
+def summarize(name, drift):
+    print(
+        "{}: mean drift={:.5f} p95={:.5f} max={:.5f}".format(
+            name,
+            drift.mean(),
+            np.percentile(drift, 95),
+            drift.max(),
+        )
+    )
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Compare backend embeddings to stored fp32 embeddings",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        help="Backend to check",
+        default="torch-int8",
+    )
+    parser.add_argument(
+        "--n",
+        type=int,
+        help="Number of stored chunks to compare",
+        default=100,
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Number of windows per forward pass",
+        default=8,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    store = get_store()
+    samples = sample_stored_embeddings(store, args.n)
+    if len(samples) == 0:
+        print("No stored {} embeddings to compare".format(CHG_EMBED_MODEL))
+        return
+    # grouped by the token budget each was stored with, so drift
+    # measures the backend and not a different truncation
+    by_policy = {}
+    for sample in samples:
+        by_policy.setdefault(sample[-1], []).append(sample[:-1])
+    samples = [s for group in by_policy.values() for s in group]
+    chunks, dialogues, code_ref, nl_ref = zip(*samples)
+
+    embedder = BasicEmbedder(batch_size=args.batch_size, backend=args.backend)
+    start = time.time()
+    code_embeddings = []
+    for policy, group in by_policy.items():
+        embedder.budget = budget_from_policy(policy)
+        code_embeddings.append(
+            embedder.embed_code_batch([chunk for chunk, _, _, _ in group])
+        )
+    code_embeddings = np.vstack(code_embeddings)
+    nl_embeddings = embedder.embed_dialogue_batch(list(dialogues))
+    elapsed = time.time() - start
+
+    print(
+        "{} vs stored {} ({} chunks, {:.3f}s per chunk)".format(
+            embedder.model_id,
+            CHG_EMBED_MODEL,
+            len(samples),
+            elapsed / len(samples),
+        )
+    )
+    summarize("code", cosine_drift(np.vstack(code_ref), code_embeddings))
+    summarize("nl", cosine_drift(np.vstack(nl_ref), nl_embeddings))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as err:
+        import pdb
+        pdb.post_mortem()
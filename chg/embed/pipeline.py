@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import multiprocessing
+import queue
+import threading
+
+import torch
+import tqdm
+
+from chg.db.database import get_store, hash_dialogue
+from chg.embed.basic import BACKENDS, BasicEmbedder, get_model_id
+from chg.embed.budget import POLICIES, TokenBudget
+
+# embedder held by each inference worker (or main process if no workers)
+_EMBEDDER = None
+
+
+def get_chunks_to_embed(store, model, policy, embed_all=False):
+    chunk_ids = store.run_query(
+        "SELECT id FROM Chunks WHERE chunk IS NOT NULL OR diff_hash IS NOT NULL"
+    )
+    chunk_ids = [row[0] for row in chunk_ids]
+    dialogues = {}
+    rows = store.run_query(
+        "SELECT chunk_id, question, answer FROM Dialogue ORDER BY chunk_id, id"
+    )
+    for chunk_id, question, answer in rows:
+        dialogues.setdefault(chunk_id, []).append((question, answer))
+
+    # skip chunks already embedded with the same dialogue and policy
+    prev_states = {} if embed_all else store.get_embedding_states(model)
+    todo = []
+    for chunk_id in chunk_ids:
+        dialogue = dialogues.get(chunk_id, [])
+        assert len(dialogue) >= 1, "Should have at least one commit message"
+        dialogue_hash = hash_dialogue(dialogue)
+        prev_hash, prev_policy = prev_states.get(chunk_id, (None, None))
+        # embeddings that predate policies (None) are kept
+        changed_policy = prev_policy is not None and prev_policy != policy
+        if prev_hash != dialogue_hash or changed_policy:
+            todo.append((chunk_id, dialogue, dialogue_hash))
+    return todo
+
+
+def read_batches(store, todo, batch_size, out_queue, errors=None):
+    # reader stage: reads on this thread's connection,
+    # alongside the main thread's writes
+    try:
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:(start + batch_size)]
+            chunks = store.get_chunks_by_ids([b[0] for b in batch])
+            out_queue.put([
+                (chunk_id, chunks[chunk_id], dialogue, dialogue_hash)
+                for chunk_id, dialogue, dialogue_hash in batch
+            ])
+    except Exception as err:
+        # e.g. chunk removed since todo was read: the consumer
+        # raises it, rather than waiting forever
+        if errors is not None:
+            errors.append(err)
+        out_queue.put(err)
+    finally:
+        # done
+        out_queue.put(None)
+
+
+def iterate_queue(in_queue):
+    while True:
+        batch = in_queue.get()
+        if batch is None:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+
+
+def set_torch_threads(intra_op_threads, inter_op_threads):
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads is not None:
+        torch.set_num_interop_threads(inter_op_threads)
+
+
+def init_worker(
+    batch_size,
+    backend,
+    budget,
+    fast_tokenizer,
+    intra_op_threads,
+    inter_op_threads,
+):
+    global _EMBEDDER
+    set_torch_threads(intra_op_threads, inter_op_threads)
+    # only dialogues are embedded here, which bypass the query cache
+    _EMBEDDER = BasicEmbedder(
+        batch_size=batch_size,
+        backend=backend,
+        budget=budget,
+        fast_tokenizer=fast_tokenizer,
+    )
+
+
+def embed_batch(batch):
+    # inference stage
+    chunk_ids, chunks, dialogues, dialogue_hashes = zip(*batch)
+    code_embeddings = _EMBEDDER.embed_code_batch(list(chunks))
+    nl_embeddings = _EMBEDDER.embed_dialogue_batch(list(dialogues))
+    return list(zip(chunk_ids, code_embeddings, nl_embeddings, dialogue_hashes))
+
+
+def write_results(
+    store, results, model, policy, write_batch_size, progress=None
+):
+    # writer stage: single writer, inserts batched into transactions
+    pending = []
+    for rows in results:
+        pending.extend(rows)
+        if progress is not None:
+            progress.update(len(rows))
+        if len(pending) >= write_batch_size:
+            store.record_embeddings_many(pending, model=model, policy=policy)
+            pending = []
+    if len(pending) > 0:
+        store.record_embeddings_many(pending, model=model, policy=policy)
+
+
+def get_policy(budget):
+    return "full" if budget is None else budget.describe()
+
+
+def get_budget(args):
+    if args.max_tokens <= 0:
+        return None
+    return TokenBudget(
+        max_tokens=args.max_tokens,
+        file_tokens=args.file_tokens,
+        policy=args.policy,
+        skip_generated=not args.keep_generated,
+    )
+
+
+def run_pipeline(
+    store,
+    todo,
+    batch_size=8,
+    backend="torch",
+    budget=None,
+    fast_tokenizer=True,
+    workers=0,
+    intra_op_threads=None,
+    inter_op_threads=None,
+    write_batch_size=256,
+):
+    batches = queue.Queue(maxsize=max(2 * workers, 2))
+    reader_errors = []
+    reader = threading.Thread(
+        target=read_batches,
+        args=(store, todo, batch_size, batches, reader_errors),
+        daemon=True,
+    )
+    reader.start()
+
+    model = get_model_id(backend)
+    policy = get_policy(budget)
+    init_args = (
+        batch_size,
+        backend,
+        budget,
+        fast_tokenizer,
+        intra_op_threads,
+        inter_op_threads,
+    )
+    progress = tqdm.tqdm(total=len(todo))
+    if workers == 0:
+        # embed in this process
+        init_worker(*init_args)
+        results = (embed_batch(b) for b in iterate_queue(batches))
+        write_results(
+            store,
+            results,
+            model,
+            policy,
+            write_batch_size,
+            progress=progress,
+        )
+    else:
+        # spawn, rather than fork a process that has torch loaded
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(
+                processes=workers,
+                initializer=init_worker,
+                initargs=init_args,
+        ) as pool:
+            results = pool.imap_unordered(embed_batch, iterate_queue(batches))
+            write_results(
+                store,
+                results,
+                model,
+                policy,
+                write_batch_size,
+                progress=progress,
+            )
+    progress.close()
+    reader.join()
+    if len(reader_errors) > 0:
+        raise reader_errors[0]
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Embed chg database",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Number of windows per forward pass (and chunks per step)",
+        default=8,
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Re-embed all chunks (default: only new or changed dialogue)",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        help="Embedding backend (embeddings are stored per backend)",
+        default="torch",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        help="Token budget for each chunk's code (<= 0: no budget)",
+        default=8192,
+    )
+    parser.add_argument(
+        "--file-tokens",
+        type=int,
+        help="Token budget for each file in a chunk",
+        default=2048,
+    )
+    parser.add_argument(
+        "--policy",
+        type=str,
+        choices=POLICIES,
+        help="Which tokens to keep when a file exceeds its budget",
+        default="head-tail",
+    )
+    parser.add_argument(
+        "--keep-generated",
+        action="store_true",
+        help="Embed lockfiles, vendored and generated files",
+    )
+    parser.add_argument(
+        "--slow-tokenizer",
+        action="store_true",
+        help="Tokenize one string at a time with the python tokenizer",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of inference processes (0: embed in main process)",
+        default=0,
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        help="torch intra-op threads per worker (default: torch's choice)",
+    )
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        help="torch inter-op threads per worker (default: torch's choice)",
+    )
+    parser.add_argument(
+        "--write-batch-size",
+        type=int,
+        help="Number of chunks' embeddings written per transaction",
+        default=256,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    store = get_store()
+    budget = get_budget(args)
+    todo = get_chunks_to_embed(
+        store,
+        get_model_id(args.backend),
+        get_policy(budget),
+        embed_all=args.all,
+    )
+    print("Embedding code and dialogue for {} chunks".format(len(todo)))
+    if len(todo) == 0:
+        return
+    run_pipeline(
+        store,
+        todo,
+        batch_size=args.batch_size,
+        backend=args.backend,
+        budget=budget,
+        fast_tokenizer=not args.slow_tokenizer,
+        workers=args.workers,
+        intra_op_threads=args.intra_op_threads,
+        inter_op_threads=args.inter_op_threads,
+        write_batch_size=args.write_batch_size,
+    )
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as err:
+        import pdb
+        pdb.post_mortem()
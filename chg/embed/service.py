@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import base64
+import json
+import os
+import socket
+import socketserver
+import threading
+
+import numpy as np
+
+from chg.defaults import CHG_PROJ_EMBED_SOCKET
+from chg.embed.budget import TokenBudget
+from chg.embed.cache import get_embedding_cache
+from chg.embed.utils import BACKENDS, get_model_id, merge_dialogue
+
+
+def encode_vectors(mat):
+    mat = np.asarray(mat, dtype=np.float32)
+    return {
+        "shape": list(mat.shape),
+        "data": base64.b64encode(mat.tobytes()).decode(),
+    }
+
+
+def decode_vectors(msg):
+    data = base64.b64decode(msg["data"])
+    return np.frombuffer(data, dtype=np.float32).reshape(msg["shape"])
+
+
+def send_message(sock_file, msg):
+    sock_file.write((json.dumps(msg) + "\n").encode())
+    sock_file.flush()
+
+
+def recv_message(sock_file):
+    line = sock_file.readline()
+    if len(line) == 0:
+        raise ConnectionError("Embedding service closed connection")
+    return json.loads(line.decode())
+
+
+class EmbeddingRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        embedder = self.server.embedder
+        # one json request per line
+        for line in self.rfile:
+            try:
+                # a malformed request gets an error reply, not a hang
+                request = json.loads(line.decode())
+                method = request.get("method")
+                if method == "info":
+                    response = {"model_id": embedder.model_id}
+                elif method == "embed_code_batch":
+                    with self.server.lock:
+                        mat = embedder.embed_code_batch(request["texts"])
+                    response = encode_vectors(mat)
+                elif method == "embed_nl_batch":
+                    with self.server.lock:
+                        mat = embedder.embed_nl_batch(
+                            request["texts"],
+                            use_cache=request.get("use_cache", True),
+                        )
+                    response = encode_vectors(mat)
+                else:
+                    response = {"error": "Unknown method: {}".format(method)}
+            except Exception as err:
+                response = {"error": str(err)}
+            send_message(self.wfile, response)
+
+
+class EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Keeps an embedder resident, a thread per client connection
+    but embedding calls are serialized
+    """
+    daemon_threads = True
+
+    def __init__(self, path, embedder):
+        self.embedder = embedder
+        self.lock = threading.Lock()
+        super().__init__(path, EmbeddingRequestHandler)
+
+
+class EmbeddingClient(object):
+    """
+    Same interface as BasicEmbedder, embedding done by EmbeddingServer
+    """
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.sock_file = self.sock.makefile("rwb")
+        self.model_id = self.call_("info")["model_id"]
+        self.sock.settimeout(None)
+
+    def call_(self, method, texts=None, **kwargs):
+        request = {"method": method, "texts": texts}
+        request.update(kwargs)
+        send_message(self.sock_file, request)
+        response = recv_message(self.sock_file)
+        if "error" in response:
+            raise Exception("Embedding service error:", response["error"])
+        return response
+
+    def close(self):
+        self.sock_file.close()
+        self.sock.close()
+
+    def embed_code_batch(self, codes):
+        return decode_vectors(self.call_("embed_code_batch", list(codes)))
+
+    def embed_nl_batch(self, nls, use_cache=True):
+        return decode_vectors(
+            self.call_("embed_nl_batch", list(nls), use_cache=use_cache)
+        )
+
+    def embed_dialogue_batch(self, dialogues):
+        return self.embed_nl_batch(
+            [merge_dialogue(d) for d in dialogues],
+            use_cache=False,
+        )
+
+    def embed_code(self, code):
+        return self.embed_code_batch([code])[0]
+
+    def embed_nl(self, nl):
+        return self.embed_nl_batch([nl])[0]
+
+    def embed_dialogue(self, question_and_answers):
+        return self.embed_dialogue_batch([question_and_answers])[0]
+
+
+def connect(path=CHG_PROJ_EMBED_SOCKET, backend="torch"):
+    # client if service is running with the same backend, else None
+    if not os.path.exists(path):
+        return None
+    try:
+        client = EmbeddingClient(path, timeout=1.0)
+    except (OSError, ConnectionError, ValueError):
+        return None
+    if client.model_id != get_model_id(backend):
+        client.close()
+        return None
+    return client
+
+
+def get_embedder(backend="torch"):
+    client = connect(backend=backend)
+    if client is not None:
+        return client
+    # fall back to loading model in this process,
+    # only import torch etc if we get here
+    from chg.embed.basic import BasicEmbedder
+    return BasicEmbedder(
+        cache=get_embedding_cache(),
+        backend=backend,
+        budget=TokenBudget(),
+    )
+
+
+def serve(path, backend="torch", batch_size=8):
+    from chg.embed.basic import BasicEmbedder
+    # cache is shared by handler threads, under the server's lock
+    embedder = BasicEmbedder(
+        batch_size=batch_size,
+        cache=get_embedding_cache(check_same_thread=False),
+        backend=backend,
+        budget=TokenBudget(),
+    )
+    if os.path.exists(path):
+        # stale socket from a previous run
+        os.remove(path)
+    server = EmbeddingServer(path, embedder)
+    print("Serving {} embeddings at {}".format(embedder.model_id, path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Long-lived embedding service over a unix socket",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        help="Unix socket path",
+        default=CHG_PROJ_EMBED_SOCKET,
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        help="Embedding backend",
+        default="torch",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Number of windows per forward pass",
+        default=8,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    try:
+        serve(args.socket, backend=args.backend, batch_size=args.batch_size)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+# helpers shared by embedders, kept free of torch so clients
+# of the embedding service start quickly
+import numpy as np
+
+from chg.defaults import CHG_EMBED_MODEL
+from chg.platform import git
+
+
+def remove_color_ascii(msg):
+    return git.strip_colors(msg).strip()
+
+
+def normalize_vectors(mat):
+    # make vectors unit norm
+    norm = np.sqrt(np.sum(mat**2, axis=1))
+    # set to 1.0 to avoid nan
+    norm[norm == 0] = 1.0
+    norm_mat = mat / norm.reshape(-1, 1)
+    return norm_mat
+
+
+def merge_dialogue(question_and_answers):
+    # empty history
+    if len(question_and_answers) == 0:
+        question_and_answers = [("", "")]
+    return "\n".join("{}:{}".format(q, a) for q, a in question_and_answers)
+
+
+BACKENDS = ["torch", "torch-int8", "onnx"]
+
+
+def get_model_id(backend):
+    # identifies the vectors produced (for cache keys and stored embeddings)
+    if backend == "torch":
+        return CHG_EMBED_MODEL
+    else:
+        return "{}:{}".format(CHG_EMBED_MODEL, backend)
@@ -9,7 +9,11 @@ from chg.annotator.template_annotator import (
 )
 from chg.dialogue import basic_dialogue, dynamic_dialogue
 from chg.db.database import get_store
-from chg.search.embedded_search import EmbeddedSearcher
+from chg.embed.utils import BACKENDS
+from chg.search.filters import add_filter_args, get_filter
+from chg.search.hybrid_search import HybridSearcher, SEARCH_MODES
+from chg.search.result_cache import get_result_cache
+from chg.search import service as search_service
 from chg.ranker.model_based_ranking import RFModel, QuestionRanker
 
 from chg.ui import (
@@ -46,7 +50,13 @@ def get_ui(args):
 
 
 def get_searcher(args):
-    searcher = EmbeddedSearcher()
+    cache = None if args.no_cache else get_result_cache()
+    searcher = HybridSearcher(
+        backend=args.backend,
+        mode=args.search,
+        cache=cache,
+        search_filter=get_filter(args),
+    )
     return searcher
 
 
@@ -100,6 +110,32 @@ def get_args():
         default="tk"
     )
     ask_parser.add_argument("--dev", action="store_true", help="Set dev flag")
+    ask_parser.add_argument(
+        "-b",
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        help="Backend used to embed questions",
+        default="torch",
+    )
+    ask_parser.add_argument(
+        "-s",
+        "--search",
+        type=str,
+        choices=SEARCH_MODES,
+        help="Match questions by keywords, embeddings or both",
+        default="hybrid",
+    )
+    ask_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't reuse or save results of previous questions",
+    )
+    add_filter_args(ask_parser)
+
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.set_defaults(action="serve")
+    search_service.add_serve_args(serve_parser)
 
     args = parser.parse_args()
 
@@ -136,6 +172,8 @@ def main():
         main_annotate(args)
     elif args.action == "ask":
         main_ask(args)
+    elif args.action == "serve":
+        search_service.main_serve(args)
     else:
         raise Exception("Invalid action", args.action)
 
@@ -1,5 +1,16 @@
-import subprocess
 import json
+import re
+import subprocess
+
+
+# ANSI color escape sequences, e.g. from git's --color=always
+ANSI_COLOR_REGEX = re.compile(r"\x1b\[[0-9;]*m")
+ANSI_RED = "\x1b[31m"
+ANSI_GREEN = "\x1b[32m"
+ANSI_BOLD = "\x1b[1m"
+ANSI_RESET = "\x1b[m"
+
+DIFF_HEADER_REGEX = re.compile(r"^diff --git a/(.*) b/(.*)$")
 
 
 def run_command(cmd, **kwargs):
@@ -24,10 +35,10 @@ def add(paths=None):
 
 def diff(path=None, extra_flags=None):
     # get both cached (already staged) and uncached changes (i.e. not staged)
-    cmd = ["git", "diff", "HEAD"]
-    if extra_flags is None:
-        extra_flags = ["--color=always"]
-    cmd.extend(extra_flags)
+    # diffs are stored color-free, color is only added for display
+    cmd = ["git", "diff", "HEAD", "--no-color"]
+    if extra_flags is not None:
+        cmd.extend(extra_flags)
     if path is not None:
         cmd.append(path)
     _, output = run_command(cmd)
@@ -47,7 +58,7 @@ def cat(path, commit=None):
 
 def diff_from_to(hash1, hash2):
     # after user has run git add
-    cmd = ["git", "diff", "--color=always", hash1, hash2]
+    cmd = ["git", "diff", "--no-color", hash1, hash2]
     _, output = run_command(cmd)
     if len(output) == 0:
         return None
@@ -55,6 +66,38 @@ def diff_from_to(hash1, hash2):
         return output
 
 
+def strip_colors(msg):
+    # diffs recorded by older versions of chg have color escapes
+    return ANSI_COLOR_REGEX.sub("", str(msg))
+
+
+def colorize_diff(diff):
+    # add terminal colors to a color-free diff for display
+    lines = []
+    for line in strip_colors(diff).split("\n"):
+        if line.startswith(("+++", "---", "diff ", "index ")):
+            line = ANSI_BOLD + line + ANSI_RESET
+        elif line.startswith("+"):
+            line = ANSI_GREEN + line + ANSI_RESET
+        elif line.startswith("-"):
+            line = ANSI_RED + line + ANSI_RESET
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def diff_paths(diff):
+    # paths (old and new, if renamed) of each file in a diff
+    paths = []
+    for line in strip_colors(diff).split("\n"):
+        match = DIFF_HEADER_REGEX.match(line)
+        if match is None:
+            continue
+        for path in match.groups():
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
 def diff_files():
     # after user has run git add
     cmd = ["git", "diff", "HEAD", "--name-only"]
@@ -80,11 +123,41 @@ def hash():
     return run_command(cmd)[1]
 
 
+def commit_timestamp(rev="HEAD"):
+    # committer date, seconds since epoch (None if unknown revision)
+    cmd = ["git", "show", "-s", "--format=%ct", rev, "--"]
+    returncode, output = run_command(cmd, stderr=subprocess.DEVNULL)
+    if returncode != 0 or len(output) == 0:
+        return None
+    return float(output)
+
+
+def rev_parse(revs):
+    # full hash each revision currently points to
+    cmd = ["git", "rev-parse"] + list(revs)
+    returncode, output = run_command(cmd, stderr=subprocess.DEVNULL)
+    if returncode != 0:
+        raise ValueError("Unknown revision:", revs)
+    return output.split("\n")
+
+
+def rev_list(since=None, until=None):
+    # full hashes of commits reachable from until (default HEAD)
+    # but not from since
+    cmd = ["git", "rev-list", until or "HEAD"]
+    if since is not None:
+        cmd.append("^" + since)
+    returncode, output = run_command(cmd, stderr=subprocess.DEVNULL)
+    if returncode != 0:
+        raise ValueError("Unknown commit range:", since, until)
+    return [h for h in output.split("\n") if len(h) > 0]
+
+
 def log():
     # parse logs (just hash and message)
     cmd = """
     git log \
-  --pretty=format:'{^^^^date^^^^:^^^^%ci^^^^,^^^^abbreviated_commit^^^^:^^^^%h^^^^,^^^^subject^^^^:^^^^%s^^^^,^^^^body^^^^:^^^^%b^^^^}' \
+  --pretty=format:'{^^^^date^^^^:^^^^%ci^^^^,^^^^timestamp^^^^:^^^^%ct^^^^,^^^^commit^^^^:^^^^%H^^^^,^^^^abbreviated_commit^^^^:^^^^%h^^^^,^^^^subject^^^^:^^^^%s^^^^,^^^^body^^^^:^^^^%b^^^^}' \
   | sed 's/"/\\"/g' \
   | sed 's/\^^^^/"/g' \
   | jq -s '.'
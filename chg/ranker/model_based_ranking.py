@@ -10,9 +10,9 @@ from scipy.stats import norm
 import tqdm
 
 from chg.db import database
-from chg.defaults import CHG_PROJ_RANKER
+from chg.defaults import CHG_EMBED_MODEL, CHG_PROJ_RANKER
 from chg.search import embedded_search
-from chg.embed.basic import BasicEmbedder, remove_color_ascii
+from chg.embed.service import get_embedder
 
 
 # TODO: we could replace this RF model
@@ -41,7 +41,7 @@ class RFModel(object):
 
 class QuestionRanker(object):
     def __init__(self, delta=0.05, train_every=1, negative_k=3):
-        self.embed_model = BasicEmbedder()
+        self.embed_model = get_embedder()
         self.loss_model = RFModel()
         self.database = database.get_store()
         self.curr = {}
@@ -54,20 +54,22 @@ class QuestionRanker(object):
 
     def sample_negative_code_vecs(self, exclude_id=None):
         query = """
-        SELECT code_embedding FROM Embeddings
+        SELECT row FROM Embeddings WHERE model = ? AND row IS NOT NULL
         """
+        params = [CHG_EMBED_MODEL]
         if exclude_id is not None:
-            query += " WHERE NOT chunk_id={}".format(exclude_id)
+            query += " AND NOT chunk_id = ?"
+            params.append(exclude_id)
         # sample some number of these
-        query += "  ORDER BY RANDOM() LIMIT {}".format(self.negative_k)
-
-        results = []
-        for row in self.database.run_query(query):
-            # comes out as a tuple by default, so take first elem
-            code_blob = row[0]
-            code_embedding = self.database.blob_to_array(code_blob)
-            results.append(code_embedding)
-        mat = np.vstack(results)
+        query += "  ORDER BY RANDOM() LIMIT ?"
+        params.append(self.negative_k)
+
+        # comes out as a tuple by default, so take first elem
+        rows = [
+            row[0]
+            for row in self.database.run_query(query, params, readonly=True)
+        ]
+        mat = self.database.vectors.get("code", rows)
         return mat
 
     def compute_loss(self, code_vec, nl_vec, neg_code_vecs):
@@ -85,6 +87,9 @@ class QuestionRanker(object):
     def embed_nl(self, _input):
         return self.embed_model.embed_nl(_input)
 
+    def embed_nl_batch(self, _input):
+        return self.embed_model.embed_nl_batch(_input)
+
     def embed_dialogue(self, _input):
         return self.embed_model.embed_dialogue(_input)
 
@@ -147,8 +152,8 @@ class QuestionRanker(object):
         scores = []
         # candidate questions: pick the one that
         # we believe will produce the best score
-        for i, q in enumerate(questions):
-            q_vec = self.embed_nl(q)
+        q_vecs = self.embed_nl_batch(questions)
+        for i, q_vec in enumerate(q_vecs):
             x = np.concatenate((context_vec, q_vec))
             y = self.loss_model.expected_improvement(x, curr_loss)
             scores.append(y)
@@ -215,7 +220,10 @@ def build_ranker_from_git_log():
     ranker = QuestionRanker()
     X = []
     y = []
-    rows = store.run_query("SELECT id FROM Chunks WHERE chunk IS NOT NULL")
+    rows = store.run_query(
+        "SELECT id FROM Chunks "
+        "WHERE chunk IS NOT NULL OR diff_hash IS NOT NULL"
+    )
     chunk_ids = [row[0] for row in rows]
 
     print("Training ranker")
@@ -223,8 +231,9 @@ def build_ranker_from_git_log():
         code_embedding, _ = store.get_embeddings_by_chunk_id(chunk_id)
         # q/a associated with this code chunk change
         dialogue = store.run_query(
-            "SELECT question, answer FROM Dialogue WHERE chunk_id={}".
-            format(chunk_id)
+            "SELECT question, answer FROM Dialogue WHERE chunk_id = ? "
+            "ORDER BY id",
+            (chunk_id, ),
         )
         for i, (current_q, future_answer) in enumerate(dialogue):
             past_dialogue = dialogue[:i]
@@ -272,7 +281,8 @@ def load_ranker():
     with open(CHG_PROJ_RANKER, "rb") as fin:
         ranker = pickle.load(fin)
         # skip pickling of model or sqlite3 connections
-        ranker.embed_model = BasicEmbedder()
+        # uses embedding service if running
+        ranker.embed_model = get_embedder()
         ranker.database = database.get_store()
     return ranker
 
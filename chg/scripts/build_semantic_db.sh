@@ -18,7 +18,7 @@ mkdir -p ${CHG_PROJ_DIR}
 CHG_PROJ_FAISS="$(python -m chg.defaults 'CHG_PROJ_FAISS')"
 
 # Embed chg's database
-python -m chg.embed.basic
+python -m chg.embed.pipeline
 
 # Load embeddings into FAISS for fast search
 python -m chg.search.embedded_search
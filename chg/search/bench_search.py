@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import zlib
+
+import faiss
+import numpy as np
+import torch
+from transformers import RobertaConfig, RobertaModel
+
+from chg.db.database import Database
+from chg.defaults import CHG_EMBED_MODEL
+from chg.embed.basic import BasicEmbedder, token_windows
+from chg.embed.utils import BACKENDS, normalize_vectors
+from chg.search.embedded_search import (
+    get_fields,
+    load_index,
+    lookup_in_store,
+    run_queries,
+    update_index,
+)
+from chg.search.index_modes import INDEX_MODES
+
+STAGES = ["open", "tokenize", "inference", "search", "lookup", "total"]
+# rows written per transaction when building a synthetic store
+BUILD_BATCH = 10000
+
+WORDS = (
+    "add remove fix refactor rename test cache index search query ranker "
+    "database schema embedding vector chunk dialogue commit annotate user "
+    "config parser service socket batch model token budget path date filter "
+    "because so that slow fast bug crash regression memory disk latency"
+).split()
+
+
+class HashTokenizer(object):
+    """
+    Words and punctuation hashed into a fixed vocabulary: stands in for
+    CodeBERT's tokenizer without downloading it
+    """
+    cls_token = "<s>"
+    sep_token = "</s>"
+    pad_token_id = 1
+    special = {"<s>": 0, "<pad>": 1, "</s>": 2, "<unk>": 3}
+
+    def __init__(self, vocab_size):
+        self.vocab_size = vocab_size
+
+    def tokenize(self, txt):
+        return re.findall(r"\w+|[^\w\s]", txt)
+
+    def convert_tokens_to_ids(self, tokens):
+        n = self.vocab_size - len(self.special)
+        return [
+            self.special[t] if t in self.special else
+            len(self.special) + zlib.crc32(t.encode()) % n
+            for t in tokens
+        ]
+
+
+class StandInEmbedder(BasicEmbedder):
+    """
+    Small randomly initialized RoBERTa with the same windowing, padding,
+    batching and pooling code as BasicEmbedder, so benchmarks run offline
+    """
+    def __init__(
+        self,
+        dim=768,
+        layers=2,
+        vocab_size=8192,
+        max_len=130,
+        batch_size=8,
+        seed=0,
+    ):
+        torch.manual_seed(seed)
+        heads = next(h for h in [12, 8, 4, 1] if dim % h == 0)
+        config = RobertaConfig(
+            vocab_size=vocab_size,
+            hidden_size=dim,
+            num_hidden_layers=layers,
+            num_attention_heads=heads,
+            intermediate_size=2 * dim,
+            max_position_embeddings=max_len,
+        )
+        super().__init__(
+            batch_size=batch_size,
+            model=RobertaModel(config),
+            tokenizer=HashTokenizer(vocab_size),
+        )
+        self.model_id = "stand-in"
+
+    def batch_windows_(self, txts):
+        windows = []
+        mapping = []
+        for i, txt in enumerate(txts):
+            txt_windows = token_windows(
+                self.tokenizer,
+                self.tokenizer.tokenize(txt),
+                self.max_len,
+            )
+            windows.extend(txt_windows)
+            mapping.extend([i] * len(txt_windows))
+        return windows, mapping
+
+
+def get_bench_embedder(name, dim=768, backend="torch"):
+    if name == "stand-in":
+        return StandInEmbedder(dim=dim)
+    elif name == "codebert":
+        return BasicEmbedder(backend=backend)
+    else:
+        raise ValueError("Unknown embedder:", name)
+
+
+def random_sentence(rng, n_words):
+    return " ".join(rng.choice(WORDS, n_words))
+
+
+def random_diff(rng, chunk_id):
+    path = "pkg{}/module{}.py".format(chunk_id % 50, chunk_id % 1000)
+    lines = ["diff --git a/{0} b/{0}".format(path)]
+    for _ in range(rng.randint(2, 12)):
+        lines.append("+    {} = {}".format(rng.choice(WORDS), chunk_id))
+    return "\n".join(lines)
+
+
+def build_store(directory, n, dim, model=CHG_EMBED_MODEL, seed=0):
+    # chunks with generated diffs and dialogue, random unit vectors.
+    # Reused if already built with the same size
+    db_path = os.path.join(directory, "db.sqlite3")
+    store = Database(db_path)
+    n_chunks = store.run_query("SELECT COUNT(*) FROM Chunks")[0][0]
+    if n_chunks == n:
+        return store
+    if n_chunks > 0:
+        raise ValueError("Store at {} has {} chunks, not {}".format(
+            directory, n_chunks, n))
+    rng = np.random.RandomState(seed)
+    # through the write API, so paths, commit dates and the full-text
+    # index are filled as for a real repository
+    for start in range(0, n, BUILD_BATCH):
+        ids = range(start + 1, min(start + BUILD_BATCH, n) + 1)
+        chunk_ids = store.record_chunks_many(
+            [
+                ("{:040x}".format(i - 1), random_diff(rng, i),
+                 "{:040x}".format(i))
+                for i in ids
+            ],
+            commit_dates=[1.6e9 + i for i in ids],
+        )
+        store.record_dialogue_many([
+            (chunk_id, [
+                (q, random_sentence(rng, rng.randint(4, 20)))
+                for q in ["Commit: ", "Why was this change made?"]
+            ])
+            for chunk_id in chunk_ids
+        ])
+        mats = {
+            field: normalize_vectors(
+                rng.standard_normal((len(chunk_ids), dim))
+            ).astype(np.float32)
+            for field in ["code", "nl"]
+        }
+        store.record_embeddings_many(
+            [
+                (chunk_id, code, nl, "h")
+                for chunk_id, code, nl in zip(
+                    chunk_ids, mats["code"], mats["nl"])
+            ],
+            model=model,
+        )
+    return store
+
+
+def percentiles(samples):
+    samples = 1000 * np.array(samples)
+    return {
+        "n": len(samples),
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p95_ms": float(np.percentile(samples, 95)),
+        "p99_ms": float(np.percentile(samples, 99)),
+    }
+
+
+def run_query_stages(embedder, store, index, params, query, k, timings):
+    # one chg ask query (vector path), timing each stage
+    fields, stride = get_fields(params)
+    start = time.perf_counter()
+    windows, _ = embedder.batch_windows_([query])
+    t_tokenize = time.perf_counter()
+    vector = normalize_vectors(
+        embedder.embed_windows_(windows).mean(axis=0, keepdims=True)
+    )
+    t_inference = time.perf_counter()
+    chunk_ids = run_queries(
+        index,
+        vector,
+        k,
+        fields=fields,
+        stride=stride,
+        params=params,
+    )[0]
+    t_search = time.perf_counter()
+    lookup_in_store(store, chunk_ids)
+    t_lookup = time.perf_counter()
+    timings["tokenize"].append(t_tokenize - start)
+    timings["inference"].append(t_inference - t_tokenize)
+    timings["search"].append(t_search - t_inference)
+    timings["lookup"].append(t_lookup - t_search)
+    timings["total"].append(t_lookup - start)
+
+
+def bench_mode(
+    embedder,
+    directory,
+    store,
+    mode,
+    queries,
+    k=5,
+    cold_runs=5,
+):
+    # cold: store and index opened from disk before each query
+    # (the OS page cache is not dropped); warm: opened once
+    index_path = os.path.join(directory, "faiss_{}.db".format(mode))
+    start = time.perf_counter()
+    update_index(store, path=index_path, mode=mode)
+    build_time = time.perf_counter() - start
+
+    db_path = store.db_path
+    cold = {stage: [] for stage in STAGES}
+    for i in range(cold_runs):
+        start = time.perf_counter()
+        cold_store = Database(db_path)
+        index, params = load_index(cold_store, index_path)
+        cold["open"].append(time.perf_counter() - start)
+        run_query_stages(
+            embedder, cold_store, index, params, queries[i % len(queries)],
+            k, cold,
+        )
+        cold["total"][-1] += cold["open"][-1]
+        # connections and mapped files, so runs don't accumulate them
+        cold_store.close()
+        del index
+
+    warm = {stage: [] for stage in STAGES}
+    index, params = load_index(store, index_path)
+    for query in queries:
+        run_query_stages(embedder, store, index, params, query, k, warm)
+    return build_time, params, cold, warm
+
+
+def run_benchmarks(args):
+    start = time.perf_counter()
+    embedder = get_bench_embedder(args.embedder, dim=args.dim,
+                                  backend=args.backend)
+    model_load = time.perf_counter() - start
+    dim = embedder.hidden_size
+    rng = np.random.RandomState(args.seed)
+    queries = [
+        random_sentence(rng, rng.randint(3, 12))
+        for _ in range(args.queries)
+    ]
+    results = [
+        dict(stage="model_load", **percentiles([model_load]))
+    ]
+    root = args.dir or tempfile.mkdtemp(prefix="chg-bench-")
+    for size in args.sizes:
+        directory = os.path.join(root, "n{}_d{}".format(size, dim))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        start = time.perf_counter()
+        store = build_store(directory, size, dim, seed=args.seed)
+        print("store: {} chunks ({:.1f}s)".format(
+            size, time.perf_counter() - start))
+        for mode in args.modes:
+            build_time, params, cold, warm = bench_mode(
+                embedder,
+                directory,
+                store,
+                mode,
+                queries,
+                k=args.k,
+                cold_runs=args.cold_runs,
+            )
+            print("  {} ({}): built in {:.2f}s".format(
+                mode, params["type"], build_time))
+            for phase, timings in [("cold", cold), ("warm", warm)]:
+                for stage in STAGES:
+                    if len(timings[stage]) == 0:
+                        continue
+                    results.append(dict(
+                        size=size,
+                        mode=mode,
+                        phase=phase,
+                        stage=stage,
+                        **percentiles(timings[stage])
+                    ))
+    return results
+
+
+def result_key(result):
+    return (
+        result.get("size"),
+        result.get("mode"),
+        result.get("phase"),
+        result["stage"],
+    )
+
+
+def print_results(results):
+    print("{:>8} {:>9} {:>5} {:>10} {:>9} {:>9} {:>9}".format(
+        "size", "mode", "phase", "stage", "p50_ms", "p95_ms", "p99_ms"))
+    for r in results:
+        print("{:>8} {:>9} {:>5} {:>10} {:9.3f} {:9.3f} {:9.3f}".format(
+            str(r.get("size", "-")),
+            str(r.get("mode", "-")),
+            str(r.get("phase", "-")),
+            r["stage"],
+            r["p50_ms"],
+            r["p95_ms"],
+            r["p99_ms"],
+        ))
+
+
+def find_regressions(results, baseline, tolerance):
+    # stages whose p95 grew by more than tolerance (a ratio) since baseline
+    previous = {result_key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        prev = previous.get(result_key(r))
+        if prev is None or r["stage"] == "model_load":
+            continue
+        if r["p95_ms"] > tolerance * prev["p95_ms"]:
+            regressions.append((r, prev))
+    return regressions
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Per-stage latency of vector search on synthetic stores",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        help="Number of chunks in each synthetic store",
+        default=[1000, 10000],
+    )
+    parser.add_argument(
+        "--modes",
+        type=str,
+        nargs="+",
+        choices=INDEX_MODES,
+        help="Index types to benchmark",
+        default=["flat", "hnsw", "ivf-flat", "ivf-pq"],
+    )
+    parser.add_argument(
+        "--embedder",
+        type=str,
+        choices=["stand-in", "codebert"],
+        help="Query embedder (stand-in needs no downloads)",
+        default="stand-in",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        help="Backend for codebert embedder",
+        default="torch",
+    )
+    parser.add_argument(
+        "--dim",
+        type=int,
+        help="Vector dimension for stand-in embedder",
+        default=768,
+    )
+    parser.add_argument(
+        "--queries",
+        type=int,
+        help="Number of warm queries per index",
+        default=200,
+    )
+    parser.add_argument(
+        "--cold-runs",
+        type=int,
+        help="Number of cold queries per index",
+        default=5,
+    )
+    parser.add_argument("--k", type=int, help="Results per query", default=5)
+    parser.add_argument("--seed", type=int, help="Random seed", default=0)
+    parser.add_argument(
+        "--dir",
+        type=str,
+        help="Where synthetic stores are built and reused (default: temp)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write results as JSON lines to this file",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="Results (JSON lines) of a previous run to compare against",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="Fail if a stage's p95 is this many times its baseline",
+        default=1.5,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    # one thread, so numbers are comparable across runners
+    faiss.omp_set_num_threads(1)
+    torch.set_num_threads(1)
+    results = run_benchmarks(args)
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, "w") as fout:
+            for result in results:
+                fout.write(json.dumps(result) + "\n")
+    if args.baseline is None:
+        return 0
+    with open(args.baseline, "r") as fin:
+        baseline = [json.loads(line) for line in fin if len(line.strip()) > 0]
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for r, prev in regressions:
+        print("Regression: {} p95 {:.3f}ms (was {:.3f}ms)".format(
+            result_key(r), r["p95_ms"], prev["p95_ms"]))
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -1,80 +1,655 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
+import json
+import os
+import sys
+import time
 
 import faiss
 import numpy as np
 
-from chg.defaults import CHG_PROJ_FAISS
+from chg.defaults import CHG_EMBED_MODEL, CHG_PROJ_FAISS
 from chg.db.database import get_store
-from chg.embed.basic import (
-    BasicEmbedder,
-    normalize_vectors,
+from chg.db.vector_store import FIELDS
+from chg.embed.service import get_embedder
+from chg.embed.utils import BACKENDS, get_model_id, normalize_vectors
+from chg.search.filters import add_filter_args, get_filter
+from chg.search.result_cache import cached_search
+from chg.search.results import result_to_dict
+from chg.search.index_modes import (
+    INDEX_MODES,
+    create_index,
+    get_params,
+    get_search_params,
+    needs_rebuild,
+    params_from_str,
+    params_to_str,
+    resolve_mode,
+    set_search_params,
+    supports_remove,
+    train_index,
 )
 
+# faiss id of a chunk's vector for field i is chunk_id * FIELD_STRIDE + i
+FIELD_STRIDE = 8
+# how much each field's similarity counts towards a chunk's score
+DEFAULT_FIELD_WEIGHTS = {"code": 0.4, "nl": 0.6}
+# neighbours retrieved per requested result and field, before combining
+OVERSAMPLE = 4
+# filters allowing at most this many chunks are searched exactly,
+# over their vectors in the store instead of the index
+EXACT_FILTER_MAX_CHUNKS = 4096
 
-def load_vectors():
-    store = get_store()
-    rows = store.run_query(
-        "SELECT code_embedding FROM Embeddings ORDER BY chunk_id"
+
+def to_vector_ids(chunk_ids, field_ix, stride=FIELD_STRIDE):
+    return np.array(chunk_ids, dtype=np.int64) * stride + field_ix
+
+
+def get_fields(params):
+    # fields indexed, and the stride of their faiss ids
+    if "fields" not in params:
+        # indices built before multiple fields: code, ids are chunk ids
+        return ["code"], 1
+    return params["fields"], FIELD_STRIDE
+
+
+def is_chunk_keyed(index):
+    # built by update_index (faiss ids derived from chunk ids). The
+    # original faiss.db was a plain IndexFlatIP, ids were row positions
+    return isinstance(
+        faiss.downcast_index(index),
+        (faiss.IndexIDMap, faiss.IndexIDMap2),
     )
-    code_embeddings = [store.blob_to_array(row[0]) for row in rows]
-    mat = np.array(code_embeddings, dtype=np.float32)
-    return mat
 
 
-def build_index(mat):
-    mat = normalize_vectors(mat).astype(np.float32)
-    index = faiss.IndexFlatIP(mat.shape[-1])
-    index.add(mat)
-    return index
+def parse_weights(s):
+    # "code=0.3,nl=0.7" -> {"code": 0.3, "nl": 0.7}
+    weights = {}
+    for part in s.split(","):
+        field, weight = part.split("=")
+        if field not in FIELDS:
+            raise ValueError("Unknown field:", field)
+        weights[field] = float(weight)
+    return weights
+
+
+def save_index(index, path=CHG_PROJ_FAISS):
+    # write then rename, so readers never see a partial index
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def get_index_changes(store, path, model):
+    # chunks to remove from the index, (chunk_id, row, hash, policy) to add
+    # and all embedded chunks
+    embedded = {row[0]: row for row in store.get_embedding_rows(model)}
+    indexed = store.get_indexed_chunks(path)
+    # chunks re-embedded since (new dialogue or token budget)
+    added = [
+        row for chunk_id, row in embedded.items()
+        if indexed.get(chunk_id) != (row[2], row[3])
+    ]
+    # deleted chunks, and the old version of re-embedded chunks
+    removed = [
+        chunk_id for chunk_id in indexed if chunk_id not in embedded
+    ]
+    removed.extend(row[0] for row in added if row[0] in indexed)
+    return removed, added, list(embedded.values())
+
+
+def load_existing_index(store, path, model, mode, fields, n_vectors):
+    # index at path if it can be updated in place, else None
+    version = store.get_index_version(path)
+    if version is None or version[0] != model or not os.path.exists(path):
+        return None, None
+    _, params = store.get_index_params(path)
+    params = params_from_str(params)
+    if get_fields(params) != (fields, FIELD_STRIDE):
+        return None, None
+    if resolve_mode(mode, n_vectors) != params["type"]:
+        return None, None
+    if needs_rebuild(params, n_vectors):
+        return None, None
+    index = faiss.read_index(path)
+    if not is_chunk_keyed(index):
+        return None, None
+    if index.ntotal != version[2]:
+        # index file and its record in the db disagree
+        return None, None
+    return index, params
+
+
+def update_index(
+    store,
+    path=CHG_PROJ_FAISS,
+    model=CHG_EMBED_MODEL,
+    mode=None,
+    fields=FIELDS,
+    rebuild=False,
+):
+    # add new chunks, replace re-embedded ones and drop deleted ones in place
+    # mode: one of INDEX_MODES, None keeps the mode the index was built with
+    # fields: embeddings indexed for each chunk (all searched at once)
+    if mode is None:
+        prev = store.get_index_params(path)
+        mode = "auto" if prev is None or prev[0] is None else prev[0]
+    fields = list(fields)
+    removed, added, embedded = get_index_changes(store, path, model)
+    n_vectors = len(embedded) * len(fields)
+    index, params = None, None
+    if not rebuild:
+        index, params = load_existing_index(
+            store, path, model, mode, fields, n_vectors
+        )
+    if index is not None and len(removed) > 0 and not supports_remove(params):
+        index = None
+
+    rebuilt = index is None
+    if rebuilt:
+        removed, added = [], embedded
+        dim = store.vectors.info()[0] or 0
+        params = get_params(resolve_mode(mode, n_vectors), dim, n_vectors)
+        params["fields"] = fields
+        index = create_index(params, dim)
+    elif len(removed) == 0 and len(added) == 0:
+        set_search_params(index, params)
+        return index, 0, 0
+
+    rows = [row[1] for row in added]
+    chunk_ids = [row[0] for row in added]
+    mats = [
+        normalize_vectors(store.vectors.get(f, rows)).astype(np.float32)
+        for f in fields
+    ]
+    ids = [to_vector_ids(chunk_ids, i) for i in range(len(fields))]
+    train_index(index, np.vstack(mats), params)
+    if len(removed) > 0:
+        index.remove_ids(
+            np.concatenate([
+                to_vector_ids(removed, i) for i in range(len(fields))
+            ])
+        )
+    if len(added) > 0:
+        index.add_with_ids(np.vstack(mats), np.concatenate(ids))
+    set_search_params(index, params)
+    save_index(index, path)
+    store.record_index_update(
+        path,
+        model,
+        removed,
+        [(row[0], row[2], row[3]) for row in added],
+        index.ntotal,
+        mode=mode,
+        params=params_to_str(params),
+        rebuilt=rebuilt,
+    )
+    return index, len(removed), len(added)
 
 
 def embed_query(model, query):
     return model.embed_nl(query)
 
 
-def load_index():
-    return faiss.read_index(CHG_PROJ_FAISS)
+def load_index(store, path=CHG_PROJ_FAISS):
+    # index and its parameters
+    index = faiss.read_index(path)
+    if not is_chunk_keyed(index) or store.get_index_version(path) is None:
+        # written by an older version, its hits would map to the wrong chunks
+        if len(store.get_embedding_rows()) == 0:
+            raise ValueError(
+                "Search index at {} is in an old format, "
+                "run chg-to-index to rebuild it".format(path)
+            )
+        print("Rebuilding search index at", path, "(old format)")
+        index, _, _ = update_index(store, path, rebuild=True)
+    # search parameters (e.g. nprobe) as saved when built
+    prev = store.get_index_params(path)
+    params = params_from_str(None if prev is None else prev[1])
+    set_search_params(index, params)
+    return index, params
+
+
+def combine_fields(D, ix, fields, weights, stride=FIELD_STRIDE):
+    # chunk ids, best combined score first
+    return [chunk_id for chunk_id, _ in
+            combine_fields_scored(D, ix, fields, weights, stride=stride)]
+
+
+def combine_fields_scored(D, ix, fields, weights, stride=FIELD_STRIDE):
+    # weighted sum of each field's similarity, per chunk. A field that
+    # wasn't retrieved counts as the lowest similarity retrieved
+    valid = ix >= 0
+    if not valid.any():
+        return []
+    floor = D[valid].min()
+    scores = {}
+    for score, _id in zip(D[valid], ix[valid]):
+        chunk_id, field_ix = divmod(int(_id), stride)
+        if chunk_id not in scores:
+            scores[chunk_id] = np.full(len(fields), floor)
+        scores[chunk_id][field_ix] = score
+    w = np.array([weights.get(f, 0.0) for f in fields])
+    totals = {chunk_id: float(np.dot(w, s)) for chunk_id, s in scores.items()}
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+
+def get_selector(chunk_ids, n_fields, stride=FIELD_STRIDE):
+    # faiss ids of all fields' vectors for chunk_ids
+    ids = np.concatenate([
+        to_vector_ids(chunk_ids, i, stride=stride) for i in range(n_fields)
+    ])
+    return faiss.IDSelectorBatch(ids)
+
+
+def run_queries(
+    index,
+    embeddings,
+    k,
+    fields=FIELDS,
+    weights=DEFAULT_FIELD_WEIGHTS,
+    stride=FIELD_STRIDE,
+    chunk_ids=None,
+    params=None,
+):
+    # one (matrix) search over all fields' vectors for all queries
+    # chunk_ids: only search these chunks, applied inside faiss
+    # params: index parameters (for search parameters used with a filter)
+    results = run_queries_scored(
+        index,
+        embeddings,
+        k,
+        fields=fields,
+        weights=weights,
+        stride=stride,
+        chunk_ids=chunk_ids,
+        params=params,
+    )
+    return [[chunk_id for chunk_id, _ in scored] for scored in results]
+
+
+def run_queries_scored(
+    index,
+    embeddings,
+    k,
+    fields=FIELDS,
+    weights=DEFAULT_FIELD_WEIGHTS,
+    stride=FIELD_STRIDE,
+    chunk_ids=None,
+    params=None,
+):
+    # as run_queries, but (chunk id, combined similarity) for each result
+    if chunk_ids is not None and len(chunk_ids) == 0:
+        return [[] for _ in embeddings]
+    embeddings = normalize_vectors(embeddings).astype(np.float32)
+    n = k if len(fields) == 1 else k * len(fields) * OVERSAMPLE
+    search_params = None
+    if chunk_ids is not None:
+        selector = get_selector(chunk_ids, len(fields), stride=stride)
+        selectivity = len(chunk_ids) * len(fields) / max(index.ntotal, 1)
+        search_params = get_search_params(
+            params or {"type": "flat"},
+            selector,
+            selectivity=selectivity,
+        )
+    D, ix = index.search(embeddings, n, params=search_params)
+    # -1 if fewer than k vectors
+    return [
+        combine_fields_scored(d, i, fields, weights, stride=stride)[:k]
+        for d, i in zip(D, ix)
+    ]
 
 
-def run_query(index, embedding, k):
+def exact_scores(
+    vectors,
+    rows,
+    embeddings,
+    fields=FIELDS,
+    weights=DEFAULT_FIELD_WEIGHTS,
+):
+    # combined similarity of each query (matrix row) to the stored
+    # vectors at rows of a VectorStore (columns), every field included
+    embeddings = normalize_vectors(embeddings).astype(np.float32)
+    totals = np.zeros((len(embeddings), len(rows)), dtype=np.float32)
+    for f in fields:
+        mat = normalize_vectors(vectors.get(f, rows))
+        totals += weights.get(f, 0.0) * (embeddings @ mat.astype(np.float32).T)
+    return totals
+
+
+def exact_search_scored(
+    store,
+    embeddings,
+    k,
+    chunk_ids,
+    fields=FIELDS,
+    weights=DEFAULT_FIELD_WEIGHTS,
+    model=CHG_EMBED_MODEL,
+):
+    # (chunk id, combined similarity) lists as run_queries_scored, but
+    # brute force over chunk_ids' stored vectors: no result allowed by a
+    # restrictive filter is missed, as it can be by hnsw or ivf
+    rows = store.get_embedding_rows_by_chunk_ids(chunk_ids, model=model)
+    if len(rows) == 0:
+        return [[] for _ in embeddings]
+    found_ids = np.array([chunk_id for chunk_id, _ in rows])
+    totals = exact_scores(
+        store.vectors,
+        [r for _, r in rows],
+        embeddings,
+        fields=fields,
+        weights=weights,
+    )
+    results = []
+    for scores in totals:
+        top = np.argsort(-scores, kind="stable")[:k]
+        results.append([
+            (int(found_ids[i]), float(scores[i])) for i in top
+        ])
+    return results
+
+
+def run_query(
+    index,
+    embedding,
+    k,
+    fields=FIELDS,
+    weights=DEFAULT_FIELD_WEIGHTS,
+    stride=FIELD_STRIDE,
+    chunk_ids=None,
+    params=None,
+):
     # make sure row vector
     embedding = embedding.reshape(1, -1)
-    embedding = normalize_vectors(embedding).astype(np.float32)
-    D, ix = index.search(embedding, k)
-    return ix.flatten()
+    return run_queries(
+        index,
+        embedding,
+        k,
+        fields=fields,
+        weights=weights,
+        stride=stride,
+        chunk_ids=chunk_ids,
+        params=params,
+    )[0]
+
 
+def lookup_in_store(store, chunk_ids, scores=None):
+    # SearchResult for each matching chunk, best match first
+    if len(chunk_ids) == 0:
+        return []
+    return store.get_search_results(chunk_ids, scores=scores)
 
-def lookup_in_store(store, ixs):
-    # ixs are offset by 1 as ids in the database
-    ids = ixs + 1
-    return store.get_dialogue_by_ids(ids)
+
+def lookup_many_in_store(store, chunk_id_lists, score_lists=None):
+    # one round trip for all queries' matches
+    all_ids = sorted(set(i for chunk_ids in chunk_id_lists for i in chunk_ids))
+    if len(all_ids) == 0:
+        return [[] for _ in chunk_id_lists]
+    by_chunk = {r.chunk_id: r for r in store.get_search_results(all_ids)}
+    if score_lists is None:
+        score_lists = [[None] * len(chunk_ids) for chunk_ids in chunk_id_lists]
+    results = []
+    for chunk_ids, scores in zip(chunk_id_lists, score_lists):
+        found = [(by_chunk[i], score) for i, score in zip(chunk_ids, scores)
+                 if i in by_chunk]
+        results.append([
+            r._replace(rank=rank, score=score)
+            for rank, (r, score) in enumerate(found)
+        ])
+    return results
+
+
+def get_cache_mode(mode, model_id, fields, weights):
+    # part of the result cache key: results depend on the query
+    # embedder and on how the fields' similarities are weighted
+    return "{};{};{}".format(
+        mode,
+        model_id,
+        ",".join("{}={}".format(f, weights.get(f)) for f in fields),
+    )
 
 
 class EmbeddedSearcher(object):
-    def __init__(self):
-        self.embed_model = BasicEmbedder()
+    def __init__(
+        self,
+        backend="torch",
+        weights=DEFAULT_FIELD_WEIGHTS,
+        cache=None,
+    ):
+        # uses embedding service if running
+        self.embed_model = get_embedder(backend=backend)
+        self.model_id = get_model_id(backend)
+        self.weights = weights
+        # ResultCache for repeated queries (None: no caching)
+        self.cache = cache
         self.store = get_store()
-        self.faiss_index = load_index()
+        self.set_index(*load_index(self.store))
+        # embeddings the index was built from, for exact filtered search
+        version = self.store.get_index_version(CHG_PROJ_FAISS)
+        self.model = CHG_EMBED_MODEL if version is None else version[0]
+
+    def set_index(self, faiss_index, params):
+        # swap in a (re)loaded index
+        self.faiss_index = faiss_index
+        self.params = params
+        self.fields, self.stride = get_fields(params)
+        self.cache_mode = get_cache_mode(
+            "vector", self.model_id, self.fields, self.weights
+        )
+
+    def run_queries_(self, vectors, k, search_filter=None):
+        # (chunk id, similarity) lists, one per query
+        chunk_ids = None
+        if search_filter is not None:
+            chunk_ids = search_filter.chunk_ids(self.store)
+        if chunk_ids is not None and len(chunk_ids) <= EXACT_FILTER_MAX_CHUNKS:
+            return exact_search_scored(
+                self.store,
+                vectors,
+                k,
+                chunk_ids,
+                fields=self.fields,
+                weights=self.weights,
+                model=self.model,
+            )
+        return run_queries_scored(
+            self.faiss_index,
+            vectors,
+            k,
+            fields=self.fields,
+            weights=self.weights,
+            stride=self.stride,
+            chunk_ids=chunk_ids,
+            params=self.params,
+        )
+
+    def search_chunk_ids(self, query, k=5, search_filter=None, scores=None):
+        # search_filter: SearchFilter (None: all chunks)
+        # scores: dict filled with chunk id -> similarity
+        assert k > 0
+        mode = self.cache_mode
+        if search_filter is not None and not search_filter.is_empty():
+            mode += ";" + search_filter.describe()
+
+        def search_fn(query, k):
+            vector = embed_query(self.embed_model, query).reshape(1, -1)
+            return self.run_queries_(vector, k, search_filter)[0]
 
-    def search(self, query, k=5):
-        vector = embed_query(self.embed_model, query)
+        scored = cached_search(
+            self.cache, self.store, query, k, mode, search_fn
+        )
+        if scores is not None:
+            scores.update(scored)
+        return [chunk_id for chunk_id, _ in scored]
+
+    def search(self, query, k=5, search_filter=None):
+        scores = {}
+        chunk_ids = self.search_chunk_ids(query, k, search_filter, scores)
+        return lookup_in_store(
+            self.store,
+            chunk_ids,
+            [scores.get(i) for i in chunk_ids],
+        )
+
+    def search_scored_many(self, queries, k=5, search_filter=None):
         assert k > 0
-        ixs = run_query(self.faiss_index, vector, k)
-        return lookup_in_store(self.store, ixs)
+        if len(queries) == 0:
+            return []
+        vectors = self.embed_model.embed_nl_batch(list(queries))
+        return self.run_queries_(vectors, k, search_filter)
+
+    def search_chunk_ids_many(self, queries, k=5, search_filter=None):
+        scored_lists = self.search_scored_many(queries, k, search_filter)
+        return [[chunk_id for chunk_id, _ in scored] for scored in scored_lists]
+
+    def search_many(self, queries, k=5, search_filter=None):
+        # results for each query: batched embedding, search and lookup
+        scored_lists = self.search_scored_many(queries, k, search_filter)
+        return lookup_many_in_store(
+            self.store,
+            [[chunk_id for chunk_id, _ in scored] for scored in scored_lists],
+            [[score for _, score in scored] for scored in scored_lists],
+        )
 
 
 def build(args):
     assert args.action == "build"
-    mat = load_vectors()
-    index = build_index(mat)
-    faiss.write_index(index, CHG_PROJ_FAISS)
+    store = get_store()
+    start = time.time()
+    index, n_removed, n_added = update_index(
+        store,
+        model=args.model,
+        mode=args.mode,
+        fields=args.fields,
+        rebuild=args.rebuild,
+    )
+    params = params_from_str(store.get_index_params(CHG_PROJ_FAISS)[1])
+    print(
+        "{} index has {} vectors ({} chunks added, {} removed in {:.3f}s)".format(
+            params["type"],
+            index.ntotal,
+            n_added,
+            n_removed,
+            time.time() - start,
+        )
+    )
+
+
+def build_in_memory(mode, mat, chunk_ids):
+    params = get_params(resolve_mode(mode, len(mat)), mat.shape[1], len(mat))
+    index = create_index(params, mat.shape[1])
+    train_index(index, mat, params)
+    index.add_with_ids(mat, np.array(chunk_ids, dtype=np.int64))
+    set_search_params(index, params)
+    return index, params
+
+
+def evaluate_modes(store, modes, model=CHG_EMBED_MODEL, k=10, n_queries=200):
+    # recall@k of each mode against exact search, using
+    # stored dialogue embeddings as queries
+    chunk_ids, mat = store.get_embedding_matrix("code", model=model)
+    if mat is None:
+        return []
+    mat = normalize_vectors(mat).astype(np.float32)
+    _, queries = store.get_embedding_matrix("nl", model=model)
+    rng = np.random.RandomState(42)
+    sample = rng.choice(len(queries), min(n_queries, len(queries)), replace=False)
+    queries = normalize_vectors(queries[np.sort(sample)]).astype(np.float32)
+
+    exact, _ = build_in_memory("flat", mat, chunk_ids)
+    _, expected = exact.search(queries, k)
+    results = []
+    for mode in modes:
+        start = time.time()
+        index, params = build_in_memory(mode, mat, chunk_ids)
+        build_time = time.time() - start
+        # one query at a time, as when searching interactively
+        latencies = []
+        found = []
+        for query in queries:
+            start = time.time()
+            _, ix = index.search(query.reshape(1, -1), k)
+            latencies.append(time.time() - start)
+            found.append(ix[0])
+        recall = np.mean([
+            len(set(f[f >= 0]) & set(e[e >= 0])) / max(np.sum(e >= 0), 1)
+            for f, e in zip(found, expected)
+        ])
+        results.append({
+            "mode": mode,
+            "type": params["type"],
+            "recall": recall,
+            "latency_ms": 1000 * np.mean(latencies),
+            "p95_ms": 1000 * np.percentile(latencies, 95),
+            "build_s": build_time,
+            "size_mb": faiss.serialize_index(index).nbytes / 1e6,
+        })
+    return results
+
+
+def evaluate(args):
+    assert args.action == "evaluate"
+    store = get_store()
+    results = evaluate_modes(
+        store,
+        args.modes,
+        model=args.model,
+        k=args.k,
+        n_queries=args.n_queries,
+    )
+    if len(results) == 0:
+        print("No {} embeddings to evaluate".format(args.model))
+        return
+    print(
+        "{:<10} {:<10} {:>10} {:>12} {:>10} {:>10} {:>10}".format(
+            "mode", "type", "recall@" + str(args.k), "latency ms", "p95 ms",
+            "build s", "size MB"
+        )
+    )
+    for r in results:
+        print(
+            "{mode:<10} {type:<10} {recall:>10.3f} {latency_ms:>12.3f} "
+            "{p95_ms:>10.3f} {build_s:>10.2f} {size_mb:>10.1f}".format(**r)
+        )
+
+
+def read_queries(path):
+    # one query per line, blank lines skipped
+    with open(path, "r") as fin:
+        return [line.strip() for line in fin if len(line.strip()) > 0]
+
+
+def write_results_jsonl(fout, queries, results):
+    for query, query_results in zip(queries, results):
+        record = {
+            "query": query,
+            "chunk_ids": [r.chunk_id for r in query_results],
+            "results": [result_to_dict(r) for r in query_results],
+        }
+        fout.write(json.dumps(record) + "\n")
 
 
 def query_from_cli(args):
     assert args.action == "query"
-    searcher = EmbeddedSearcher()
-    return searcher.search(args.query, k=args.k)
+    searcher = EmbeddedSearcher(
+        backend=args.backend,
+        weights=parse_weights(args.weights),
+    )
+    if args.queries_file is None:
+        queries = [args.query]
+    else:
+        queries = read_queries(args.queries_file)
+    results = searcher.search_many(
+        queries,
+        k=args.k,
+        search_filter=get_filter(args),
+    )
+    if args.output is None:
+        write_results_jsonl(sys.stdout, queries, results)
+    else:
+        with open(args.output, "w") as fout:
+            write_results_jsonl(fout, queries, results)
+    return results
 
 
 def get_args():
@@ -85,6 +660,31 @@ def get_args():
 
     build_parser = subparsers.add_parser("build")
     build_parser.set_defaults(action="build")
+    build_parser.add_argument(
+        "--model",
+        type=str,
+        help="Index embeddings computed by this model (and backend)",
+        default=CHG_EMBED_MODEL,
+    )
+    build_parser.add_argument(
+        "--mode",
+        type=str,
+        choices=INDEX_MODES,
+        help="Index type (default: keep current, auto for a new index)",
+    )
+    build_parser.add_argument(
+        "--fields",
+        type=str,
+        nargs="+",
+        choices=FIELDS,
+        help="Embeddings to index for each chunk",
+        default=FIELDS,
+    )
+    build_parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Build index from scratch (default: only apply changes)",
+    )
 
     query_parser = subparsers.add_parser("query")
     query_parser.set_defaults(action="query")
@@ -93,13 +693,72 @@ def get_args():
         type=str,
         help="Query to search with",
     )
+    query_parser.add_argument(
+        "--queries-file",
+        type=str,
+        help="File with one query per line (searched as a batch)",
+    )
+    query_parser.add_argument(
+        "--output",
+        type=str,
+        help="JSONL file for results (default: stdout)",
+    )
     query_parser.add_argument(
         "--k",
         type=int,
         help="Number of records to return for query",
         default=5,
     )
-    parser.set_defaults(action="build")
+    query_parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        help="Backend used to embed the query",
+        default="torch",
+    )
+    query_parser.add_argument(
+        "--weights",
+        type=str,
+        help="Weight of each field's similarity, e.g. code=0.4,nl=0.6",
+        default="code=0.4,nl=0.6",
+    )
+    add_filter_args(query_parser)
+    eval_parser = subparsers.add_parser("evaluate")
+    eval_parser.set_defaults(action="evaluate")
+    eval_parser.add_argument(
+        "--modes",
+        type=str,
+        nargs="+",
+        choices=INDEX_MODES,
+        help="Index types to compare against exact search",
+        default=INDEX_MODES[1:],
+    )
+    eval_parser.add_argument(
+        "--k",
+        type=int,
+        help="Number of neighbours for recall@k",
+        default=10,
+    )
+    eval_parser.add_argument(
+        "--n-queries",
+        type=int,
+        help="Number of stored dialogue embeddings used as queries",
+        default=200,
+    )
+    eval_parser.add_argument(
+        "--model",
+        type=str,
+        help="Evaluate embeddings computed by this model (and backend)",
+        default=CHG_EMBED_MODEL,
+    )
+
+    parser.set_defaults(
+        action="build",
+        model=CHG_EMBED_MODEL,
+        mode=None,
+        fields=FIELDS,
+        rebuild=False,
+    )
     return parser.parse_args()
 
 
@@ -109,6 +768,8 @@ def main():
         build(args)
     elif args.action == "query":
         query_from_cli(args)
+    elif args.action == "evaluate":
+        evaluate(args)
     else:
         raise Exception("Unknown action:", args.action)
 
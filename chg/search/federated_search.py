@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import json
+import os
+import threading
+
+import faiss
+
+from chg.defaults import CHG_EMBED_MODEL
+from chg.db.database import (
+    get_embedding_rows_by_chunk_ids,
+    get_index_params,
+    get_search_results,
+    open_connection,
+)
+from chg.db.vector_store import VectorStore
+from chg.db.migrations import SCHEMA_VERSION, get_schema_version
+from chg.embed.service import get_embedder
+from chg.embed.utils import BACKENDS
+from chg.search.embedded_search import (
+    DEFAULT_FIELD_WEIGHTS,
+    OVERSAMPLE,
+    exact_scores,
+    get_fields,
+    is_chunk_keyed,
+    read_queries,
+    run_queries_scored,
+)
+from chg.search.index_modes import params_from_str, set_search_params
+from chg.search.results import result_to_dict
+
+# repositories kept open (index mapped, database connected) at once
+DEFAULT_MAX_OPEN = 64
+
+
+def read_registry(path):
+    # one repository root per line, blank lines and # comments skipped
+    roots = []
+    with open(path, "r") as fin:
+        for line in fin:
+            line = line.split("#", 1)[0].strip()
+            if len(line) > 0:
+                roots.append(os.path.expanduser(line))
+    return roots
+
+
+def open_readonly(db_path):
+    # never creates or migrates another repository's database
+    return open_connection(db_path, readonly=True)
+
+
+def read_index_mapped(path):
+    # vectors and graph stay in the page cache instead of being copied
+    # into memory (IO_FLAG_MMAP alone only maps some index types)
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if flags is not None:
+        try:
+            return faiss.read_index(path, flags | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # index type without in-place mapping support
+            pass
+    return faiss.read_index(
+        path,
+        faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+    )
+
+
+class RepoIndex(object):
+    """
+    A repository's faiss.db and database, opened on first search and
+    closed again by OpenRepos once it's among the least recently used.
+    The index is memory-mapped, so open ones share the page cache
+    instead of each being read into memory
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.name = os.path.basename(self.root.rstrip("/"))
+        self.index_path = os.path.join(self.root, ".chg", "faiss.db")
+        self.db_path = os.path.join(self.root, ".chg", "db.sqlite3")
+        self.vectors_dir = os.path.join(self.root, ".chg", "vectors")
+        self.conn = None
+        self.vectors = None
+        self.faiss_index = None
+        self.params = None
+        self.model = None
+        # held while opening, searching and closing
+        self.lock = threading.RLock()
+
+    def exists(self):
+        return os.path.exists(self.index_path) and os.path.exists(self.db_path)
+
+    def open(self):
+        with self.lock:
+            if self.faiss_index is not None:
+                return
+            conn = open_readonly(self.db_path)
+            version = get_schema_version(conn)
+            if version < SCHEMA_VERSION:
+                conn.close()
+                raise ValueError(
+                    "{} has schema version {} (need {}), run chg there "
+                    "once to migrate it".format(
+                        self.db_path, version, SCHEMA_VERSION)
+                )
+            self.conn = conn
+            prev = get_index_params(self.conn, self.index_path)
+            cursor = self.conn.cursor()
+            if prev is None:
+                # index built under a different path to the root (e.g. moved)
+                cursor.execute(
+                    "SELECT mode, params FROM IndexVersions "
+                    "ORDER BY updated DESC LIMIT 1"
+                )
+                prev = cursor.fetchone()
+            cursor.execute(
+                "SELECT model FROM IndexVersions ORDER BY updated DESC LIMIT 1"
+            )
+            row = cursor.fetchone()
+            cursor.close()
+            self.model = None if row is None else row[0]
+            self.params = params_from_str(None if prev is None else prev[1])
+            index = read_index_mapped(self.index_path)
+            if prev is None or not is_chunk_keyed(index):
+                # can't rebuild another repository's index read-only
+                raise ValueError(
+                    "{} is in an old format, run chg-to-index there to "
+                    "rebuild it".format(self.index_path)
+                )
+            set_search_params(index, self.params)
+            self.vectors = VectorStore(
+                self.conn,
+                self.vectors_dir,
+                get_reader=lambda: self.conn,
+            )
+            self.faiss_index = index
+
+    def is_open(self):
+        return self.faiss_index is not None
+
+    def close(self):
+        with self.lock:
+            self.faiss_index = None
+            self.vectors = None
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def search(self, vectors, k, weights=DEFAULT_FIELD_WEIGHTS):
+        # (chunk id, similarity) lists, one per query. run_queries_scored
+        # fills fields a chunk wasn't retrieved for with the lowest
+        # similarity this repository retrieved, so its scores aren't
+        # comparable across repositories: candidates are rescored
+        # exactly against their stored vectors instead
+        with self.lock:
+            self.open()
+            fields, stride = get_fields(self.params)
+            candidates = run_queries_scored(
+                self.faiss_index,
+                vectors,
+                k * OVERSAMPLE,
+                fields=fields,
+                weights=weights,
+                stride=stride,
+                params=self.params,
+            )
+            results = []
+            for vector, scored in zip(vectors, candidates):
+                rows = get_embedding_rows_by_chunk_ids(
+                    self.conn,
+                    [chunk_id for chunk_id, _ in scored],
+                    self.model or CHG_EMBED_MODEL,
+                )
+                if len(rows) == 0:
+                    results.append([])
+                    continue
+                totals = exact_scores(
+                    self.vectors,
+                    [row for _, row in rows],
+                    vector.reshape(1, -1),
+                    fields=fields,
+                    weights=weights,
+                )[0]
+                rescored = [
+                    (chunk_id, float(score))
+                    for (chunk_id, _), score in zip(rows, totals)
+                ]
+                rescored.sort(key=lambda item: -item[1])
+                results.append(rescored[:k])
+            return results
+
+    def lookup(self, chunk_ids):
+        if len(chunk_ids) == 0:
+            return []
+        with self.lock:
+            self.open()
+            return get_search_results(self.conn, chunk_ids)
+
+
+class OpenRepos(object):
+    """
+    Bounds how many repositories are open: once more than max_open
+    have been used, the least recently used are closed (and reopened
+    if searched again)
+    """
+    def __init__(self, max_open=DEFAULT_MAX_OPEN):
+        self.max_open = max_open
+        self.repos = OrderedDict()
+        self.lock = threading.Lock()
+
+    def use(self, repo):
+        # call after using repo, without holding its lock
+        with self.lock:
+            self.repos[repo.root] = repo
+            self.repos.move_to_end(repo.root)
+            evicted = []
+            while len(self.repos) > self.max_open:
+                evicted.append(self.repos.popitem(last=False)[1])
+        for old in evicted:
+            # waits for searches of it in progress
+            old.close()
+
+    def __len__(self):
+        return len(self.repos)
+
+
+class FederatedSearcher(object):
+    """
+    Searches many repositories' indexes: the query is embedded once,
+    each index searched in a thread pool (faiss releases the GIL) and
+    the best k chunks across all of them kept
+    """
+    def __init__(
+        self,
+        roots,
+        backend="torch",
+        model=CHG_EMBED_MODEL,
+        weights=DEFAULT_FIELD_WEIGHTS,
+        max_workers=8,
+        max_open=DEFAULT_MAX_OPEN,
+    ):
+        repos = [RepoIndex(r) for r in roots]
+        missing = [r.root for r in repos if not r.exists()]
+        if len(missing) > 0:
+            print("Skipping {} repositories without an index".format(
+                len(missing)))
+        self.repos = [r for r in repos if r.exists()]
+        self.embed_model = get_embedder(backend=backend)
+        self.model = model
+        self.weights = weights
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.open_repos = OpenRepos(max_open)
+
+    def search_repo_(self, repo, vectors, k):
+        try:
+            repo.open()
+            if repo.model is not None and repo.model != self.model:
+                # similarities from different models aren't comparable
+                return [[] for _ in vectors]
+            return repo.search(vectors, k, weights=self.weights)
+        finally:
+            self.open_repos.use(repo)
+
+    def lookup_repo_(self, repo, chunk_ids):
+        try:
+            return repo.lookup(chunk_ids)
+        finally:
+            self.open_repos.use(repo)
+
+    def search_chunk_ids_many(self, queries, k=5):
+        # (repo, chunk id, similarity) lists, best first, one per query
+        assert k > 0
+        if len(queries) == 0:
+            return []
+        vectors = self.embed_model.embed_nl_batch(list(queries))
+        futures = [
+            (repo, self.pool.submit(self.search_repo_, repo, vectors, k))
+            for repo in self.repos
+        ]
+        merged = [[] for _ in queries]
+        for repo, future in futures:
+            try:
+                results = future.result()
+            except Exception as err:
+                print("Failed to search {}: {}".format(repo.root, err))
+                continue
+            for i, scored in enumerate(results):
+                merged[i].extend(
+                    (repo, chunk_id, score) for chunk_id, score in scored
+                )
+        return [
+            heapq.nlargest(k, candidates, key=lambda c: c[2])
+            for candidates in merged
+        ]
+
+    def search_many(self, queries, k=5):
+        # (repo root, SearchResult) for each query's matches, best first
+        ranked_lists = self.search_chunk_ids_many(queries, k)
+        # one lookup per repository
+        wanted = {}
+        for ranked in ranked_lists:
+            for repo, chunk_id, _ in ranked:
+                wanted.setdefault(repo, set()).add(chunk_id)
+        by_chunk = {}
+        for repo, chunk_ids in wanted.items():
+            for r in self.lookup_repo_(repo, sorted(chunk_ids)):
+                by_chunk[(repo.root, r.chunk_id)] = r
+        results = []
+        for ranked in ranked_lists:
+            found = [
+                (repo.root, by_chunk[(repo.root, chunk_id)], score)
+                for repo, chunk_id, score in ranked
+                if (repo.root, chunk_id) in by_chunk
+            ]
+            results.append([
+                (root, r._replace(rank=rank, score=score))
+                for rank, (root, r, score) in enumerate(found)
+            ])
+        return results
+
+    def search(self, query, k=5):
+        return self.search_many([query], k)[0]
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Search the indexes of many repositories at once",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--repos",
+        type=str,
+        nargs="+",
+        help="Repository roots (each with a .chg folder)",
+    )
+    parser.add_argument(
+        "--registry",
+        type=str,
+        help="File with one repository root per line",
+    )
+    parser.add_argument("--query", type=str, help="Query to search with")
+    parser.add_argument(
+        "--queries-file",
+        type=str,
+        help="File with one query per line, searched as a batch",
+    )
+    parser.add_argument(
+        "--k",
+        type=int,
+        help="Number of chunks to return across all repositories",
+        default=5,
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        help="Backend used to embed the query",
+        default="torch",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Repositories searched in parallel",
+        default=8,
+    )
+    parser.add_argument(
+        "--max-open",
+        type=int,
+        help="Repositories kept open between searches",
+        default=DEFAULT_MAX_OPEN,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    roots = list(args.repos or [])
+    if args.registry is not None:
+        roots.extend(read_registry(args.registry))
+    if len(roots) == 0:
+        raise ValueError("Need --repos or --registry")
+    searcher = FederatedSearcher(
+        roots,
+        backend=args.backend,
+        max_workers=args.workers,
+        max_open=args.max_open,
+    )
+    if args.queries_file is not None:
+        queries = read_queries(args.queries_file)
+    else:
+        queries = [args.query]
+    for query, results in zip(queries, searcher.search_many(queries, args.k)):
+        for root, result in results:
+            record = {"query": query, "repo": root}
+            record.update(result_to_dict(result))
+            print(json.dumps(record))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as err:
+        import pdb
+        pdb.post_mortem()
@@ -0,0 +1,135 @@
+import datetime
+import json
+
+from chg.platform import git
+
+
+def parse_date(s, end_of_day=False):
+    # ISO date (or datetime) to seconds since epoch, local time
+    if s is None:
+        return None
+    date = datetime.datetime.fromisoformat(s)
+    if end_of_day and len(s) == 10:
+        # a date alone includes that whole day
+        date += datetime.timedelta(days=1, microseconds=-1)
+    return date.timestamp()
+
+
+class SearchFilter(object):
+    """
+    Restricts search to chunks that touch some path (glob or directory),
+    were committed in a date range, or are in a commit range
+    (since_commit..until_commit, as in git log)
+    """
+    def __init__(
+        self,
+        paths=None,
+        since=None,
+        until=None,
+        since_commit=None,
+        until_commit=None,
+    ):
+        self.paths = None if paths is None or len(paths) == 0 else list(paths)
+        self.since = since
+        self.until = until
+        self.since_commit = since_commit
+        self.until_commit = until_commit
+        # (content and commit range version, chunk ids) last resolved
+        self.resolved = None
+
+    def is_empty(self):
+        return all(
+            v is None for v in [
+                self.paths,
+                self.since,
+                self.until,
+                self.since_commit,
+                self.until_commit,
+            ]
+        )
+
+    def as_dict(self):
+        # SearchFilter(**f.as_dict()) is the same filter
+        return {
+            "paths": self.paths,
+            "since": self.since,
+            "until": self.until,
+            "since_commit": self.since_commit,
+            "until_commit": self.until_commit,
+        }
+
+    def describe(self):
+        # part of the result cache key
+        return json.dumps([
+            self.paths,
+            self.since,
+            self.until,
+            self.since_commit,
+            self.until_commit,
+        ])
+
+    def chunk_ids(self, store):
+        # ids of chunks that pass, None if no filter
+        if self.is_empty():
+            return None
+        version = store.get_content_version()
+        has_range = self.since_commit is not None or \
+            self.until_commit is not None
+        if has_range:
+            # refs (e.g. main~10..main) move with new commits
+            ends = [self.until_commit or "HEAD"]
+            if self.since_commit is not None:
+                ends.append(self.since_commit)
+            version = (version, git.rev_parse(ends))
+        if self.resolved is not None and self.resolved[0] == version:
+            return self.resolved[1]
+        commits = None
+        if has_range:
+            commits = git.rev_list(self.since_commit, self.until_commit)
+        chunk_ids = store.filter_chunk_ids(
+            path_globs=self.paths,
+            since=parse_date(self.since),
+            until=parse_date(self.until, end_of_day=True),
+            commits=commits,
+        )
+        self.resolved = (version, chunk_ids)
+        return chunk_ids
+
+
+def add_filter_args(parser):
+    parser.add_argument(
+        "--path",
+        type=str,
+        nargs="+",
+        help="Only chunks touching these paths (globs or directories)",
+    )
+    parser.add_argument(
+        "--since",
+        type=str,
+        help="Only chunks committed on or after this date (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--until",
+        type=str,
+        help="Only chunks committed on or before this date (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--since-commit",
+        type=str,
+        help="Only chunks from commits after this one",
+    )
+    parser.add_argument(
+        "--until-commit",
+        type=str,
+        help="Only chunks from commits up to this one (default: HEAD)",
+    )
+
+
+def get_filter(args):
+    return SearchFilter(
+        paths=args.path,
+        since=args.since,
+        until=args.until,
+        since_commit=args.since_commit,
+        until_commit=args.until_commit,
+    )
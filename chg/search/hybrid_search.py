@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import re
+
+from chg.db.database import get_store
+from chg.db.vector_store import FIELDS
+from chg.embed.utils import BACKENDS, get_model_id
+from chg.search.embedded_search import (
+    DEFAULT_FIELD_WEIGHTS,
+    EmbeddedSearcher,
+    get_cache_mode,
+    lookup_in_store,
+)
+from chg.search.filters import add_filter_args, get_filter
+from chg.search.result_cache import cached_search, get_result_cache
+from chg.search.results import format_result
+from chg.search import service as search_service
+
+SEARCH_MODES = ["hybrid", "vector", "lexical"]
+
+# words, paths, dotted names, ticket numbers (e.g. ABC-123, #42)
+TERM_REGEX = re.compile(r"#?\w+(?:[./:\-#]\w+)*")
+# candidates taken from each ranked list before fusing
+CANDIDATES_PER_LIST = 50
+# reciprocal rank fusion constant (Cormack et al. 2009)
+RRF_K = 60
+
+
+def to_match_expression(query):
+    # each term quoted, so punctuation can't be read as fts5 syntax,
+    # and OR'ed, so bm25 ranks partial matches too
+    terms = TERM_REGEX.findall(query)
+    return " OR ".join('"{}"'.format(t.replace('"', '""')) for t in terms)
+
+
+def looks_like_identifier(query):
+    # single token with code-like shape: CamelCase, snake_case,
+    # a path, a dotted name or a number
+    query = query.strip()
+    if len(query) == 0 or re.search(r"\s", query):
+        return False
+    return re.search(r"[_./#:\-\d]|[a-z][A-Z]", query) is not None
+
+
+def reciprocal_rank_fusion(ranked_lists, k=RRF_K, scores=None):
+    # scores: dict filled with id -> fused score
+    totals = {}
+    for ranked in ranked_lists:
+        for rank, _id in enumerate(ranked):
+            totals[_id] = totals.get(_id, 0.0) + 1.0 / (k + rank + 1)
+    if scores is not None:
+        scores.update(totals)
+    return sorted(totals, key=lambda _id: -totals[_id])
+
+
+class LexicalSearcher(object):
+    def __init__(self, store=None):
+        self.store = get_store() if store is None else store
+
+    def search_chunk_ids(self, query, k=5, chunk_ids=None):
+        # ranked lists of chunk ids: matches in code, matches in answers
+        # chunk_ids: only consider these chunks (None: all)
+        match = to_match_expression(query)
+        if len(match) == 0:
+            return [], []
+        return self.store.search_text(match, k, chunk_ids=chunk_ids)
+
+
+class HybridSearcher(object):
+    def __init__(
+        self,
+        backend="torch",
+        mode="hybrid",
+        cache=None,
+        search_filter=None,
+    ):
+        if mode not in SEARCH_MODES:
+            raise ValueError("Unknown search mode:", mode)
+        self.store = get_store()
+        self.backend = backend
+        self.mode = mode
+        # part of the result cache key. Vector results, and so fused
+        # ones, depend on the query embedder and field weights
+        self.cache_mode = mode
+        if mode != "lexical":
+            self.cache_mode = get_cache_mode(
+                mode, get_model_id(backend), FIELDS, DEFAULT_FIELD_WEIGHTS
+            )
+        # ResultCache for repeated queries (None: no caching)
+        self.cache = cache
+        # SearchFilter applied when a query doesn't pass its own
+        self.search_filter = search_filter
+        self.lexical = LexicalSearcher(self.store)
+        # loaded on first query that needs it
+        self.vector = None
+
+    def get_vector_searcher(self):
+        if self.vector is None:
+            # uses search service if running
+            self.vector = search_service.connect(backend=self.backend)
+        if self.vector is None:
+            self.vector = EmbeddedSearcher(backend=self.backend)
+        return self.vector
+
+    def search_chunk_ids(self, query, k=5, search_filter=None, scores=None):
+        # search_filter: SearchFilter (None: searcher's default filter)
+        # scores: dict filled with chunk id -> fused score
+        search_filter = search_filter or self.search_filter
+        mode = self.cache_mode
+        if search_filter is not None and not search_filter.is_empty():
+            mode += ";" + search_filter.describe()
+
+        def search_fn(query, k):
+            fused = {}
+            chunk_ids = self.search_chunk_ids_(query, k, search_filter, fused)
+            return [(chunk_id, fused.get(chunk_id)) for chunk_id in chunk_ids]
+
+        scored = cached_search(
+            self.cache, self.store, query, k, mode, search_fn
+        )
+        if scores is not None:
+            scores.update(scored)
+        return [chunk_id for chunk_id, _ in scored]
+
+    def search_chunk_ids_(self, query, k, search_filter=None, scores=None):
+        n = max(k, CANDIDATES_PER_LIST)
+        ranked_lists = []
+        if self.mode != "vector":
+            chunk_ids = None
+            if search_filter is not None:
+                chunk_ids = search_filter.chunk_ids(self.store)
+            ranked_lists.extend(
+                self.lexical.search_chunk_ids(query, n, chunk_ids=chunk_ids)
+            )
+            found = any(len(r) > 0 for r in ranked_lists)
+            identifier = found and looks_like_identifier(query)
+            if self.mode == "lexical" or identifier:
+                # exact identifier hits, no need to embed the query
+                return reciprocal_rank_fusion(ranked_lists, scores=scores)[:k]
+        vector = self.get_vector_searcher()
+        ranked_lists.append(
+            vector.search_chunk_ids(query, n, search_filter=search_filter)
+        )
+        return reciprocal_rank_fusion(ranked_lists, scores=scores)[:k]
+
+    def search(self, query, k=5, search_filter=None):
+        assert k > 0
+        scores = {}
+        chunk_ids = self.search_chunk_ids(query, k, search_filter, scores)
+        return lookup_in_store(
+            self.store,
+            chunk_ids,
+            [scores.get(i) for i in chunk_ids],
+        )
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Search chunks by keywords, embeddings or both",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--query", type=str, help="Query to search with")
+    parser.add_argument(
+        "--k",
+        type=int,
+        help="Number of chunks to return for query",
+        default=5,
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        choices=SEARCH_MODES,
+        help="Search mode",
+        default="hybrid",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        help="Backend used to embed the query",
+        default="torch",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't reuse or save results of previous queries",
+    )
+    add_filter_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    cache = None if args.no_cache else get_result_cache()
+    searcher = HybridSearcher(
+        backend=args.backend,
+        mode=args.mode,
+        cache=cache,
+        search_filter=get_filter(args),
+    )
+    for result in searcher.search(args.query, k=args.k):
+        print(format_result(result))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as err:
+        import pdb
+        pdb.post_mortem()
@@ -0,0 +1,145 @@
+import json
+import math
+
+import faiss
+import numpy as np
+
+INDEX_MODES = ["auto", "flat", "hnsw", "ivf-flat", "ivf-pq"]
+
+# auto mode: exact search below this many chunks
+FLAT_MAX_VECTORS = 50000
+# auto mode: compress vectors above this many chunks
+IVF_FLAT_MAX_VECTORS = 1000000
+# retrain ivf centroids once the corpus has grown this much
+RETRAIN_GROWTH = 4
+# training points per ivf centroid
+TRAIN_POINTS_PER_LIST = 256
+# most hnsw candidates visited when searching with a filter
+FILTERED_EF_SEARCH_MAX = 4096
+
+
+def choose_mode(n_vectors):
+    # hnsw can't remove vectors in place, so only used if requested
+    if n_vectors <= FLAT_MAX_VECTORS:
+        return "flat"
+    elif n_vectors <= IVF_FLAT_MAX_VECTORS:
+        return "ivf-flat"
+    else:
+        return "ivf-pq"
+
+
+def resolve_mode(mode, n_vectors):
+    return choose_mode(n_vectors) if mode == "auto" else mode
+
+
+def get_params(mode, dim, n_vectors):
+    # construction and search parameters, saved along with the index
+    params = {"type": mode, "trained_on": n_vectors}
+    if mode == "hnsw":
+        params.update({"M": 32, "efConstruction": 80, "efSearch": 64})
+    elif mode in ["ivf-flat", "ivf-pq"]:
+        # at least 39 training points per list (faiss warns otherwise)
+        nlist = int(4 * math.sqrt(max(n_vectors, 1)))
+        nlist = max(1, min(nlist, n_vectors // 39))
+        params.update({"nlist": nlist, "nprobe": min(nlist, 16)})
+    if mode == "ivf-pq":
+        # bytes per vector: largest divisor of dim up to 64
+        m = max(i for i in range(1, min(dim, 64) + 1) if dim % i == 0)
+        # pq codebooks also want 39 training points per centroid
+        nbits = max(1, min(8, int(math.log2(max(n_vectors // 39, 2)))))
+        params.update({"m": m, "nbits": nbits})
+    return params
+
+
+def create_index(params, dim):
+    # faiss ids are chunk ids
+    mode = params["type"]
+    metric = faiss.METRIC_INNER_PRODUCT
+    if mode == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif mode == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["M"], metric)
+        index.hnsw.efConstruction = params["efConstruction"]
+    elif mode == "ivf-flat":
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, params["nlist"], metric)
+    elif mode == "ivf-pq":
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(
+            quantizer,
+            dim,
+            params["nlist"],
+            params["m"],
+            params["nbits"],
+            metric,
+        )
+    else:
+        raise ValueError("Unknown index mode:", mode)
+    return faiss.IndexIDMap2(index)
+
+
+def supports_remove(params):
+    return params["type"] != "hnsw"
+
+
+def needs_rebuild(params, n_vectors):
+    # ivf centroids trained on a much smaller corpus
+    if params["type"] not in ["ivf-flat", "ivf-pq"]:
+        return False
+    return n_vectors > RETRAIN_GROWTH * max(params["trained_on"], 1)
+
+
+def train_index(index, mat, params, seed=42):
+    if index.is_trained:
+        return
+    n_train = TRAIN_POINTS_PER_LIST * max(
+        params.get("nlist", 1),
+        2**params.get("nbits", 0),
+    )
+    if len(mat) > n_train:
+        rng = np.random.RandomState(seed)
+        mat = mat[np.sort(rng.choice(len(mat), n_train, replace=False))]
+    index.train(np.ascontiguousarray(mat, dtype=np.float32))
+
+
+def set_search_params(index, params):
+    inner = faiss.downcast_index(index.index)
+    if params["type"] == "hnsw":
+        inner.hnsw.efSearch = params["efSearch"]
+    elif params["type"] in ["ivf-flat", "ivf-pq"]:
+        inner.nprobe = params["nprobe"]
+
+
+def get_search_params(params, selector, selectivity=1.0):
+    # search parameters restricted to ids in selector. hnsw and ivf skip
+    # filtered out vectors while traversing, so with fraction selectivity
+    # of vectors allowed they need to visit proportionally more
+    scale = 1.0 / max(selectivity, 1e-6)
+    if params["type"] == "hnsw":
+        return faiss.SearchParametersHNSW(
+            sel=selector,
+            efSearch=min(
+                int(math.ceil(params["efSearch"] * scale)),
+                FILTERED_EF_SEARCH_MAX,
+            ),
+        )
+    elif params["type"] in ["ivf-flat", "ivf-pq"]:
+        return faiss.SearchParametersIVF(
+            sel=selector,
+            nprobe=min(
+                int(math.ceil(params["nprobe"] * scale)),
+                params["nlist"],
+            ),
+        )
+    return faiss.SearchParameters(sel=selector)
+
+
+def params_to_str(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def params_from_str(s):
+    if s is None:
+        # indices built before modes existed
+        return {"type": "flat", "trained_on": 0}
+    return json.loads(s)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import json
+import threading
+import time
+
+import numpy as np
+
+from chg.defaults import CHG_PROJ_SEARCH_SOCKET
+from chg.search.embedded_search import read_queries
+from chg.search.service import SearchClient
+
+DEFAULT_QUERIES = [
+    "why did we change the database schema",
+    "what does the question ranker do",
+    "how are embeddings cached",
+    "fix for the search index",
+    "what changed in the annotate ui",
+    "why store vectors outside sqlite",
+    "how are commit dates recorded",
+    "what tests cover hybrid search",
+]
+
+
+def run_client(path, queries, n_requests, k, latencies, errors):
+    client = SearchClient(path)
+    try:
+        for i in range(n_requests):
+            start = time.time()
+            try:
+                client.search(queries[i % len(queries)], k=k)
+            except Exception as err:
+                errors.append(str(err))
+                continue
+            latencies.append(time.time() - start)
+    finally:
+        client.close()
+
+
+def run_load(path, queries, concurrency=8, n_requests=100, k=5):
+    # n_requests per client, clients running concurrently
+    latencies = []
+    errors = []
+    monitor = SearchClient(path)
+    stats_before = monitor.stats()
+    threads = [
+        threading.Thread(
+            target=run_client,
+            args=(path, queries[i:] + queries[:i], n_requests, k, latencies,
+                  errors),
+        ) for i in range(concurrency)
+    ]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    stats_after = monitor.stats()
+    monitor.close()
+    n_batches = stats_after["batches"] - stats_before["batches"]
+    n_served = stats_after["requests"] - stats_before["requests"]
+    n_ok = len(latencies)
+    latencies = np.array(latencies) if n_ok > 0 else np.zeros(1)
+    return {
+        "concurrency": concurrency,
+        "requests": n_ok,
+        "errors": len(errors),
+        "throughput_qps": n_ok / elapsed,
+        "p50_ms": 1000 * np.percentile(latencies, 50),
+        "p95_ms": 1000 * np.percentile(latencies, 95),
+        "p99_ms": 1000 * np.percentile(latencies, 99),
+        "mean_batch": n_served / max(n_batches, 1),
+    }
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Concurrent load against a running search service",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        help="Unix socket path",
+        default=CHG_PROJ_SEARCH_SOCKET,
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        help="Number of concurrent clients (one run for each)",
+        default=[1, 8, 32],
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        help="Requests sent by each client",
+        default=100,
+    )
+    parser.add_argument("--k", type=int, help="Results per query", default=5)
+    parser.add_argument(
+        "--queries-file",
+        type=str,
+        help="File with one query per line (default: built-in queries)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write results as JSON lines to this file",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    queries = DEFAULT_QUERIES
+    if args.queries_file is not None:
+        queries = read_queries(args.queries_file)
+    results = []
+    for concurrency in args.concurrency:
+        result = run_load(
+            args.socket,
+            queries,
+            concurrency=concurrency,
+            n_requests=args.requests,
+            k=args.k,
+        )
+        results.append(result)
+        print(
+            "clients={concurrency:<4} qps={throughput_qps:8.1f} "
+            "p50={p50_ms:7.2f}ms p95={p95_ms:7.2f}ms p99={p99_ms:7.2f}ms "
+            "batch={mean_batch:5.1f} errors={errors}".format(**result)
+        )
+    if args.output is not None:
+        with open(args.output, "w") as fout:
+            for result in results:
+                fout.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as err:
+        import pdb
+        pdb.post_mortem()
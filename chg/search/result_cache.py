@@ -0,0 +1,178 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+from chg.defaults import CHG_PROJ_FAISS, CHG_PROJ_RESULT_CACHE
+from chg.embed.cache import normalize_text
+
+
+def normalize_query(query):
+    # "What changed in auth? " and "What changed in  auth" are the same
+    # query. Case is kept: the embedding tokenizer is case-sensitive
+    query = normalize_text(query)
+    query = re.sub(r"\s+", " ", query)
+    return query.rstrip("?.! ")
+
+
+def result_key(query, k, mode):
+    h = hashlib.sha256()
+    for part in [normalize_query(query), str(k), mode]:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def get_search_state(store, path=CHG_PROJ_FAISS):
+    # changes whenever the index is updated or rebuilt, or chunks,
+    # dialogue or embeddings are added to the database
+    version = store.get_index_version(path)
+    stat = os.stat(path) if os.path.exists(path) else None
+    return json.dumps([
+        None if version is None else version[1],
+        None if stat is None else (stat.st_mtime_ns, stat.st_size),
+        store.get_content_version(),
+    ])
+
+
+class ResultCache(object):
+    """
+    Ranked (chunk id, score) pairs for recent queries: in-memory LRU in front of
+    a size-bounded sqlite table on disk. Entries are only valid for the
+    search state (index and database version) they were computed in
+    """
+    def __init__(self, path, max_entries=10000, memory_entries=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.state = None
+        self.conn = sqlite3.connect(path)
+        self._create_table()
+
+    def _create_table(self):
+        stmt = """
+        CREATE TABLE IF NOT EXISTS ResultCache (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            results TEXT,
+            last_used REAL
+        )
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("PRAGMA table_info(ResultCache)")
+        columns = [row[1] for row in cursor.fetchall()]
+        if len(columns) > 0 and "results" not in columns:
+            # written before scores were cached, just a cache so start over
+            cursor.execute("DROP TABLE ResultCache")
+        cursor.execute(stmt)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ResultCacheLastUsed "
+            "ON ResultCache(last_used)"
+        )
+        self.conn.commit()
+        cursor.close()
+
+    def set_state(self, state):
+        # drop results computed against an older index or database
+        if state == self.state:
+            return
+        self.state = state
+        self.memory = OrderedDict()
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM ResultCache WHERE state != ?", (state, ))
+        self.conn.commit()
+        cursor.close()
+
+    def _remember(self, key, results):
+        self.memory[key] = results
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, query, k, mode):
+        # ranked (chunk id, score) pairs, or None if not cached
+        key = result_key(query, k, mode)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT results FROM ResultCache WHERE key = ? AND state = ?",
+            (key, self.state),
+        )
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute(
+                "UPDATE ResultCache SET last_used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self.conn.commit()
+        cursor.close()
+        if row is None:
+            return None
+        results = [tuple(r) for r in json.loads(row[0])]
+        self._remember(key, results)
+        return results
+
+    def put(self, query, k, mode, results):
+        # results: ranked (chunk id, score) pairs, score may be None
+        key = result_key(query, k, mode)
+        results = [
+            (int(i), None if score is None else float(score))
+            for i, score in results
+        ]
+        self._remember(key, results)
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO ResultCache(key, state, results, last_used) "
+            "VALUES(?, ?, ?, ?)",
+            (key, self.state, json.dumps(results), time.time()),
+        )
+        self.conn.commit()
+        cursor.close()
+        self.evict()
+
+    def evict(self):
+        # drop least recently used entries beyond max_entries
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM ResultCache")
+        n = cursor.fetchone()[0]
+        if n > self.max_entries:
+            cursor.execute(
+                """
+                DELETE FROM ResultCache WHERE key IN (
+                    SELECT key FROM ResultCache
+                    ORDER BY last_used LIMIT ?
+                )
+                """,
+                (n - self.max_entries, ),
+            )
+            self.conn.commit()
+        cursor.close()
+
+
+def cached_search(cache, store, query, k, mode, search_fn):
+    # search_fn(query, k) -> ranked (chunk id, score) pairs, only called
+    # on a miss. A hit returns the same pairs the miss did
+    if cache is None:
+        return search_fn(query, k)
+    cache.set_state(get_search_state(store))
+    results = cache.get(query, k, mode)
+    if results is None:
+        results = search_fn(query, k)
+        cache.put(query, k, mode, results)
+        # as a hit would return them
+        results = cache.get(query, k, mode)
+    return results
+
+
+def get_result_cache():
+    cache_dir = os.path.dirname(CHG_PROJ_RESULT_CACHE)
+    if not os.path.exists(cache_dir):
+        print("Creating folder for chg result cache at", cache_dir)
+        os.makedirs(cache_dir)
+    return ResultCache(CHG_PROJ_RESULT_CACHE)
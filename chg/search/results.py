@@ -0,0 +1,33 @@
+import datetime
+
+from chg.db.database import SearchResult
+
+
+def result_to_dict(result):
+    return result._asdict()
+
+
+def result_from_dict(d):
+    d = dict(d)
+    d["dialogue"] = [tuple(qa) for qa in d["dialogue"]]
+    return SearchResult(**d)
+
+
+def format_result(result):
+    # multi-line text for the UIs
+    header = "#{} chunk {}".format(result.rank + 1, result.chunk_id)
+    if result.score is not None:
+        header += " (score {:.3f})".format(result.score)
+    if result.posthash is not None:
+        header += " commit {}".format(result.posthash[:10])
+    if result.commit_date is not None:
+        date = datetime.datetime.fromtimestamp(result.commit_date)
+        header += " on {}".format(date.strftime("%Y-%m-%d"))
+    lines = [header]
+    if len(result.paths) > 0:
+        lines.append("  files: {}".format(", ".join(result.paths)))
+    for question, answer in result.dialogue:
+        lines.append("  {} {}".format(question.strip(), answer))
+    if result.excerpt is not None:
+        lines.extend("  | " + line for line in result.excerpt.split("\n"))
+    return "\n".join(lines)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+from chg.defaults import CHG_PROJ_FAISS, CHG_PROJ_SEARCH_SOCKET
+from chg.embed.service import recv_message, send_message
+from chg.embed.utils import BACKENDS, get_model_id
+from chg.search.embedded_search import (
+    EmbeddedSearcher,
+    load_index,
+    lookup_many_in_store,
+)
+from chg.search.filters import SearchFilter
+from chg.search.results import result_from_dict, result_to_dict
+
+
+class SearchRequest(object):
+    def __init__(self, query, k, search_filter):
+        self.query = query
+        self.k = k
+        self.search_filter = search_filter
+        self.chunk_ids = None
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def index_state(path=CHG_PROJ_FAISS):
+    # changes when the index file is rewritten (saved atomically)
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class QueryBatcher(object):
+    """
+    Owns the searcher: queries that arrive within max_wait of each other
+    (up to max_batch) are embedded in one forward pass, searched
+    together and their dialogue looked up in one query
+    """
+    def __init__(self, backend="torch", max_batch=32, max_wait=0.005):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.searcher = None
+        # (index, params) loaded in the background, swapped in between batches
+        self.pending_index = None
+        self.ready = threading.Event()
+        # raised by start() if the searcher could not be created
+        self.error = None
+        self.stats = {"requests": 0, "batches": 0, "reloads": 0}
+        # shared by handler threads, keeps resolved filter ids memoized
+        self.filters = {}
+        self.filters_lock = threading.Lock()
+
+    def get_filter(self, filter_dict):
+        if filter_dict is None:
+            return None
+        search_filter = SearchFilter(**filter_dict)
+        if search_filter.is_empty():
+            return None
+        key = search_filter.describe()
+        with self.filters_lock:
+            search_filter = self.filters.setdefault(key, search_filter)
+        # a bad date or commit range fails this request, before it can
+        # share a batch with others
+        search_filter.chunk_ids(self.searcher.store)
+        return search_filter
+
+    def submit(self, query, k, filter_dict=None):
+        request = SearchRequest(query, k, self.get_filter(filter_dict))
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise Exception(request.error)
+        return request
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run_batch(self, batch):
+        vectors = self.searcher.embed_model.embed_nl_batch(
+            [r.query for r in batch]
+        )
+        # requests with the same filter are searched together
+        groups = {}
+        for i, r in enumerate(batch):
+            key = None if r.search_filter is None else r.search_filter.describe()
+            groups.setdefault(key, []).append(i)
+        scores = [None] * len(batch)
+        for ixs in groups.values():
+            k = max(batch[i].k for i in ixs)
+            search_filter = batch[ixs[0]].search_filter
+            try:
+                scored_lists = self.searcher.run_queries_(
+                    vectors[ixs],
+                    k,
+                    search_filter,
+                )
+            except Exception as err:
+                # only the requests with this filter fail
+                for i in ixs:
+                    batch[i].error = str(err)
+                continue
+            for i, scored in zip(ixs, scored_lists):
+                scored = scored[:batch[i].k]
+                batch[i].chunk_ids = [chunk_id for chunk_id, _ in scored]
+                scores[i] = [score for _, score in scored]
+        ok = [i for i, r in enumerate(batch) if r.error is None]
+        results = lookup_many_in_store(
+            self.searcher.store,
+            [batch[i].chunk_ids for i in ok],
+            [scores[i] for i in ok],
+        )
+        for i, rows in zip(ok, results):
+            batch[i].results = rows
+
+    def run(self):
+        try:
+            self.searcher = EmbeddedSearcher(backend=self.backend)
+        except Exception as err:
+            # e.g. no index built yet
+            self.error = err
+            return
+        finally:
+            self.ready.set()
+        while True:
+            batch = self.next_batch()
+            if self.pending_index is not None:
+                self.searcher.set_index(*self.pending_index)
+                self.pending_index = None
+                self.stats["reloads"] += 1
+            try:
+                self.run_batch(batch)
+            except Exception as err:
+                for r in batch:
+                    r.error = str(err)
+            self.stats["requests"] += len(batch)
+            self.stats["batches"] += 1
+            for r in batch:
+                r.done.set()
+
+    def watch_index(self, path=CHG_PROJ_FAISS, interval=2.0):
+        # reload the index when rebuilt or updated on disk,
+        # without blocking queries while it is read
+        store = self.searcher.store
+        state = index_state(path)
+        while True:
+            time.sleep(interval)
+            new_state = index_state(path)
+            if new_state is None or new_state == state:
+                continue
+            try:
+                self.pending_index = load_index(store, path)
+                state = new_state
+            except Exception as err:
+                print("Failed to reload index:", err)
+
+    def start(self, path=CHG_PROJ_FAISS, interval=2.0):
+        threading.Thread(target=self.run, daemon=True).start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        threading.Thread(
+            target=self.watch_index,
+            args=(path, interval),
+            daemon=True,
+        ).start()
+
+
+class SearchRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        batcher = self.server.batcher
+        # one json request per line
+        for line in self.rfile:
+            try:
+                # a malformed request gets an error reply, not a hang
+                request = json.loads(line.decode())
+                method = request.get("method")
+                if method == "info":
+                    response = {"model_id": self.server.model_id}
+                elif method == "stats":
+                    response = dict(batcher.stats)
+                elif method == "search":
+                    r = batcher.submit(
+                        request["query"],
+                        request.get("k", 5),
+                        request.get("filter"),
+                    )
+                    response = {
+                        "chunk_ids": [int(i) for i in r.chunk_ids],
+                        "results": [result_to_dict(x) for x in r.results],
+                    }
+                else:
+                    response = {"error": "Unknown method: {}".format(method)}
+            except Exception as err:
+                response = {"error": str(err)}
+            send_message(self.wfile, response)
+
+
+class SearchServer(socketserver.ThreadingUnixStreamServer):
+    """
+    A thread per client connection, queries are handed to a single
+    QueryBatcher
+    """
+    daemon_threads = True
+
+    def __init__(self, path, batcher, model_id):
+        self.batcher = batcher
+        self.model_id = model_id
+        super().__init__(path, SearchRequestHandler)
+
+
+class SearchClient(object):
+    """
+    Same search interface as EmbeddedSearcher, searching done by SearchServer
+    """
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.sock_file = self.sock.makefile("rwb")
+        self.model_id = self.call_({"method": "info"})["model_id"]
+        self.sock.settimeout(None)
+
+    def call_(self, request):
+        send_message(self.sock_file, request)
+        response = recv_message(self.sock_file)
+        if "error" in response:
+            raise Exception("Search service error:", response["error"])
+        return response
+
+    def close(self):
+        self.sock_file.close()
+        self.sock.close()
+
+    def stats(self):
+        return self.call_({"method": "stats"})
+
+    def search_(self, query, k, search_filter):
+        request = {"method": "search", "query": query, "k": k}
+        if search_filter is not None and not search_filter.is_empty():
+            request["filter"] = search_filter.as_dict()
+        return self.call_(request)
+
+    def search_chunk_ids(self, query, k=5, search_filter=None):
+        assert k > 0
+        return self.search_(query, k, search_filter)["chunk_ids"]
+
+    def search(self, query, k=5, search_filter=None):
+        assert k > 0
+        results = self.search_(query, k, search_filter)["results"]
+        return [result_from_dict(d) for d in results]
+
+
+def connect(path=CHG_PROJ_SEARCH_SOCKET, backend="torch"):
+    # client if service is running with the same backend, else None
+    if not os.path.exists(path):
+        return None
+    try:
+        client = SearchClient(path, timeout=1.0)
+    except (OSError, ConnectionError, ValueError):
+        return None
+    if client.model_id != get_model_id(backend):
+        client.close()
+        return None
+    return client
+
+
+def serve(
+    path=CHG_PROJ_SEARCH_SOCKET,
+    backend="torch",
+    max_batch=32,
+    max_wait=0.005,
+    reload_interval=2.0,
+):
+    batcher = QueryBatcher(
+        backend=backend,
+        max_batch=max_batch,
+        max_wait=max_wait,
+    )
+    batcher.start(interval=reload_interval)
+    if os.path.exists(path):
+        # stale socket from a previous run
+        os.remove(path)
+    server = SearchServer(path, batcher, get_model_id(backend))
+    print("Serving search at {}".format(path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def add_serve_args(parser):
+    parser.add_argument(
+        "--socket",
+        type=str,
+        help="Unix socket path",
+        default=CHG_PROJ_SEARCH_SOCKET,
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        help="Backend used to embed queries",
+        default="torch",
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        help="Most queries embedded in one forward pass",
+        default=32,
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        help="How long a query waits for others to batch with",
+        default=5.0,
+    )
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        help="Seconds between checks for an updated index",
+        default=2.0,
+    )
+
+
+def main_serve(args):
+    try:
+        serve(
+            args.socket,
+            backend=args.backend,
+            max_batch=args.max_batch,
+            max_wait=args.max_wait_ms / 1000.0,
+            reload_interval=args.reload_interval,
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Long-lived search service over a unix socket",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    add_serve_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    main_serve(get_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,20 @@
+from chg.platform import git
+from chg.search.results import format_result
+
+
 class SimpleCLIUI(object):
     def __init__(self, prompt_marker=">", dev=False):
         self.dev = dev
         self.prompt_marker = prompt_marker
 
     def display_chunk(self, chunk):
-        print(chunk)
+        print(git.colorize_diff(str(chunk)))
 
     def display_question(self, question):
         print("Question: {}".format(question))
 
     def display_search_result(self, result):
-        print(result)
+        print(format_result(result))
 
     def prompt(self, msg, options=None):
         formatted_msg = "{} {} ".format(self.prompt_marker, msg)
@@ -82,7 +86,10 @@ class SimpleCLIUI(object):
                 # TODO: if the user exits or crashes before this
                 # the file system will reflect git changes, but not
                 # any info in chg database, we should fix this...
-                chunk_id = store.record_chunk((old_hash, chunk, new_hash))
+                chunk_id = store.record_chunk(
+                    (old_hash, str(chunk), new_hash),
+                    commit_date=platform.commit_timestamp(new_hash),
+                )
                 store.record_dialogue((chunk_id, answered))
 
     def annotate(self, chunker, store, annotator, platform):
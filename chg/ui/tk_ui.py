@@ -1,20 +1,15 @@
 import enum
-import subprocess
 import sys
 
 import tkinter as tk
 import tkinter.scrolledtext as scrolledtext
 
+from chg.platform import git
+from chg.search.results import format_result
+
 
 def strip_ansi_colors(msg):
-    proc = subprocess.Popen(
-        "sed 's/\x1b\[[0-9;]*m//g'",
-        shell=True,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-    )
-    output, _ = proc.communicate(str.encode(str(msg)))
-    return output.decode().strip()
+    return git.strip_colors(msg).strip()
 
 
 class AnnotationStates(enum.Enum):
@@ -202,7 +197,10 @@ class TkUI(object):
             self.chunker.commit(chunk, commit_msg)
             new_hash = self.platform.hash()
             chunk = self.txt_code.get("1.0", tk.END)
-            chunk_id = self.store.record_chunk((old_hash, chunk, new_hash))
+            chunk_id = self.store.record_chunk(
+                (old_hash, chunk, new_hash),
+                commit_date=self.platform.commit_timestamp(new_hash),
+            )
             self.store.record_dialogue((chunk_id, self.answered))
 
         self.state = AnnotationStates.STAGING
@@ -259,8 +257,8 @@ class TkUI(object):
     def display_results(self, results):
         self.txt_results.configure(state=tk.NORMAL)
         for r in results:
-            r_str = str(r)
-            self.txt_results.insert(tk.END, r_str + "\n")
+            r_str = format_result(r)
+            self.txt_results.insert(tk.END, r_str + "\n\n")
         self.txt_results.configure(state=tk.DISABLED)
 
 
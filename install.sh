@@ -34,6 +34,8 @@ pip install tqdm
 # https://github.com/microsoft/CodeBERT
 pip install torch
 pip install transformers
+# optional onnx embedding backend (--backend onnx)
+pip install onnx onnxruntime
 
 # install faiss
 conda install faiss-cpu -c pytorch
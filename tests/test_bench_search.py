@@ -0,0 +1,40 @@
+from chg.search.bench_search import (
+    StandInEmbedder,
+    bench_mode,
+    build_store,
+    find_regressions,
+)
+
+
+def test_bench_mode(tmp_path):
+    embedder = StandInEmbedder(dim=16, layers=1)
+    store = build_store(str(tmp_path), 30, 16)
+    # reused when rebuilt with the same size
+    store = build_store(str(tmp_path), 30, 16)
+    assert store.run_query("SELECT COUNT(*) FROM Dialogue")[0][0] == 60
+    # paths, dates and text indexed as in a real repository
+    assert len(store.filter_chunk_ids(path_globs=["pkg1/*"])) == 1
+    assert len(store.filter_chunk_ids(since=1.6e9 + 25)) == 6
+    code_ids, answer_ids = store.search_text("fix", 30)
+    assert len(code_ids) + len(answer_ids) > 0
+    _, params, cold, warm = bench_mode(
+        embedder, str(tmp_path), store, "flat", ["fix cache", "why"],
+        cold_runs=2,
+    )
+    assert params["type"] == "flat"
+    assert len(cold["open"]) == 2 and len(warm["search"]) == 2
+    assert len(warm["open"]) == 0
+
+
+def test_find_regressions():
+    baseline = [{"stage": "search", "mode": "flat", "p95_ms": 1.0}]
+    results = [{"stage": "search", "mode": "flat", "p95_ms": 2.0}]
+    assert len(find_regressions(results, baseline, 1.5)) == 1
+    assert len(find_regressions(results, baseline, 2.5)) == 0
+
+
+def test_stand_in_embedder_has_basic_attributes():
+    embedder = StandInEmbedder(dim=16, layers=1)
+    assert (embedder.model_id, embedder.policy) == ("stand-in", "full")
+    assert embedder.cache is None and embedder.budget is None
+    assert embedder.embed_nl_batch(["fix cache"]).shape == (1, 16)
@@ -0,0 +1,72 @@
+from chg.embed.budget import (
+    TokenBudget,
+    budget_from_policy,
+    split_diff_by_file,
+)
+
+
+def tokenize(txt):
+    # stand-in for a real tokenizer: one token per word
+    return txt.split()
+
+
+def make_diff(path, n_lines):
+    header = "diff --git a/{} b/{}".format(path, path)
+    lines = ["+word{}".format(i) for i in range(n_lines)]
+    return "\n".join([header] + lines)
+
+
+def test_split_diff_by_file():
+    diff = make_diff("a.py", 2) + "\n" + make_diff("b/c.py", 3)
+    files = list(split_diff_by_file(diff))
+    assert [path for path, _ in files] == ["a.py", "b/c.py"]
+    assert files[1][1].split("\n")[-1] == "+word2"
+
+
+def test_policies_respect_budget():
+    diff = make_diff("a.py", 1000)
+    for policy in ["head", "tail", "head-tail"]:
+        budget = TokenBudget(max_tokens=50, file_tokens=50, policy=policy)
+        tokens = budget.select_tokens(tokenize, diff)
+        assert len(tokens) == 50
+    strided = TokenBudget(max_tokens=50, file_tokens=50, policy="strided")
+    tokens = strided.select_tokens(tokenize, diff)
+    # samples from across the whole file
+    assert 0 < len(tokens) <= 50
+    assert int(tokens[-1][len("+word"):]) > 500
+    head = TokenBudget(max_tokens=10, file_tokens=10, policy="head")
+    assert head.select_tokens(tokenize, diff)[-1] == "+word5"
+    tail = TokenBudget(max_tokens=10, file_tokens=10, policy="tail")
+    assert tail.select_tokens(tokenize, diff)[-1] == "+word999"
+
+
+def test_skip_generated_files():
+    diff = make_diff("yarn.lock", 100) + "\n" + make_diff("a.py", 5)
+    budget = TokenBudget()
+    tokens = budget.select_tokens(tokenize, diff)
+    assert "+word99" not in tokens
+    assert tokens[-1] == "+word4"
+    # only generated files: keep headers so chunk isn't empty
+    tokens = budget.select_tokens(tokenize, make_diff("yarn.lock", 100))
+    assert tokens == ["diff", "--git", "a/yarn.lock", "b/yarn.lock"]
+
+
+def test_head_tail_just_over_budget():
+    budget = TokenBudget(max_tokens=50, file_tokens=50, policy="head-tail")
+    # more bytes than the limit, but fewer tokens: all of it, once
+    diff = make_diff("a.py", 30)
+    assert budget.select_tokens(tokenize, diff) == tokenize(diff)
+    # a few tokens over: nothing taken twice
+    diff = make_diff("a.py", 50)
+    tokens = budget.select_tokens(tokenize, diff)
+    assert len(tokens) == 50 and len(set(tokens)) == 50
+    assert tokens[-1] == "+word49"
+
+
+def test_budget_from_policy():
+    budget = TokenBudget(max_tokens=100, file_tokens=30, policy="tail",
+                         skip_generated=False)
+    policy = budget.describe()
+    assert budget_from_policy(policy).describe() == policy
+    assert budget_from_policy("full") is None
+    assert budget_from_policy(None) is None
@@ -0,0 +1,135 @@
+import sqlite3
+import threading
+
+import pytest
+
+from chg.db.database import Database
+from chg.db.migrations import SCHEMA_VERSION, get_schema_version, migrate
+
+
+def test_bulk_writes_in_transaction(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    assert store.run_query("PRAGMA journal_mode") == [("wal", )]
+    rows = [("a", "diff --git a/x.py b/x.py\n+x = 1", "b"),
+            ("b", "diff --git a/y.py b/y.py\n+y = 1", "c")]
+    with store.transaction():
+        chunk_ids = store.record_chunks_many(rows, commit_dates=[1.0, 2.0])
+        qa_ids = store.record_dialogue_many([
+            (chunk_ids[0], [("Commit: ", "add x"), ("Why?", "needed")]),
+            (chunk_ids[1], [("Commit: ", "add y")]),
+        ])
+    assert [len(ids) for ids in qa_ids] == [2, 1]
+    assert store.filter_chunk_ids(path_globs=["y.py"]) == [chunk_ids[1]]
+
+    # nothing written if the transaction fails part way
+    with pytest.raises(ValueError):
+        with store.transaction():
+            store.record_chunk(("c", "+z = 1", "d"))
+            raise ValueError()
+    assert store.run_query("SELECT COUNT(*) FROM Chunks") == [(2, )]
+
+
+def test_migrations_upgrade_in_place(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    conn = sqlite3.connect(path)
+    # as written by a version without SchemaVersion or indexes
+    conn.execute(
+        "CREATE TABLE Embeddings (id INTEGER PRIMARY KEY, chunk_id INTEGER, "
+        "code_embedding BLOB, nl_embedding BLOB, dialogue_hash TEXT, "
+        "model TEXT, policy TEXT, row INTEGER)"
+    )
+    conn.executemany(
+        "INSERT INTO Embeddings(chunk_id, model, dialogue_hash) VALUES(?, ?, ?)",
+        [(1, "m", "old"), (1, "m", "new"), (2, "m", "h")],
+    )
+    conn.commit()
+    conn.close()
+
+    store = Database(path)
+    assert get_schema_version(store.conn) == SCHEMA_VERSION
+    assert store.run_query(
+        "SELECT chunk_id, dialogue_hash FROM Embeddings ORDER BY chunk_id"
+    ) == [(1, "new"), (2, "h")]
+    plan = store.run_query(
+        "EXPLAIN QUERY PLAN SELECT * FROM Dialogue WHERE chunk_id = 1"
+    )
+    assert "DialogueChunkId" in plan[0][-1]
+    # Diffs and Chunks.diff_hash come with compress_diffs
+    columns = [row[1] for row in store.run_query("PRAGMA table_info(Chunks)")]
+    assert "diff_hash" in columns
+    # already up to date
+    assert migrate(store.conn) == []
+
+
+def test_search_results_in_rank_order(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    first = store.record_chunk(("a", "diff --git a/x.py b/x.py\n+x = 1", "b"))
+    second = store.record_chunk(("b", "diff --git a/y.py b/y.py\n+y = 1", "c"))
+    store.record_dialogue((second, [("Commit: ", "add y"), ("Why?", "tests")]))
+    results = store.get_search_results([second, first], scores=[0.9, 0.5])
+    assert [(r.rank, r.chunk_id, r.score) for r in results] == \
+        [(0, second, 0.9), (1, first, 0.5)]
+    assert results[0].paths == ["y.py"]
+    assert results[0].dialogue == [("Commit: ", "add y"), ("Why?", "tests")]
+    assert results[0].excerpt.endswith("+y = 1")
+    assert results[1].dialogue == []
+
+
+def test_diffs_compressed_and_stored_once(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    diff = "diff --git a/x.py b/x.py\n+x = 1"
+    conn = sqlite3.connect(path)
+    # as written before diffs moved out of Chunks
+    conn.execute(
+        "CREATE TABLE Chunks (id INTEGER PRIMARY KEY, prehash TEXT, "
+        "chunk TEXT, posthash TEXT, commit_date REAL)"
+    )
+    conn.executemany(
+        "INSERT INTO Chunks(prehash, chunk, posthash) VALUES(?, ?, ?)",
+        [("a", diff, "b"), ("c", diff, "d")],
+    )
+    conn.commit()
+    conn.close()
+
+    store = Database(path)
+    assert store.run_query("SELECT COUNT(*) FROM Chunks WHERE chunk IS NULL") \
+        == [(2, )]
+    third = store.record_chunk(("e", diff, "f"))
+    n_chunks, n_diffs, raw, _ = store.get_diff_stats()
+    assert (n_chunks, n_diffs, raw) == (3, 1, len(diff))
+    assert store.get_chunks_by_ids([1, third]) == {1: diff, third: diff}
+    assert store.get_search_results([third])[0].paths == ["x.py"]
+    assert store.filter_chunk_ids(path_globs=["x.py"]) == [1, 2, third]
+
+
+def test_reads_from_other_threads_during_write(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    first = store.record_chunk(("a", "diff --git a/x.py b/x.py\n+x = 1", "b"))
+    seen = []
+
+    def read():
+        seen.append(sorted(store.get_chunks_by_ids([first, first + 1])))
+
+    with store.transaction():
+        second = store.record_chunk(("b", "diff --git a/y.py b/y.py", "c"))
+        # this thread reads its own write, others the last commit
+        assert sorted(store.get_chunks_by_ids([first, second])) == \
+            [first, second]
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join(timeout=5)
+    read()
+    assert seen == [[first], [first, second]]
+    with pytest.raises(sqlite3.OperationalError):
+        store.reader.execute("DELETE FROM Chunks")
+
+
+def test_close_closes_every_threads_reader(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    readers = []
+    thread = threading.Thread(target=lambda: readers.append(store.reader))
+    thread.start()
+    thread.join(timeout=5)
+    store.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        readers[0].execute("SELECT 1")
@@ -0,0 +1,17 @@
+import numpy as np
+
+from chg.embed.cache import EmbeddingCache
+
+
+def test_cache_shared_between_connections(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    first = EmbeddingCache(path, memory_entries=0)
+    second = EmbeddingCache(path, memory_entries=0)
+    assert first.conn.execute("PRAGMA journal_mode").fetchone() == ("wal", )
+    vec = np.ones(4, dtype=np.float32)
+    # an open read on one connection doesn't make the other's write fail
+    first.conn.execute("BEGIN")
+    first.conn.execute("SELECT COUNT(*) FROM EmbeddingCache").fetchone()
+    second.put_many("m", ["why?"], [vec])
+    first.conn.rollback()
+    assert np.allclose(first.get_many("m", [" why? "])[0], vec)
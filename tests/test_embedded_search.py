@@ -0,0 +1,132 @@
+import faiss
+import numpy as np
+
+from chg.db.database import Database
+from chg.search import embedded_search
+from chg.search.embedded_search import (
+    EmbeddedSearcher,
+    load_index,
+    lookup_many_in_store,
+    run_queries,
+    run_query,
+    update_index,
+)
+from chg.search.index_modes import choose_mode
+
+
+def test_update_index_in_place(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    path = str(tmp_path / "faiss.db")
+    vecs = np.eye(4, dtype=np.float32)
+    store.record_embeddings_many([(i + 1, vecs[i], vecs[i], "h")
+                                  for i in range(3)])
+    index, n_removed, n_added = update_index(store, path=path)
+    assert (index.ntotal, n_removed, n_added) == (6, 0, 3)
+    assert run_query(index, vecs[1], 1) == [2]
+
+    # chunk 2 re-embedded, chunk 3 dropped
+    store.record_embeddings((2, vecs[3], vecs[3]), dialogue_hash="h2")
+    store.run_query("DELETE FROM Embeddings WHERE chunk_id = 3")
+    store.conn.commit()
+    index, n_removed, n_added = update_index(store, path=path)
+    assert (index.ntotal, n_removed, n_added) == (4, 2, 1)
+    assert run_query(index, vecs[3], 1) == [2]
+    assert sorted(run_query(index, vecs[2], 3)) == [1, 2]
+    assert store.get_index_version(path)[1:] == (2, 4)
+
+    # nothing changed
+    _, n_removed, n_added = update_index(store, path=path)
+    assert (n_removed, n_added) == (0, 0)
+
+
+def test_baseline_index_is_rebuilt(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    path = str(tmp_path / "faiss.db")
+    vecs = np.eye(4, dtype=np.float32)
+    store.record_embeddings_many([(i + 3, vecs[i], vecs[i], "h")
+                                  for i in range(3)])
+    # as written originally: positional, no IndexVersions row
+    old = faiss.IndexFlatIP(4)
+    old.add(vecs[:3])
+    faiss.write_index(old, path)
+    index, params = load_index(store, path)
+    assert run_query(index, vecs[1], 1) == [4]
+    assert store.get_index_version(path) is not None
+    # loaded as is once rebuilt
+    _, n_removed, n_added = update_index(store, path=path)
+    assert (n_removed, n_added) == (0, 0)
+
+
+def test_index_modes(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    path = str(tmp_path / "faiss.db")
+    vecs = np.random.RandomState(0).random((200, 8)).astype(np.float32)
+    store.record_embeddings_many([(i + 1, vecs[i], vecs[i], "h")
+                                  for i in range(200)])
+    assert choose_mode(200) == "flat"
+    for mode in ["ivf-flat", "ivf-pq", "hnsw"]:
+        index, _, n_added = update_index(store, path=path, mode=mode)
+        assert n_added == 200
+        assert store.get_index_params(path)[0] == mode
+
+    # hnsw can't remove in place, so rebuilt when a chunk is replaced
+    store.record_embeddings((5, vecs[0], vecs[0]), dialogue_hash="h2")
+    index, n_removed, n_added = update_index(store, path=path)
+    assert (index.ntotal, n_removed, n_added) == (400, 0, 200)
+    assert store.get_index_params(path)[0] == "hnsw"
+
+
+def test_field_weights(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    path = str(tmp_path / "faiss.db")
+    vecs = np.eye(4, dtype=np.float32)
+    # chunk 1 matches the query on code, chunk 2 on dialogue
+    store.record_embeddings_many([
+        (1, vecs[0], vecs[1], "h"),
+        (2, vecs[1], vecs[0], "h"),
+    ])
+    index, _, _ = update_index(store, path=path)
+    code_first = {"code": 0.9, "nl": 0.1}
+    nl_first = {"code": 0.1, "nl": 0.9}
+    assert run_query(index, vecs[0], 2, weights=code_first) == [1, 2]
+    assert run_query(index, vecs[0], 2, weights=nl_first) == [2, 1]
+
+
+def test_batched_queries_match_single(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    path = str(tmp_path / "faiss.db")
+    vecs = np.random.RandomState(0).random((20, 8)).astype(np.float32)
+    for i in range(20):
+        chunk_id = store.record_chunk(("a", "chunk {}".format(i), "b"))
+        store.record_dialogue((chunk_id, [("Commit: ", "msg {}".format(i))]))
+    store.record_embeddings_many([(i + 1, vecs[i], vecs[i], "h")
+                                  for i in range(20)])
+    index, _, _ = update_index(store, path=path)
+    queries = vecs[:5] + 0.1
+    batched = run_queries(index, queries, 3)
+    assert batched == [run_query(index, q, 3) for q in queries]
+    results = lookup_many_in_store(store, batched)
+    assert [[r.chunk_id for r in rs] for rs in results] == batched
+    assert results[0][0].dialogue == [("Commit: ", "msg {}".format(
+        batched[0][0] - 1))]
+
+
+def test_cache_mode_follows_backend_and_index(tmp_path, monkeypatch):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    path = str(tmp_path / "faiss.db")
+    vecs = np.eye(4, dtype=np.float32)
+    store.record_embeddings_many([(i + 1, vecs[i], vecs[i], "h")
+                                  for i in range(3)])
+    update_index(store, path=path)
+    monkeypatch.setattr(embedded_search, "get_embedder",
+                        lambda backend: None)
+    monkeypatch.setattr(embedded_search, "get_store", lambda: store)
+    monkeypatch.setattr(embedded_search, "load_index",
+                        lambda store: load_index(store, path))
+    searcher = EmbeddedSearcher(backend="torch")
+    # results from one backend are not served to another
+    assert searcher.cache_mode != EmbeddedSearcher(backend="onnx").cache_mode
+    mode = searcher.cache_mode
+    index, params = load_index(store, path)
+    searcher.set_index(index, dict(params, fields=["nl"]))
+    assert searcher.cache_mode != mode
@@ -0,0 +1,69 @@
+import numpy as np
+
+from chg.db.database import Database
+from chg.search.embedded_search import update_index
+from chg.search.federated_search import OpenRepos, RepoIndex, read_registry
+
+
+def build_repo(root, vecs, nl_vecs=None):
+    (root / ".chg").mkdir(parents=True)
+    store = Database(str(root / ".chg" / "db.sqlite3"))
+    nl_vecs = vecs if nl_vecs is None else nl_vecs
+    store.record_embeddings_many([
+        (i + 1, code, nl, "h")
+        for i, (code, nl) in enumerate(zip(vecs, nl_vecs))
+    ])
+    update_index(store, path=str(root / ".chg" / "faiss.db"))
+
+
+def test_repo_index(tmp_path):
+    vecs = np.eye(4, dtype=np.float32)
+    build_repo(tmp_path / "a", vecs[:2])
+    build_repo(tmp_path / "b", vecs[2:])
+    registry = tmp_path / "repos.txt"
+    registry.write_text("# services\n{}\n\n{}  # b\n".format(
+        tmp_path / "a", tmp_path / "b"))
+    repos = [RepoIndex(r) for r in read_registry(str(registry))]
+    assert [r.name for r in repos] == ["a", "b"]
+
+    # opened lazily, similarities comparable across repositories
+    assert repos[1].faiss_index is None
+    scored = [r.search(vecs[3:], 1)[0] for r in repos]
+    assert scored[1][0][0] == 2
+    assert scored[1][0][1] > scored[0][0][1]
+
+
+def test_least_recently_used_repos_closed(tmp_path):
+    vecs = np.eye(4, dtype=np.float32)
+    repos = []
+    for name in "abc":
+        build_repo(tmp_path / name, vecs)
+        repos.append(RepoIndex(str(tmp_path / name)))
+    open_repos = OpenRepos(max_open=2)
+    for repo in repos + [repos[1]]:
+        repo.search(vecs[:1], 1)
+        open_repos.use(repo)
+    assert len(open_repos) == 2
+    assert [r.is_open() for r in repos] == [False, True, True]
+    assert repos[0].conn is None
+    # reopened when searched again, closing the least recently used
+    assert repos[0].search(vecs[:1], 1)[0][0][0] == 1
+    open_repos.use(repos[0])
+    assert [r.is_open() for r in repos] == [True, True, False]
+
+
+def test_scores_are_exact_similarities(tmp_path):
+    rng = np.random.RandomState(0)
+    code, nl = rng.standard_normal((2, 200, 16)).astype(np.float32)
+    code /= np.linalg.norm(code, axis=1, keepdims=True)
+    nl /= np.linalg.norm(nl, axis=1, keepdims=True)
+    # few chunks are retrieved for both fields, the others were filled
+    # with this repository's lowest retrieved similarity
+    build_repo(tmp_path / "a", code, nl_vecs=nl)
+    query = code[:1]
+    exact = 0.4 * (code @ query[0]) + 0.6 * (nl @ query[0])
+    scored = RepoIndex(str(tmp_path / "a")).search(query, 5)[0]
+    assert [chunk_id for chunk_id, _ in scored] == \
+        list(np.argsort(-exact)[:5] + 1)
+    for chunk_id, score in scored:
+        assert abs(score - exact[chunk_id - 1]) < 1e-5
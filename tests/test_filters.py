@@ -0,0 +1,101 @@
+import json
+
+import numpy as np
+
+from chg.db.database import Database
+from chg.search.embedded_search import (
+    exact_search_scored,
+    get_fields,
+    run_queries_scored,
+    run_query,
+    update_index,
+)
+from chg.search.index_modes import INDEX_MODES
+from chg.search.filters import SearchFilter, parse_date
+
+
+def diff(path):
+    return "diff --git a/{0} b/{0}\n+x = 1".format(path)
+
+
+def test_filter_chunk_ids(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    day = parse_date("2021-03-02")
+    first = store.record_chunk(("a" * 40, diff("chg/db/x.py"), "b" * 40),
+                               commit_date=day)
+    second = store.record_chunk(("b" * 40, diff("README.md"), "c" * 7),
+                                commit_date=day + 86400)
+
+    assert store.filter_chunk_ids(path_globs=["chg/db"]) == [first]
+    assert store.filter_chunk_ids(path_globs=["*.md"]) == [second]
+    assert store.filter_chunk_ids(path_globs=["chg"], since=day + 1) == []
+    until = parse_date("2021-03-02", end_of_day=True)
+    assert store.filter_chunk_ids(until=until) == [first]
+    # full hashes match abbreviated ones recorded
+    assert store.filter_chunk_ids(commits=["c" * 40]) == [second]
+    assert SearchFilter(paths=["README.md"]).chunk_ids(store) == [second]
+    assert SearchFilter().chunk_ids(store) is None
+
+
+def test_filtered_query(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    path = str(tmp_path / "faiss.db")
+    vecs = np.eye(4, dtype=np.float32)
+    store.record_embeddings_many([(i + 1, vecs[i], vecs[i], "h")
+                                  for i in range(3)])
+    index, _, _ = update_index(store, path=path)
+    assert run_query(index, vecs[0], 1) == [1]
+    # closest allowed chunk instead
+    assert run_query(index, vecs[0], 1, chunk_ids=[2, 3]) in ([2], [3])
+    assert run_query(index, vecs[0], 5, chunk_ids=[3]) == [3]
+    assert run_query(index, vecs[0], 5, chunk_ids=[]) == []
+
+
+def test_filtered_query_returns_k_in_every_mode(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    rng = np.random.RandomState(0)
+    n = 400
+    code, nl = rng.standard_normal((2, n, 16)).astype(np.float32)
+    store.record_embeddings_many([(i + 1, code[i], nl[i], "h")
+                                  for i in range(n)])
+    queries = rng.standard_normal((5, 16)).astype(np.float32)
+    k = 3
+    for mode in INDEX_MODES:
+        path = str(tmp_path / "{}.faiss".format(mode))
+        index, _, _ = update_index(store, path=path, mode=mode)
+        _, params = store.get_index_params(path)
+        params = json.loads(params)
+        fields, stride = get_fields(params)
+        for allowed in [[7, 90, 200, 311], [5, 6]]:
+            expected = min(k, len(allowed))
+            for results in [
+                run_queries_scored(index, queries, k, fields=fields,
+                                   stride=stride, chunk_ids=allowed,
+                                   params=params),
+                exact_search_scored(store, queries, k, allowed,
+                                    fields=fields),
+            ]:
+                for scored in results:
+                    assert len(scored) == expected, mode
+                    assert set(i for i, _ in scored) <= set(allowed)
+
+
+def test_commit_range_follows_refs(tmp_path, monkeypatch):
+    from chg.platform import git
+    monkeypatch.chdir(tmp_path)
+    git.init()
+    hashes = []
+    for name in ["a.py", "b.py"]:
+        (tmp_path / name).write_text("x = 1\n")
+        git.add([name])
+        git.commit("add " + name)
+        hashes.append(git.hash())
+    store = Database(str(tmp_path / "db.sqlite3"))
+    chunk_ids = [store.record_chunk(("0" * 40, diff(name), h))
+                 for name, h in zip(["a.py", "b.py"], hashes)]
+    git.run_command(["git", "reset", "-q", "--hard", hashes[0]])
+    search_filter = SearchFilter(until_commit="HEAD")
+    assert search_filter.chunk_ids(store) == chunk_ids[:1]
+    # HEAD moved, the database didn't change
+    git.run_command(["git", "reset", "-q", "--hard", hashes[1]])
+    assert sorted(search_filter.chunk_ids(store)) == chunk_ids
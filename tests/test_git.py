@@ -82,3 +82,29 @@ def test_modify_file(tmp_path):
     assert changed == ["file1.txt"]
 
     os.chdir(curr_dir)
+
+
+def test_diff_without_colors(tmp_path):
+    curr_dir = os.getcwd()
+    os.chdir(tmp_path)
+    assert git.init() == 0
+    write("file1.txt", "this is file 1")
+    assert git.add(["."]) == 0
+    assert git.commit("stub") == 0
+
+    write("file1.txt", "this is more content", mode="a")
+    assert git.add(["."]) == 0
+
+    diff = git.diff()
+    assert "\x1b[" not in diff
+    assert "+this is file 1this is more content" in diff
+
+    os.chdir(curr_dir)
+
+
+def test_strip_and_colorize():
+    colored = "\x1b[1mdiff --git a/f b/f\x1b[m\n\x1b[32m+added\x1b[m"
+    plain = "diff --git a/f b/f\n+added"
+    assert git.strip_colors(colored) == plain
+    assert git.strip_colors(git.colorize_diff(plain)) == plain
+    assert git.colorize_diff(plain).split("\n")[1] == "\x1b[32m+added\x1b[m"
@@ -0,0 +1,43 @@
+from chg.db.database import Database
+from chg.search.hybrid_search import (
+    LexicalSearcher,
+    looks_like_identifier,
+    reciprocal_rank_fusion,
+    to_match_expression,
+)
+
+
+def test_query_parsing():
+    assert to_match_expression('fix "QuestionRanker"') == \
+        '"fix" OR "QuestionRanker"'
+    assert to_match_expression("chg/db/database.py") == \
+        '"chg/db/database.py"'
+    assert to_match_expression("?!") == ""
+    assert looks_like_identifier("QuestionRanker")
+    assert looks_like_identifier("JIRA-123")
+    assert looks_like_identifier("insert_chunk")
+    assert not looks_like_identifier("ranker")
+    assert not looks_like_identifier("why rank questions")
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([[1, 2, 3], [2, 3], []])
+    assert fused == [2, 3, 1]
+
+
+def test_text_kept_in_sync(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    first = store.record_chunk(("a", "+class QuestionRanker(object):", "b"))
+    second = store.record_chunk(("b", "+def insert_chunk(conn, row):", "c"))
+    store.record_dialogue((first, [("Commit: ", "Rank questions")]))
+    store.record_dialogue((second, [("Commit: ", "Fixes JIRA-123")]))
+
+    searcher = LexicalSearcher(store)
+    assert searcher.search_chunk_ids("QuestionRanker") == ([first], [])
+    assert searcher.search_chunk_ids("JIRA-123") == ([], [second])
+    assert searcher.search_chunk_ids("insert_chunk")[0] == [second]
+
+    # existing rows are indexed when the tables are first created
+    store.run_query("DROP TABLE ChunkText")
+    store = Database(str(tmp_path / "db.sqlite3"))
+    assert LexicalSearcher(store).search_chunk_ids("row")[0] == [second]
@@ -0,0 +1,21 @@
+import queue
+
+import pytest
+
+from chg.db.database import Database
+from chg.embed.pipeline import iterate_queue, read_batches
+
+
+def test_reader_error_reaches_consumer(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    chunk_id = store.record_chunk(("a" * 40, "+x = 1", "b" * 40))
+    # second chunk removed after todo was read
+    todo = [(chunk_id, [], "h"), (chunk_id + 1, [], "h")]
+    batches = queue.Queue()
+    errors = []
+    read_batches(store, todo, 1, batches, errors)
+    consumed = []
+    with pytest.raises(KeyError):
+        for batch in iterate_queue(batches):
+            consumed.append(batch)
+    assert len(consumed) == 1 and len(errors) == 1
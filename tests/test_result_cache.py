@@ -0,0 +1,58 @@
+import numpy as np
+
+from chg.db.database import Database
+from chg.search.result_cache import ResultCache, cached_search, normalize_query
+
+
+def test_normalize_query():
+    assert normalize_query(" What changed in  auth? ") == \
+        normalize_query("What changed in auth")
+    assert normalize_query("Fix URLParser") != normalize_query("fix urlparser")
+
+
+def test_cached_until_content_changes(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    calls = []
+
+    def search_fn(query, k):
+        calls.append(query)
+        return [(1, 0.5), (2, 0.25)][:k]
+
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"))
+    miss = cached_search(cache, store, "auth?", 2, "hybrid", search_fn)
+    assert miss == [(1, 0.5), (2, 0.25)]
+    assert cached_search(cache, store, "auth ", 2, "hybrid", search_fn) == miss
+    assert len(calls) == 1
+    # different k or mode are different results
+    cached_search(cache, store, "auth", 1, "hybrid", search_fn)
+    cached_search(cache, store, "auth", 2, "vector", search_fn)
+    assert len(calls) == 3
+
+    # persisted across sessions, scores included
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"))
+    assert cached_search(cache, store, "auth", 2, "hybrid", search_fn) == miss
+    assert len(calls) == 3
+
+    # new chunk: stale results dropped
+    store.record_chunk(("a", "+x = 1", "b"))
+    cached_search(cache, store, "auth", 2, "hybrid", search_fn)
+    assert len(calls) == 4
+
+
+def test_hit_equals_miss(tmp_path):
+    from chg.search.embedded_search import lookup_in_store
+    store = Database(str(tmp_path / "db.sqlite3"))
+    chunk_id = store.record_chunk(("a", "diff --git a/auth.py b/auth.py", "b"))
+
+    def search_fn(query, k):
+        return [(chunk_id, np.float32(0.7))]
+
+    path = str(tmp_path / "cache.sqlite3")
+    miss = cached_search(ResultCache(path), store, "auth", 1, "vector",
+                         search_fn)
+    # from disk, not the in-memory LRU
+    hit = cached_search(ResultCache(path), store, "auth", 1, "vector",
+                        search_fn)
+    assert hit == miss
+    assert lookup_in_store(store, *zip(*hit)) == \
+        lookup_in_store(store, *zip(*miss))
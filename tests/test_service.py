@@ -0,0 +1,102 @@
+import socket
+import threading
+
+import numpy as np
+import pytest
+
+from chg.db.database import Database
+from chg.embed.service import EmbeddingServer, recv_message, send_message
+from chg.search import embedded_search
+from chg.search.filters import SearchFilter
+from chg.search.service import QueryBatcher, SearchRequest, SearchServer
+
+
+class StubEmbedder(object):
+    model_id = "stub"
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(server.server_address)
+    return sock, sock.makefile("rwb")
+
+
+def test_embedding_service_rejects_malformed_request(tmp_path):
+    server = EmbeddingServer(str(tmp_path / "embed.sock"), StubEmbedder())
+    sock, sock_file = start(server)
+    sock_file.write(b"not json\n")
+    sock_file.flush()
+    assert "error" in recv_message(sock_file)
+    # connection still served
+    send_message(sock_file, {"method": "info"})
+    assert recv_message(sock_file) == {"model_id": "stub"}
+    sock.close()
+    server.shutdown()
+    server.server_close()
+
+
+class StubBatcher(object):
+    stats = {"requests": 0, "batches": 0, "reloads": 0}
+
+
+def test_search_service_rejects_malformed_request(tmp_path):
+    path = str(tmp_path / "search.sock")
+    server = SearchServer(path, StubBatcher(), "stub")
+    sock, sock_file = start(server)
+    sock_file.write(b"{\"method\": \"search\"\n")
+    sock_file.flush()
+    assert "error" in recv_message(sock_file)
+    send_message(sock_file, {"method": "stats"})
+    assert recv_message(sock_file) == StubBatcher.stats
+    sock.close()
+    server.shutdown()
+    server.server_close()
+
+
+class StubSearcher(object):
+    def __init__(self, store):
+        self.store = store
+        self.embed_model = self
+
+    def embed_nl_batch(self, nls):
+        return np.zeros((len(nls), 4), dtype=np.float32)
+
+    def run_queries_(self, vectors, k, search_filter=None):
+        if search_filter is not None:
+            search_filter.chunk_ids(self.store)
+        return [[(1, 1.0)] for _ in vectors]
+
+
+def test_bad_filter_fails_only_its_requests(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    chunk_id = store.record_chunk(("a" * 40, "+x = 1", "b" * 40))
+    store.record_dialogue((chunk_id, [("Commit: ", "add x")]))
+    batcher = QueryBatcher()
+    batcher.searcher = StubSearcher(store)
+    with pytest.raises(ValueError):
+        batcher.get_filter({"since": "yesterday"})
+    # resolved in the batch, e.g. if it was valid when submitted
+    batch = [
+        SearchRequest("x", 1, SearchFilter(since="yesterday")),
+        SearchRequest("x", 1, None),
+    ]
+    batcher.run_batch(batch)
+    assert batch[0].error is not None and batch[0].results is None
+    assert batch[1].error is None and batch[1].chunk_ids == [chunk_id]
+    assert len(batch[1].results) == 1
+
+
+def test_batcher_start_raises_without_index(tmp_path, monkeypatch):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    load_index = embedded_search.load_index
+    monkeypatch.setattr(embedded_search, "get_embedder",
+                        lambda backend: StubEmbedder())
+    monkeypatch.setattr(embedded_search, "get_store", lambda: store)
+    monkeypatch.setattr(
+        embedded_search, "load_index",
+        lambda store: load_index(store, str(tmp_path / "faiss.db")),
+    )
+    batcher = QueryBatcher()
+    with pytest.raises(RuntimeError):
+        batcher.start(path=str(tmp_path / "faiss.db"))
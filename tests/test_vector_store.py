@@ -0,0 +1,94 @@
+import threading
+
+import numpy as np
+
+from chg.db.database import Database
+
+
+def random_vectors(n, dim=4):
+    return np.random.random((n, dim)).astype(np.float32)
+
+
+def test_embeddings_roundtrip_and_compact(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    code, nl = random_vectors(3), random_vectors(3)
+    ids = store.record_embeddings_many([(i + 1, code[i], nl[i], "h")
+                                        for i in range(3)])
+    assert len(set(ids)) == 3
+    # re-embedding a chunk leaves its old row unreferenced
+    assert store.record_embeddings(
+        (2, nl[0], code[0]), dialogue_hash="h2") == ids[1]
+
+    chunk_ids, mat = store.get_embedding_matrix("code")
+    assert chunk_ids == [1, 2, 3]
+    assert np.allclose(mat, np.vstack([code[0], nl[0], code[2]]))
+
+    assert store.vectors.compact() == (4, 3)
+    code_vec, nl_vec = store.get_embeddings_by_chunk_id(2)
+    assert np.allclose(code_vec, nl[0]) and np.allclose(nl_vec, code[0])
+    assert len(list(tmp_path.joinpath("vectors").iterdir())) == 2
+
+
+def test_uncommitted_append_is_dropped(tmp_path):
+    db_path = str(tmp_path / "db.sqlite3")
+    store = Database(db_path)
+    store.record_embeddings((1, random_vectors(1)[0], random_vectors(1)[0]))
+    # vectors written, but transaction never committed
+    store.vectors.append({"code": random_vectors(5), "nl": random_vectors(5)})
+    store.conn.rollback()
+    store.conn.close()
+
+    store = Database(db_path)
+    assert store.vectors.info()[1] == 1
+    assert store.vectors.matrix("code").shape == (1, 4)
+    # leftovers are dropped by the next append, under the write lock
+    store.record_embeddings((2, random_vectors(1)[0], random_vectors(1)[0]))
+    assert store.vectors.matrix("code").shape == (2, 4)
+    assert tmp_path.joinpath("vectors", "code.0.f32").stat().st_size == 32
+
+
+def test_open_during_append_keeps_rows(tmp_path):
+    db_path = str(tmp_path / "db.sqlite3")
+    writer = Database(db_path)
+    writer.record_embeddings((1, random_vectors(1)[0], random_vectors(1)[0]))
+    with writer.transaction():
+        writer.record_embeddings_many([
+            (i, code, nl, "h")
+            for i, code, nl in zip([2, 3, 4], random_vectors(3),
+                                   random_vectors(3))
+        ])
+        # appended but not committed yet
+        other = Database(db_path)
+        assert other.vectors.matrix("code").shape == (1, 4)
+    assert other.vectors.matrix("code").shape == (4, 4)
+    assert tmp_path.joinpath("vectors", "code.0.f32").stat().st_size == 64
+
+
+def test_compact_waits_for_other_threads_transaction(tmp_path):
+    store = Database(str(tmp_path / "db.sqlite3"))
+    store.record_embeddings((1, random_vectors(1)[0], random_vectors(1)[0]))
+    started, release = threading.Event(), threading.Event()
+
+    def write():
+        try:
+            with store.transaction():
+                store.record_chunk(("a", "+x = 1", "b"))
+                started.set()
+                release.wait(5)
+                raise ValueError()
+        except ValueError:
+            pass
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    started.wait(5)
+    compactor = threading.Thread(target=store.vectors.compact)
+    compactor.start()
+    compactor.join(timeout=0.2)
+    assert compactor.is_alive()
+    release.set()
+    writer.join(timeout=5)
+    compactor.join(timeout=5)
+    # compact didn't commit the other thread's half-finished write
+    assert store.run_query("SELECT COUNT(*) FROM Chunks") == [(0, )]
+    assert store.vectors.info()[1:] == (1, 1)